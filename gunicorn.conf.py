@@ -0,0 +1,65 @@
+# Gunicorn settings of the website, run from the repository root :
+#   gunicorn route:app
+#
+# The app (and so the NYCRouteManager) is loaded once in the master process
+# (preload_app), the workers are forked from it : they share the pages of
+# the snapshot files (page cache) and of the arrays built while loading
+# instead of each loading its own copy of the graph. See the README for the
+# memory used by each worker.
+#
+# With LAZY_STARTUP=1, the app is not preloaded : each worker imports it and
+# loads the graph in the background, answering /health at once and /ready
+# once the graph is mapped and its route pools are forked (faster start, no
+# pages shared but the snapshot files).
+#
+# The workers are not restarted when the data changes : they map the new
+# snapshot or risk arrays on their next request (see
+# NYCRouteManager.refresh_snapshot).
+import gc
+import multiprocessing
+import os
+import shutil
+
+pythonpath = "website"
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+lazy_startup = bool(os.environ.get("LAZY_STARTUP"))
+preload_app = not lazy_startup
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Threads waiting on the geocoders and on the route pool of the worker
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+# Above the request deadline of the NavigationService
+timeout = 60
+# Number of processes computing the routes in each worker (read by route.py)
+os.environ.setdefault("ROUTE_WORKERS", "2")
+# Files of the metrics of the workers, added up by /metrics
+metrics_dirpath = os.environ.get("METRICS_DIRPATH", "data/metrics")
+
+
+def on_starting(server):
+    # The metrics of a previous run are not counted
+    shutil.rmtree(metrics_dirpath, ignore_errors=True)
+
+
+def pre_fork(server, worker):
+    # The objects created while loading are never collected : a collection
+    # would write in their pages, which would then be copied by each worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from utils.metrics import metrics
+
+    metrics.share(metrics_dirpath)
+    if preload_app:
+        import route
+
+        # Forked before the threads of the worker start, see
+        # NYCRouteManager.get_route_pool
+        route.route_managers.start_route_pools()
+
+
+def worker_exit(server, worker):
+    from utils.metrics import metrics
+
+    metrics.save()
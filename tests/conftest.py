@@ -0,0 +1,82 @@
+import sys
+
+from os import path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# The modules are imported as in the website : `from utils.x import ...`
+sys.path.insert(0, path.join(path.dirname(path.dirname(__file__)), "website"))
+
+from utils.benchmark import synthetic_graph  # noqa: E402
+from utils.graph_snapshot import GraphSnapshot  # noqa: E402
+from utils.profiles import compile_profiles  # noqa: E402
+from utils.route_engine import RouteEngine  # noqa: E402
+
+# Side (in nodes) of the synthetic grid of the tests
+GRID_SIZE = 12
+
+
+def profile_graph(G, profile):
+    """
+    Returns a copy of a graph with the weight of a profile on each edge in
+    a `weight` attribute, to search it with networkx.
+    """
+    H = G.copy()
+    for u, v, data in H.edges(data=True):
+        # The profile evaluated on a snapshot of one edge
+        edge = SimpleNamespace(
+            n_edges=1,
+            edge_length=[data.get("length", np.nan)],
+            edge_risk=[data.get("risk", np.nan)],
+            edge_global_risk=[data.get("global_risk", np.nan)],
+        )
+        data["weight"] = float(profile.weights(edge)[0])
+    return H
+
+
+def node_path(snapshot, path):
+    """OSM ids of the nodes of a path of node indices"""
+    return [int(snapshot.node_ids[i]) for i in path]
+
+
+def path_weight(G, path):
+    """Weight of a path in a graph weighted by profile_graph"""
+    return sum(
+        min(data["weight"] for data in G[u][v].values())
+        for u, v in zip(path[:-1], path[1:])
+    )
+
+
+@pytest.fixture(scope="session")
+def graph():
+    return synthetic_graph(GRID_SIZE, seed=0)
+
+
+@pytest.fixture(scope="session")
+def snapshot(graph):
+    return GraphSnapshot.from_graph(graph)
+
+
+@pytest.fixture(scope="session")
+def profiles():
+    return compile_profiles()
+
+
+@pytest.fixture(scope="session")
+def engine(snapshot, profiles):
+    return RouteEngine.from_snapshot(snapshot, profiles)
+
+
+@pytest.fixture(scope="session")
+def pairs(snapshot):
+    """Random (source, target) node indices"""
+    rng = np.random.default_rng(1)
+    return rng.integers(0, snapshot.n_nodes, (40, 2)).tolist()
+
+
+@pytest.fixture(scope="session")
+def profile_graphs(graph, profiles):
+    """name:graph weighted by the profile (see profile_graph)"""
+    return {name: profile_graph(graph, profile) for name, profile in profiles.items()}
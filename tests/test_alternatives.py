@@ -0,0 +1,29 @@
+from conftest import node_path, path_weight
+from utils.alternatives import alternative_routes
+from utils.route_engine import NoPathException
+
+
+def test_alternatives_start_with_the_best_route(
+    engine, profile_graphs, snapshot, pairs
+):
+    G = profile_graphs["safest_streets"]
+    for source, target in pairs[:10]:
+        try:
+            best = engine.shortest_path(source, target, "safest_streets")
+        except NoPathException:
+            continue
+        routes = alternative_routes(engine, source, target, "safest_streets", k=3)
+        assert routes[0] == best
+        best_weight = path_weight(G, node_path(snapshot, best))
+        kept = {(u, v) for u, v in zip(best, best[1:])}
+        for route in routes[1:]:
+            assert route[0] == source and route[-1] == target
+            assert len(set(route)) == len(route)
+            assert (
+                path_weight(G, node_path(snapshot, route)) <= 1.25 * best_weight + 1e-6
+            )
+            # At most half of its length on the routes kept before
+            lengths = snapshot.edge_length[engine.route_edges(route)]
+            shared = [(u, v) in kept for u, v in zip(route, route[1:])]
+            assert lengths[shared].sum() <= 0.5 * lengths.sum() + 1e-6
+            kept.update(zip(route, route[1:]))
@@ -0,0 +1,79 @@
+import multiprocessing
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.batch import read_od_pairs, route_od_file
+from utils.graph_snapshot import GraphSnapshot
+from utils.NYCRouteManager import NYCRouteManager
+
+
+@pytest.fixture(scope="module")
+def manager(graph, tmp_path_factory):
+    manager = NYCRouteManager(load=False)
+    manager.snapshot_dirpath = str(tmp_path_factory.mktemp("batch") / "snapshot")
+    manager.route_cache_filepath = None
+    GraphSnapshot.from_graph(graph).save(manager.snapshot_dirpath)
+    manager.load_snapshot()
+    return manager
+
+
+@pytest.fixture
+def od_filepath(snapshot, pairs, tmp_path):
+    # Two pairs from the same origin, searched with one tree
+    pairs = pairs[:10] + [(pairs[0][0], pairs[1][1])]
+    filepath = tmp_path / "pairs.csv"
+    pd.DataFrame(
+        {
+            "id": [f"p{i}" for i in range(len(pairs))],
+            "from_lat": [snapshot.node_y[u] for u, _ in pairs],
+            "from_lng": [snapshot.node_x[u] for u, _ in pairs],
+            "to_lat": [snapshot.node_y[v] for _, v in pairs],
+            "to_lng": [snapshot.node_x[v] for _, v in pairs],
+        }
+    ).to_csv(filepath, index=False)
+    return filepath
+
+
+def test_ids_are_row_numbers_without_id_column(tmp_path):
+    filepath = tmp_path / "pairs.csv"
+    pd.DataFrame(
+        np.zeros((5, 4)), columns=["from_lat", "from_lng", "to_lat", "to_lng"]
+    ).to_csv(filepath, index=False)
+    chunks = list(read_od_pairs(filepath, chunksize=2))
+    assert [chunk["id"].tolist() for chunk in chunks] == [[0, 1], [2, 3], [4]]
+
+
+def test_batch_routes_match_networkx(manager, profile_graphs, od_filepath, tmp_path):
+    output_filepath = tmp_path / "routes.csv"
+    assert route_od_file(manager, od_filepath, output_filepath, workers=1) == 11
+    routes = pd.read_csv(output_filepath).set_index("id")
+    G = profile_graphs["safest"]
+    for pair_id, route in routes.iterrows():
+        try:
+            expected = nx.dijkstra_path_length(
+                G, route["from_node"], route["to_node"], weight="weight"
+            )
+        except nx.NetworkXNoPath:
+            assert np.isnan(route["cost"]) and route["n_edges"] == 0
+            continue
+        assert route["cost"] == pytest.approx(expected)
+    assert sorted(routes.index) == sorted(f"p{i}" for i in range(11))
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_pool_gives_the_same_routes(manager, od_filepath, tmp_path):
+    route_od_file(manager, od_filepath, tmp_path / "one.csv", workers=1)
+    route_od_file(manager, od_filepath, tmp_path / "pool.csv", workers=2)
+    one = pd.read_csv(tmp_path / "one.csv").set_index("id").sort_index()
+    pool = pd.read_csv(tmp_path / "pool.csv").set_index("id").sort_index()
+    pd.testing.assert_frame_equal(one, pool)
+
+
+def test_unknown_route_type_is_rejected(manager, od_filepath, tmp_path):
+    with pytest.raises(ValueError):
+        route_od_file(manager, od_filepath, tmp_path / "routes.csv", profile="nope")
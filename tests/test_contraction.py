@@ -0,0 +1,59 @@
+import networkx as nx
+import pytest
+
+from utils.contraction import ContractionHierarchy, graph_digest, weights_digest
+from utils.graph_snapshot import GraphSnapshot
+from utils.route_engine import NoPathException, RouteEngine
+
+
+@pytest.fixture(scope="module")
+def hierarchy(engine):
+    return ContractionHierarchy.build(
+        engine.pair_indptr, engine.pair_target, engine.pair_weights["safest_streets"]
+    )
+
+
+def test_unpacked_paths_match_the_engine(engine, hierarchy, pairs):
+    weights = engine.pair_weights["safest_streets"]
+
+    def weight_of(path):
+        return sum(weights[engine.pair_index(u, v)] for u, v in zip(path, path[1:]))
+
+    for source, target in pairs:
+        try:
+            expected = engine.shortest_path(source, target, "safest_streets")
+        except NoPathException:
+            with pytest.raises(NoPathException):
+                hierarchy.shortest_path(source, target)
+            continue
+        path = hierarchy.shortest_path(source, target)
+        # Shortcuts unpacked to edges of the graph
+        assert path[0] == source and path[-1] == target
+        assert all(engine.pair_index(u, v) >= 0 for u, v in zip(path, path[1:]))
+        assert weight_of(path) == pytest.approx(weight_of(expected))
+
+
+def test_saved_hierarchy_keeps_its_digests(engine, hierarchy, tmp_path):
+    filepath = tmp_path / "ch.npz"
+    hierarchy.save(filepath)
+    loaded = ContractionHierarchy.load(filepath)
+    assert loaded.weights_digest == weights_digest(
+        engine.pair_weights["safest_streets"]
+    )
+    assert loaded.graph_digest == graph_digest(engine.pair_indptr, engine.pair_target)
+
+
+def test_reindexed_graph_has_another_digest(graph, snapshot, engine):
+    # Other node ids interleaved with the ones of the graph : same weights
+    # in the same order, on other node indices
+    ids = {node: 2 * i for i, node in enumerate(sorted(graph))}
+    others = nx.relabel_nodes(graph, {node: ids[node] + 1 for node in graph})
+    relabelled = GraphSnapshot.from_graph(nx.relabel_nodes(graph, ids))
+    table = GraphSnapshot.union_nodes([GraphSnapshot.from_graph(others), relabelled])
+    reindexed = RouteEngine.from_snapshot(relabelled.reindex(table))
+    assert weights_digest(reindexed.pair_weights["shortest"]) == weights_digest(
+        engine.pair_weights["shortest"]
+    )
+    assert graph_digest(reindexed.pair_indptr, reindexed.pair_target) != graph_digest(
+        engine.pair_indptr, engine.pair_target
+    )
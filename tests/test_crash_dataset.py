@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+from utils.crash_dataset import CATEGORY_COLUMNS, CrashDataset
+from utils.risk_builder import RAW_COLUMNS, crash_timestamps, read_crashes
+
+
+def raw_export(filepath):
+    """Raw NYPD export of 6 crashes, 2 of them dropped by the ingestion"""
+    df = pd.DataFrame(
+        {
+            "crash_date": [
+                "2020-12-03",
+                "2020-12-02",
+                "not a date",
+                "2021-01-04",
+                "2021-01-04",
+                "2020-11-30",
+            ],
+            "crash_time": ["13:37:00", "9:05", "12:00", "0:10", "23:59", "8:00"],
+            "borough": ["MANHATTAN", "QUEENS", "QUEENS", None, "MANHATTAN", "BRONX"],
+            "zip_code": [10025, 11001, None, None, 10025, 10451],
+            "latitude": [40.7985, 40.7311, 40.70, 40.75, 40.7986, 0],
+            "longitude": [-73.9671, -73.7099, -73.90, -73.95, -73.9672, 0],
+            "on_street_name": [
+                "West 103 Street",
+                "256 Street",
+                None,
+                "",
+                "Broadway",
+                "E 149 St",
+            ],
+            "off_street_name": [None, "87 Avenue", None, None, "West 103 Street", None],
+        }
+    )
+    for i, column in enumerate(RAW_COLUMNS):
+        df[column] = [(i + row) % 3 for row in range(len(df))]
+    for column in CATEGORY_COLUMNS:
+        if column not in df:
+            df[column] = ["Unspecified", None, "Taxi", None, "Unspecified", None]
+    df.to_csv(filepath, index=False)
+    return df
+
+
+def test_ingested_dataset_reads_as_the_raw_file(tmp_path):
+    csv_filepath = tmp_path / "raw.csv"
+    raw_export(csv_filepath)
+    dataset = CrashDataset.ingest(csv_filepath, tmp_path / "crashes", chunksize=2)
+    assert len(dataset) == 4 and dataset.meta["n_dropped"] == 1
+    assert dataset.meta["first_hour"] == 2020120209
+    assert dataset.meta["last_hour"] == 2021010423
+
+    raw = pd.concat(read_crashes(csv_filepath))
+    raw = raw[crash_timestamps(raw) >= 0]
+    crashes = pd.concat(read_crashes(tmp_path / "crashes", chunksize=3))
+    assert len(crashes) == len(raw)
+    np.testing.assert_allclose(crashes["latitude"], raw["latitude"])
+    np.testing.assert_array_equal(crash_timestamps(crashes), crash_timestamps(raw))
+    for column in RAW_COLUMNS.values():
+        np.testing.assert_array_equal(crashes[column], raw[column])
+    names = pd.concat(dataset.chunks(["on_street_name", "zip_code"]))
+    # The empty names are missing
+    assert names["on_street_name"].fillna("").tolist() == [
+        "West 103 Street",
+        "256 Street",
+        "",
+        "Broadway",
+    ]
+    # The streets share one vocabulary
+    assert set(dataset.categories("off_street_name")) <= set(
+        dataset.categories("on_street_name")
+    )
+    assert names["zip_code"].tolist() == [10025, 11001, 0, 10025]
+
+
+def test_dataset_is_replaced_by_a_new_ingestion(tmp_path):
+    csv_filepath = tmp_path / "raw.csv"
+    df = raw_export(csv_filepath)
+    CrashDataset.ingest(csv_filepath, tmp_path / "crashes")
+    df[:2].to_csv(csv_filepath, index=False)
+    assert len(CrashDataset.ingest(csv_filepath, tmp_path / "crashes")) == 2
+    assert len(CrashDataset.load(tmp_path / "crashes")) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["crashes", "raw.csv"]
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.crash_tiles import (
+    CELL_SIZE,
+    TILE_SIZE,
+    aggregate_crashes,
+    build_crash_tiles,
+    mercator_pixels,
+)
+
+
+def crashes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "latitude": rng.uniform(40.70, 40.80, n),
+            "longitude": rng.uniform(-74.00, -73.90, n),
+            "persons_injured": rng.integers(0, 3, n),
+            "persons_killed": np.zeros(n),
+        }
+    )
+
+
+def test_mercator_pixels():
+    x, y = mercator_pixels(np.array([0.0, 85.05112878]), np.array([0.0, -180.0]), 0)
+    np.testing.assert_allclose(x, [TILE_SIZE / 2, 0])
+    np.testing.assert_allclose(y, [TILE_SIZE / 2, 0], atol=1e-6)
+
+
+def test_chunks_are_summed_in_the_same_cells():
+    df = crashes(500)
+    whole = aggregate_crashes([df], zooms=[12, 15])
+    chunked = aggregate_crashes([df[:123], df[123:123], df[123:]], zooms=[12, 15])
+    for zoom in (12, 15):
+        keys, counts, severities = chunked[zoom]
+        np.testing.assert_array_equal(keys, whole[zoom][0])
+        np.testing.assert_array_equal(counts, whole[zoom][1])
+        np.testing.assert_allclose(severities, whole[zoom][2])
+        assert counts.sum() == 500
+        assert severities.sum() == pytest.approx(500 + 3 * df["persons_injured"].sum())
+    # Higher zoom, smaller cells
+    assert len(chunked[15][0]) > len(chunked[12][0])
+
+
+def test_tiles_of_the_crash_file_are_written(tmp_path):
+    pytest.importorskip("PIL")
+    crash_filepath = tmp_path / "crashes.csv"
+    crashes(200).to_csv(crash_filepath, index=False)
+    dirpath = tmp_path / "crash_tiles"
+    n_tiles = build_crash_tiles(crash_filepath, dirpath, zooms=[11, 12])
+    assert n_tiles == len(list(dirpath.glob("*/*/*.png"))) > 0
+
+    with open(dirpath / "index.json") as f:
+        index = json.load(f)
+    assert index["cell_size"] == CELL_SIZE
+    assert sorted(index["zooms"]) == ["11", "12"]
+    assert all(zoom["crashes"] == 200 for zoom in index["zooms"].values())
+    # Built again : the previous tiles are replaced
+    assert build_crash_tiles(crash_filepath, dirpath, zooms=[11]) > 0
+    assert sorted(p.name for p in dirpath.iterdir()) == ["11", "index.json"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["crash_tiles", "crashes.csv"]
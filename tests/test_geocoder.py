@@ -0,0 +1,89 @@
+import networkx as nx
+import pandas as pd
+import pytest
+
+from utils.geocoder import (
+    CachedGeocoder,
+    GeocoderChain,
+    LocalGeocoder,
+    StubGeocoder,
+    normalize,
+)
+
+
+@pytest.fixture(scope="module")
+def geocoder():
+    G = nx.MultiDiGraph()
+    for node, (x, y) in {1: (0, 0), 2: (1, 0), 3: (2, 0), 4: (2, 1)}.items():
+        G.add_node(node, x=x, y=y)
+    G.add_edge(1, 2, name="West 103rd Street")
+    G.add_edge(2, 3, name="West 103rd Street")
+    G.add_edge(3, 4, name=["Broadway", "Bway"])
+    crashes = pd.DataFrame(
+        {
+            "latitude": [10.0, 12.0, 20.0],
+            "longitude": [-5.0, -7.0, -30.0],
+            "on_street_name": ["W 103 ST", "W 103 ST", "Pearl St"],
+            "off_street_name": [None, None, "Broadway"],
+            "zip_code": [10025, 10025, 10038],
+        }
+    )
+    return LocalGeocoder.build(G, [crashes])
+
+
+def test_names_are_normalized():
+    assert normalize("W 103rd St.") == normalize("West 103 Street")
+    assert normalize("Fifth Ave") == "5 avenue"
+
+
+def test_exact_and_prefix_streets(geocoder):
+    # The node of the street nearest to its centroid
+    result = geocoder.geocode("West 103rd St, New York, NY")
+    assert (result.latitude, result.longitude) == (0, 1)
+    assert result.address == "West 103 Street, New York"
+    assert geocoder.geocode("west 103") == result
+    assert geocoder.suggest("w") == ["west 103 street"]
+    # A typo is matched, a house number isn't placed on its street
+    assert geocoder.resolve_street("braodway") == "broadway"
+    assert geocoder.geocode("2880 Broadway") is None
+    assert geocoder.geocode("Unknown Street") is None
+
+
+def test_intersections_and_zip_codes(geocoder):
+    for address in ("Broadway & W 103rd St", "west 103 street and broadway, nyc"):
+        result = geocoder.geocode(address)
+        assert (result.latitude, result.longitude) == (0, 2)
+    # Only known from the crashes
+    assert geocoder.geocode("Pearl St / Broadway") == (
+        20,
+        -30,
+        "Broadway & Pearl Street, New York",
+    )
+    # The crashes of the street in the zip code, then the zip code alone
+    result = geocoder.geocode("W 103 St 10025")
+    assert (result.latitude, result.longitude) == (11, -6)
+    assert geocoder.geocode("10038")[:2] == (20, -30)
+
+
+def test_saved_index_is_loaded(geocoder, tmp_path):
+    filepath = tmp_path / "geocoder.npz"
+    geocoder.save(filepath)
+    loaded = LocalGeocoder.load(filepath)
+    assert loaded.geocode("broadway & w 103 st") == geocoder.geocode(
+        "broadway & w 103 st"
+    )
+    assert LocalGeocoder.load(tmp_path / "missing.npz") is None
+
+
+def test_remote_results_are_cached(tmp_path):
+    stub = StubGeocoder({"Times Square": (40.758, -73.985)})
+    cached = CachedGeocoder(stub, tmp_path / "geocode.sqlite")
+    assert cached.geocode("times  square")[:2] == (40.758, -73.985)
+    assert cached.geocode("Nowhere") is None
+    # Answered by the cache, the unknown addresses too
+    stub.locations = {}
+    assert cached.geocode("TIMES SQUARE")[:2] == (40.758, -73.985)
+    assert cached.geocode("nowhere") is None
+
+    chain = GeocoderChain([StubGeocoder(), cached])
+    assert chain.geocode("times square")[:2] == (40.758, -73.985)
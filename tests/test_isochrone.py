@@ -0,0 +1,26 @@
+import networkx as nx
+import pytest
+
+from conftest import node_path
+from utils.isochrone import Isochrone
+
+
+@pytest.mark.parametrize(
+    "profile,cutoff", [("shortest", 800), ("safest_streets", 2000)]
+)
+def test_isochrone_costs_match_networkx(
+    snapshot, engine, profile_graphs, profile, cutoff
+):
+    G = profile_graphs[profile]
+    source = snapshot.n_nodes // 2
+    isochrone = Isochrone.search(snapshot, engine, {source: 0}, cutoff, weight=profile)
+    expected = nx.single_source_dijkstra_path_length(
+        G, int(snapshot.node_ids[source]), cutoff=cutoff, weight="weight"
+    )
+    costs = dict(zip(node_path(snapshot, isochrone.nodes), isochrone.cost.tolist()))
+    assert costs.keys() == expected.keys()
+    for node, cost in expected.items():
+        assert costs[node] == pytest.approx(cost)
+    # The length of the path to each node, along the lightest parallel edges
+    if profile == "shortest":
+        assert isochrone.length == pytest.approx(isochrone.cost)
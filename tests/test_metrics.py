@@ -0,0 +1,32 @@
+from utils.metrics import MetricsRegistry, span, stage_seconds
+
+
+def stage_series(stage):
+    return [dict(key) for key in stage_seconds.series if dict(key)["stage"] == stage]
+
+
+def test_stages_have_the_same_labels():
+    with span("snap"):
+        pass
+    with span("geometry", profile="safest") as labels:
+        labels["length"] = "short"
+    assert {"stage": "snap", "profile": "none", "length": "none"} in stage_series(
+        "snap"
+    )
+    assert {"stage": "geometry", "profile": "safest", "length": "short"} in (
+        stage_series("geometry")
+    )
+    assert {frozenset(labels) for labels in map(dict, stage_seconds.series)} == {
+        frozenset(("stage", "profile", "length"))
+    }
+
+
+def test_histogram_is_rendered_by_labels():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("seconds", "Duration", buckets=(0.1, 1))
+    histogram.observe(0.05, stage="snap")
+    histogram.observe(0.5, stage="snap")
+    lines = registry.render().splitlines()
+    assert 'seconds_bucket{stage="snap",le="0.1"} 1' in lines
+    assert 'seconds_bucket{stage="snap",le="+Inf"} 2' in lines
+    assert 'seconds_count{stage="snap"} 2' in lines
@@ -0,0 +1,71 @@
+import time
+
+from concurrent.futures import TimeoutError
+
+import pytest
+
+from utils import navigation
+from utils.navigation import (
+    DeadlineExceededException,
+    NavigationService,
+    OverloadedException,
+)
+
+
+class RouteManager:
+    """Route manager answering after a delay, or timing out"""
+
+    def __init__(self, seconds=0.0):
+        self.seconds = seconds
+        self.timeouts = []
+
+    def get_routes(self, point_from, point_to, route_types, timeout, **kwargs):
+        self.timeouts.append(timeout)
+        if self.seconds > timeout:
+            raise TimeoutError()
+        time.sleep(self.seconds)
+        return {route_type: [point_from, point_to] for route_type in route_types}
+
+
+def test_requests_in_excess_are_rejected():
+    service = NavigationService(RouteManager(), max_pending=2)
+    with service.admit(), service.admit():
+        with pytest.raises(OverloadedException):
+            with service.admit():
+                pass
+    # Admitted again once the requests are done
+    with service.admit() as deadline:
+        assert deadline > time.monotonic()
+
+
+def test_stages_are_bounded_by_the_request_deadline():
+    manager = RouteManager()
+    service = NavigationService(manager, route_timeout=10, request_timeout=0.5)
+    with service.admit() as deadline:
+        assert service.get_routes("a", "b", ["safest"], deadline) == {
+            "safest": ["a", "b"]
+        }
+    assert manager.timeouts[0] <= 0.5
+    # The deadline of the request has passed
+    with pytest.raises(DeadlineExceededException):
+        service.get_routes("a", "b", ["safest"], time.monotonic() - 1)
+
+    slow = NavigationService(RouteManager(seconds=5), route_timeout=0.1)
+    with slow.admit() as deadline:
+        with pytest.raises(DeadlineExceededException):
+            slow.get_routes("a", "b", ["safest"], deadline)
+
+
+def test_slow_geocoding_exceeds_its_deadline(monkeypatch):
+    def get_coordinates(address):
+        time.sleep(0.1 if address == "near" else 2)
+        return (40.7, -74.0)
+
+    monkeypatch.setattr(navigation, "get_coordinates", get_coordinates)
+    service = NavigationService(RouteManager(), geocode_timeout=0.5)
+    with service.admit() as deadline:
+        assert service.geocode("near", "near", deadline) == ((40.7, -74.0),) * 2
+        start = time.monotonic()
+        with pytest.raises(DeadlineExceededException):
+            service.geocode("near", "far", deadline)
+        assert time.monotonic() - start < 1
@@ -0,0 +1,64 @@
+from os import path
+
+import numpy as np
+
+from utils.benchmark import synthetic_graph
+from utils.graph_snapshot import GraphSnapshot
+from utils.networks import SharedNodes
+from utils.NYCRouteManager import NYCRouteManager
+from utils.risk_builder import load_risk_state, save_risk_state
+from utils.time_risk import TimeBucketRisk
+
+
+def save_networks(tmp_path):
+    """Snapshots of two networks with some nodes in common"""
+    G = synthetic_graph(6, seed=0)
+    H = G.subgraph(list(G.nodes)[: len(G) // 2]).copy()
+    dirpaths = []
+    for name, graph in (("drive", G), ("walk", H)):
+        dirpath = str(tmp_path / f"NYC_{name}_risk.snapshot")
+        GraphSnapshot.from_graph(graph).save(dirpath)
+        dirpaths.append(dirpath)
+    return dirpaths
+
+
+def test_node_table_is_built_once(tmp_path):
+    dirpaths = save_networks(tmp_path)
+    nodes_dirpath = tmp_path / "NYC_nodes.snapshot"
+    nodes = SharedNodes.prepare(nodes_dirpath, dirpaths)
+    assert nodes.n_nodes == GraphSnapshot.load(dirpaths[0]).n_nodes
+    # Loaded again as it is : all the nodes of the networks are in it
+    again = SharedNodes.prepare(nodes_dirpath, dirpaths)
+    assert again.snapshot.snapshot_id == nodes.snapshot.snapshot_id
+
+
+def test_shared_snapshot_keeps_its_risk_files(tmp_path):
+    dirpaths = save_networks(tmp_path)
+    nodes = SharedNodes.prepare(tmp_path / "NYC_nodes.snapshot", dirpaths)
+    manager = NYCRouteManager(load=False, nodes=nodes)
+    manager.snapshot_dirpath = dirpaths[1]
+    snapshot = GraphSnapshot.load(dirpaths[1])
+    risk = np.arange(snapshot.n_edges, dtype=float)
+    snapshot.write_risk(dirpaths[1], risk, 2 * risk)
+    severity = np.linspace(0, 1, snapshot.n_edges)
+    save_risk_state(dirpaths[1], severity, 42)
+    factors = np.ones((2, 168), dtype=np.float32)
+    TimeBucketRisk(np.array([0, 3]), factors).save(dirpaths[1])
+
+    shared = manager.share_nodes(GraphSnapshot.load(dirpaths[1]))
+    assert shared.node_ids is nodes.snapshot.node_ids
+    assert shared.n_edges == snapshot.n_edges
+    np.testing.assert_array_equal(shared.edge_risk, risk)
+    np.testing.assert_array_equal(shared.edge_global_risk, 2 * risk)
+    edge_severity, watermark, _ = load_risk_state(dirpaths[1])
+    assert watermark == 42
+    np.testing.assert_array_equal(edge_severity, severity)
+    time_risk = TimeBucketRisk.load(dirpaths[1])
+    np.testing.assert_array_equal(time_risk.edges, [0, 3])
+    # No temporary directory is left
+    assert not [p for p in tmp_path.iterdir() if p.name.endswith((".tmp", ".old"))]
+
+    # Already shared (by another process) : not saved again
+    snapshot_id = shared.snapshot_id
+    assert manager.share_nodes(shared).snapshot_id == snapshot_id
+    assert GraphSnapshot.load(dirpaths[1]).snapshot_id == snapshot_id
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from conftest import GRID_SIZE
+from utils.partition import PartitionedGraph
+from utils.route_engine import NoPathException
+
+
+@pytest.fixture(scope="module")
+def partitioned(snapshot, profiles):
+    # Four quadrants of the grid (the node ids are row * size + column + 1)
+    row, column = np.divmod(np.asarray(snapshot.node_ids) - 1, GRID_SIZE)
+    half = GRID_SIZE // 2
+    node_cell = (row >= half) * 2 + (column >= half)
+    return PartitionedGraph.build(
+        snapshot, node_cell, cell_names=("SW", "SE", "NW", "NE"), profiles=profiles
+    )
+
+
+@pytest.mark.parametrize("profile", ["shortest", "safest", "safest_streets"])
+def test_partitioned_routes_have_the_engine_weight(engine, partitioned, pairs, profile):
+    weights = engine.pair_weights[profile]
+
+    def weight_of(path):
+        pairs = [engine.pair_index(u, v) for u, v in zip(path, path[1:])]
+        assert all(pair >= 0 for pair in pairs)
+        return sum(weights[pair] for pair in pairs)
+
+    for source, target in pairs:
+        try:
+            expected = engine.shortest_path(source, target, profile)
+        except NoPathException:
+            with pytest.raises(NoPathException):
+                partitioned.shortest_path(source, target, profile)
+            continue
+        path = partitioned.shortest_path(source, target, profile)
+        assert path[0] == source and path[-1] == target
+        assert weight_of(path) == pytest.approx(weight_of(expected))
+
+
+def test_saved_partition_routes_the_same(snapshot, partitioned, pairs, tmp_path):
+    partitioned.save(tmp_path)
+    loaded = PartitionedGraph.load(snapshot, tmp_path)
+    assert loaded is not None
+    for source, target in pairs[:10]:
+        try:
+            expected = partitioned.shortest_path(source, target)
+        except NoPathException:
+            continue
+        assert loaded.shortest_path(source, target) == expected
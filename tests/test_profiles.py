@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from utils.profiles import Profile, ProfileException, band
+
+
+def test_band():
+    values = np.array([0, 2.9, 3, 6.9, 7, 100])
+    assert band(values, [3, 7], [500, 250, 1]).tolist() == [500, 500, 250, 250, 1, 1]
+    with pytest.raises(ProfileException):
+        band(values, [3, 7], [500, 1])
+    with pytest.raises(ProfileException):
+        band(values, [7, 3], [500, 250, 1])
+
+
+@pytest.mark.parametrize(
+    "weight",
+    [
+        "length +",
+        "__import__('os')",
+        "length.real",
+        "speed * length",
+        "open('x')",
+        "'length'",
+        "[x for x in length]",
+    ],
+)
+def test_invalid_expressions_are_rejected(weight):
+    with pytest.raises(ProfileException):
+        Profile("test", weight)
+
+
+def test_weights_are_evaluated_per_edge(snapshot):
+    profile = Profile(
+        "test", "length * (global_risk + 1) + risk", fill={"global_risk": 0}
+    )
+    length = np.asarray(snapshot.edge_length)
+    global_risk = np.asarray(snapshot.edge_global_risk)
+    expected = length * (global_risk + 1) + np.asarray(snapshot.edge_risk)
+    assert profile.weights(snapshot) == pytest.approx(expected)
+    # A global risk given instead of the one of the snapshot
+    assert profile.weights(snapshot, global_risk=global_risk * 0) == pytest.approx(
+        length + np.asarray(snapshot.edge_risk)
+    )
+
+
+def test_negative_weights_are_rejected(snapshot):
+    with pytest.raises(ProfileException):
+        Profile("test", "length - 1000").weights(snapshot)
+
+
+def test_time_variables(snapshot):
+    profile = Profile("night", "length * where((hour >= 22) | (hour < 6), 2, 1)")
+    assert profile.uses_time
+    length = np.asarray(snapshot.edge_length)
+    # Tuesday 23h, then Tuesday noon
+    assert profile.weights(snapshot, bucket=1 * 24 + 23) == pytest.approx(2 * length)
+    assert profile.weights(snapshot, bucket=1 * 24 + 12) == pytest.approx(length)
@@ -0,0 +1,144 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.graph_snapshot import GraphSnapshot
+from utils.NYCRouteManager import NYCRouteManager, set_risk_to_graph
+from utils.risk_builder import (
+    accumulate_since,
+    crash_severity,
+    crash_timestamps,
+    network_severity,
+    read_crashes,
+)
+from utils.spatial_index import SpatialIndex
+
+
+def crashes(snapshot, rows):
+    """Crashes (preprocessed columns) on nodes : (node, YYYYMMDDHH, injured)"""
+    return pd.DataFrame(
+        {
+            "latitude": [snapshot.node_y[node] for node, _, _ in rows],
+            "longitude": [snapshot.node_x[node] for node, _, _ in rows],
+            "year": [stamp // 1000000 for _, stamp, _ in rows],
+            "month": [stamp // 10000 % 100 for _, stamp, _ in rows],
+            "day": [stamp // 100 % 100 for _, stamp, _ in rows],
+            "hour": [stamp % 100 for _, stamp, _ in rows],
+            "persons_injured": [injured for _, _, injured in rows],
+        }
+    )
+
+
+@pytest.fixture(scope="module")
+def spatial_index(snapshot):
+    return SpatialIndex.build(snapshot)
+
+
+def test_severity_of_the_network_users():
+    df = pd.DataFrame({"persons_injured": [0, 2, np.nan], "persons_killed": [0, 1, 0]})
+    assert crash_severity(df).tolist() == [1, 1 + 6 + 20, 1]
+    df["pedestrians_injured"] = [0, 1, 0]
+    assert network_severity("walk")(df).tolist() == [0, 3, 0]
+
+
+def test_raw_columns_are_renamed(tmp_path):
+    filepath = tmp_path / "raw.csv"
+    pd.DataFrame(
+        {
+            "latitude": [40.75, np.nan, 0],
+            "longitude": [-73.98, -73.98, 0],
+            "number_of_persons_injured": [2, 0, 0],
+            "borough": ["MANHATTAN"] * 3,
+        }
+    ).to_csv(filepath, index=False)
+    # The rows without coordinates are dropped
+    (chunk,) = read_crashes(filepath)
+    assert chunk.columns.tolist() == ["latitude", "longitude", "persons_injured"]
+    assert chunk["persons_injured"].tolist() == [2]
+
+
+def test_crashes_are_snapped_on_their_street(tmp_path):
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for node, x in ((1, -73.980), (2, -73.979), (3, -73.978)):
+        G.add_node(node, x=x, y=40.75)
+    G.add_edge(1, 2, length=84.0)
+    G.add_edge(2, 1, length=84.0)
+    G.add_edge(2, 3, length=84.0)
+    filepath = tmp_path / "crashes.csv"
+    pd.DataFrame(
+        {
+            # Near the street 1-2, then too far from the streets
+            "latitude": [40.7501, 40.76],
+            "longitude": [-73.9795, -73.9795],
+            "persons_injured": [1, 5],
+        }
+    ).to_csv(filepath, index=False)
+    set_risk_to_graph(G, filepath)
+    # Both directions of the street share its risk
+    assert G.edges[1, 2, 0]["risk"] == G.edges[2, 1, 0]["risk"] == 4
+    assert G.edges[1, 2, 0]["global_risk"] == pytest.approx(4 * 100 / 84)
+    assert G.edges[2, 3, 0]["risk"] == 0
+
+
+def test_invalid_crash_times_are_coerced():
+    raw = pd.DataFrame(
+        {
+            "crash_date": ["12/03/2020", "12/03/2020", "not a date", "12/03/2020"],
+            "crash_time": ["0:05", "13:37:00", "12:00", None],
+        }
+    )
+    assert crash_timestamps(raw).tolist() == [2020120300, 2020120313, -1, -1]
+    preprocessed = pd.DataFrame(
+        {"year": [2020, 2020], "month": [12, 2], "day": [3, 30], "hour": [np.nan, 8]}
+    )
+    assert crash_timestamps(preprocessed).tolist() == [-1, -1]
+
+
+def test_crashes_added_to_the_watermark_hour_are_ingested(snapshot, spatial_index):
+    first = [(0, 2020120312, 0), (1, 2020120313, 0), (2, 2020120313, 1)]
+    total, watermark, seen = accumulate_since(
+        snapshot, spatial_index, [crashes(snapshot, first)]
+    )
+    assert watermark == 2020120313 and len(seen) == 2
+    assert total.sum() == 1 + 1 + 4
+
+    # A late crash of the watermark hour, a late one of an older hour (not
+    # ingested) and a new one
+    later = first + [(3, 2020120313, 0), (4, 2020120301, 0), (5, 2020120402, 1)]
+    total, watermark, seen = accumulate_since(
+        snapshot,
+        spatial_index,
+        [crashes(snapshot, later)],
+        since=watermark,
+        seen=seen,
+    )
+    assert total.sum() == 1 + 4
+    assert watermark == 2020120402 and len(seen) == 1
+
+    total, again, same = accumulate_since(
+        snapshot, spatial_index, [crashes(snapshot, later)], since=watermark, seen=seen
+    )
+    assert not total.any() and again == watermark and same == seen
+
+
+def test_risk_version_is_only_bumped_by_new_crashes(tmp_path, graph):
+    manager = NYCRouteManager(load=False)
+    manager.snapshot_dirpath = str(tmp_path / "NYC_drive_risk.snapshot")
+    manager.route_cache_filepath = None
+    snapshot = GraphSnapshot.from_graph(graph)
+    snapshot.save(manager.snapshot_dirpath)
+    manager.load_snapshot()
+    crash_filepath = tmp_path / "crashes.csv"
+    rows = [(0, 2020120312, 1), (7, 2020120313, 0)]
+    crashes(snapshot, rows).to_csv(crash_filepath, index=False)
+
+    assert manager.update_risk(crash_filepath) == 2020120313
+    assert manager.snapshot.risk_version == 1
+    assert manager.update_risk(crash_filepath) == 2020120313
+    assert GraphSnapshot.load(manager.snapshot_dirpath).risk_version == 1
+
+    rows.append((9, 2020120313, 2))
+    crashes(snapshot, rows).to_csv(crash_filepath, index=False)
+    manager.update_risk(crash_filepath)
+    assert GraphSnapshot.load(manager.snapshot_dirpath).risk_version == 2
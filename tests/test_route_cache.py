@@ -0,0 +1,79 @@
+from utils.route_cache import RouteCache
+
+
+def route(n, start=0):
+    return list(range(start, start + n))
+
+
+def test_least_recently_used_routes_are_evicted_by_nodes():
+    cache = RouteCache(max_nodes=10)
+    cache.put(("a",), route(4))
+    cache.put(("b",), route(4))
+    assert cache.get(("a",)) == route(4)
+    # "b" is the least recently used : evicted to fit 4 more nodes
+    cache.put(("c",), route(4))
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) == route(4) and cache.get(("c",)) == route(4)
+    assert cache.n_nodes == 8
+    # A route larger than the cache isn't cached
+    cache.put(("d",), route(11))
+    assert cache.get(("d",)) is None and len(cache) == 2
+    assert cache.stats() == {"hits": 3, "misses": 2, "routes": 2, "nodes": 8}
+
+
+def test_saved_routes_are_loaded_with_the_same_version(tmp_path):
+    filepath = tmp_path / "routes.json"
+    cache = RouteCache()
+    key = ((1, 2, 0.5), 3, "safest", None, 7)
+    cache.put(key, route(5))
+    cache.save(filepath, version="v1")
+
+    loaded = RouteCache()
+    assert loaded.load(filepath, version="v1") == 1
+    assert loaded.get(key) == route(5)
+    assert RouteCache().load(filepath, version="v2") == 0
+
+
+def test_processes_add_their_routes_to_the_file(tmp_path):
+    filepath = tmp_path / "routes.json"
+    first, second, master = RouteCache(), RouteCache(), RouteCache()
+    first.put(("a",), route(3))
+    second.put(("b",), route(3))
+    first.save(filepath, version="v1")
+    second.save(filepath, version="v1")
+    # Without new routes, nothing is written
+    master.save(filepath, version="v1")
+
+    loaded = RouteCache()
+    assert loaded.load(filepath, version="v1") == 2
+    assert loaded.get(("a",)) == route(3) and loaded.get(("b",)) == route(3)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "routes.json",
+        "routes.json.lock",
+    ]
+
+
+def test_merged_file_keeps_the_last_saved_routes(tmp_path):
+    filepath = tmp_path / "routes.json"
+    old, new = RouteCache(max_nodes=6), RouteCache(max_nodes=6)
+    old.put(("a",), route(3))
+    old.put(("b",), route(3))
+    old.save(filepath)
+    new.put(("c",), route(3))
+    new.save(filepath)
+
+    loaded = RouteCache(max_nodes=6)
+    assert loaded.load(filepath) == 2
+    assert loaded.get(("a",)) is None
+    assert loaded.get(("b",)) == route(3) and loaded.get(("c",)) == route(3)
+
+
+def test_unreadable_file_is_an_empty_cache(tmp_path):
+    filepath = tmp_path / "routes.json"
+    filepath.write_text('{"version": "v1", "routes": [[["a"], [1, 2')
+    cache = RouteCache()
+    assert cache.load(filepath, version="v1") == 0
+    # Written again by the next save
+    cache.put(("a",), route(2))
+    cache.save(filepath, version="v1")
+    assert RouteCache().load(filepath, version="v1") == 1
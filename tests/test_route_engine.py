@@ -0,0 +1,65 @@
+import networkx as nx
+import pytest
+
+from conftest import node_path, path_weight
+from utils.route_engine import NoPathException
+
+
+@pytest.mark.parametrize(
+    "profile", ["shortest", "safest", "safest_streets", "dangerous"]
+)
+def test_dijkstra_matches_networkx(snapshot, engine, profile_graphs, pairs, profile):
+    G = profile_graphs[profile]
+    for source, target in pairs:
+        u, v = int(snapshot.node_ids[source]), int(snapshot.node_ids[target])
+        try:
+            expected = nx.dijkstra_path(G, u, v, weight="weight")
+        except nx.NetworkXNoPath:
+            with pytest.raises(NoPathException):
+                engine.shortest_path(source, target, profile)
+            continue
+        path = engine.shortest_path(source, target, profile)
+        assert node_path(snapshot, path) == expected
+
+
+def test_astar_is_as_short_as_dijkstra(snapshot, engine, profile_graphs, pairs):
+    G = profile_graphs["shortest"]
+    for source, target in pairs:
+        try:
+            expected = engine.shortest_path(source, target, "shortest")
+        except NoPathException:
+            continue
+        path = engine.shortest_path(source, target, "shortest", heuristic=True)
+        assert path[0] == source and path[-1] == target
+        assert path_weight(G, node_path(snapshot, path)) == pytest.approx(
+            path_weight(G, node_path(snapshot, expected))
+        )
+
+
+def test_tree_paths_match_shortest_paths(engine, pairs):
+    source = pairs[0][0]
+    tree = engine.shortest_path_tree({source: 0}, weight="safest_streets")
+    for _, target in pairs:
+        if target not in tree.dist:
+            continue
+        assert engine.tree_path(tree, target) == engine.shortest_path(
+            source, target, "safest_streets"
+        )
+    # The reverse tree gives the paths to its source
+    reverse = engine.shortest_path_tree(
+        {source: 0}, weight="safest_streets", reverse=True
+    )
+    for _, start in pairs:
+        if start in reverse.dist:
+            path = engine.tree_path(reverse, start)
+            assert path[0] == start and path[-1] == source
+
+
+def test_route_edges_follow_the_lightest_parallel_edge(snapshot, engine, graph, pairs):
+    source, target = pairs[1]
+    path = engine.shortest_path(source, target, "shortest")
+    edges = engine.route_edges(path)
+    nodes = node_path(snapshot, path)
+    for u, v, edge in zip(nodes[:-1], nodes[1:], edges):
+        lengths = [data["length"] for data in graph[u][v].values()]
+        assert snapshot.edge_length[edge] == min(lengths)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from utils.polyline import decode_polyline, encode_polyline
+from utils.route_engine import NoPathException
+from utils.route_geometry import RouteGeometry
+
+
+@pytest.fixture(scope="module")
+def geometries(snapshot, engine, pairs):
+    geometries = []
+    for source, target in pairs[:10]:
+        try:
+            path = engine.shortest_path(source, target, "safest_streets")
+        except NoPathException:
+            continue
+        if len(path) > 1:
+            route = [int(snapshot.node_ids[i]) for i in path]
+            geometries.append(RouteGeometry.from_route(snapshot, engine, route))
+    return geometries
+
+
+def test_polyline_round_trip():
+    rng = np.random.default_rng(3)
+    coords = np.column_stack(
+        (rng.uniform(-74.3, -73.7, 50), rng.uniform(40.5, 40.9, 50))
+    ).round(5)
+    assert decode_polyline(encode_polyline(coords)) == pytest.approx(coords)
+    # The example of the format documentation
+    example = [(-120.2, 38.5), (-120.95, 40.7), (-126.453, 43.252)]
+    assert encode_polyline(example) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+def test_line_follows_the_lightest_parallel_edges(graph, geometries):
+    for geometry in geometries:
+        expected = []
+        for u, v in zip(geometry.nodes[:-1], geometry.nodes[1:]):
+            data = min(graph[u][v].values(), key=lambda data: data["length"])
+            if "geometry" in data:
+                coords = list(data["geometry"].coords)
+            else:
+                coords = [(graph.nodes[n]["x"], graph.nodes[n]["y"]) for n in (u, v)]
+            expected.extend(coords if not expected else coords[1:])
+        assert geometry.line_coords() == pytest.approx(np.array(expected))
+
+
+def test_json_segments_cover_the_line(geometries):
+    for geometry in geometries:
+        data = geometry.to_json()
+        coords = decode_polyline(data["polyline"])
+        assert coords == pytest.approx(geometry.line_coords(), abs=1e-5)
+        assert data["length"] == pytest.approx(geometry.length, abs=0.1)
+
+        segments = data["segments"]
+        assert segments[0][0] == 0 and segments[-1][1] == len(coords) - 1
+        for previous, segment in zip(segments[:-1], segments[1:]):
+            # Runs joined on a point, of different classes
+            assert segment[0] == previous[1]
+            assert segment[2] != previous[2]
+        # Each edge is in the run of its class
+        classes = geometry.risk_classes()
+        runs = np.repeat(
+            [segment[2] for segment in segments],
+            np.diff(np.flatnonzero(np.diff(classes, prepend=-1, append=-1) != 0)),
+        )
+        assert runs.tolist() == classes.tolist()
@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from utils.NYCRouteManager import NYCRouteManager
+from utils.route_pool import RoutePool
+
+pytestmark = pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def pid():
+    return os.getpid()
+
+
+def kill_process():
+    os._exit(1)
+
+
+def new_pool(workers=2):
+    return RoutePool(
+        ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+    )
+
+
+@pytest.fixture
+def manager():
+    manager = NYCRouteManager(load=False)
+    manager.route_workers = 2
+    yield manager
+    manager.shutdown_route_pool()
+
+
+def test_retired_pool_ends_its_other_tasks_first():
+    pool = new_pool()
+    stuck = pool.submit(sleep, 60)
+    other = pool.submit(sleep, 0.5)
+    time.sleep(0.1)
+    pool.abandon(stuck)
+    assert pool.retired and not pool.terminated
+    assert other.result(timeout=10) == 0.5
+    # Only the abandoned task was left : its processes are terminated
+    assert pool.terminated
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(sleep, 0).result(timeout=10)
+
+
+def test_timeout_retires_the_pool_without_breaking_the_other_tasks(manager):
+    pool = manager.get_route_pool()
+    other = pool.submit(sleep, 1)
+    with pytest.raises(TimeoutError):
+        manager.pool_result(pool, sleep, (60,), 0.2)
+    # The next requests get a new pool, the task of the other request ends
+    assert manager.get_route_pool() is not pool
+    assert other.result(timeout=10) == 1
+    assert pool.terminated
+
+
+def test_broken_pool_task_is_submitted_again(manager):
+    pool = manager.get_route_pool()
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(kill_process).result(timeout=10)
+    # A task failing with the dead process runs once again in a new pool
+    assert manager.pool_result(pool, pid, (), 10) != os.getpid()
+    assert manager.get_route_pool() is not pool
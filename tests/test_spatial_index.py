@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from utils.spatial_index import SpatialIndex, great_circle
+
+
+@pytest.fixture(scope="module")
+def spatial_index(snapshot):
+    return SpatialIndex.build(snapshot)
+
+
+@pytest.fixture(scope="module")
+def points(snapshot):
+    """Random points around the graph, some of them outside of it"""
+    rng = np.random.default_rng(2)
+    lat = np.asarray(snapshot.node_y)
+    lng = np.asarray(snapshot.node_x)
+    lats = rng.uniform(lat.min() - 0.005, lat.max() + 0.005, 300)
+    lngs = rng.uniform(lng.min() - 0.005, lng.max() + 0.005, 300)
+    return lats, lngs
+
+
+def test_nearest_nodes_match_brute_force(snapshot, spatial_index, points):
+    lats, lngs = points
+    nodes, dists = spatial_index.nearest_nodes(lats, lngs, return_dist=True)
+    expected = great_circle(
+        lats[:, None],
+        lngs[:, None],
+        np.asarray(snapshot.node_y)[None],
+        np.asarray(snapshot.node_x)[None],
+    )
+    assert dists == pytest.approx(expected.min(axis=1))
+    assert (nodes == expected.argmin(axis=1)).all()
+
+
+def test_snap_edges_match_brute_force(snapshot, spatial_index, points):
+    lats, lngs = points
+    edges, fractions, dists = spatial_index.snap_edges(lats, lngs, batch_size=64)
+    # Distance to all the segments of the geometries
+    segments = np.flatnonzero(spatial_index.segment_length > 0)
+    pxs, pys = spatial_index.project(lats, lngs)
+    for i in range(len(lats)):
+        d, _ = spatial_index._segment_distances(segments, pxs[i], pys[i])
+        assert dists[i] == pytest.approx(d.min())
+    assert ((fractions >= 0) & (fractions <= 1)).all()
+    # The snapped position is at the snapped distance of the point
+    for i in range(len(lats)):
+        xs, ys = snapshot.edge_coords(edges[i])
+        px, py = spatial_index.project(np.asarray(ys), np.asarray(xs))
+        seg = np.hypot(np.diff(px), np.diff(py))
+        position = fractions[i] * seg.sum()
+        k = min(np.searchsorted(np.cumsum(seg), position), len(seg) - 1)
+        t = (position - np.cumsum(seg)[k] + seg[k]) / seg[k]
+        x = px[k] + t * (px[k + 1] - px[k])
+        y = py[k] + t * (py[k + 1] - py[k])
+        assert np.hypot(x - pxs[i], y - pys[i]) == pytest.approx(dists[i], abs=1e-3)
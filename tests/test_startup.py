@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+from utils.startup import Startup
+
+
+def test_started_services_are_ready_once_loaded():
+    loading = threading.Event()
+
+    def loader(startup):
+        with startup.stage("graph"):
+            loading.wait(10)
+
+    startup = Startup()
+    startup.start(loader)
+    assert not startup.wait(0.05) and not startup.ready
+    loading.set()
+    assert startup.wait(10)
+    status = startup.status()
+    assert status["ready"] and status["error"] is None
+    assert list(status["stages"]) == ["graph"] and status["ready_after"] > 0
+
+
+# The exception of the loader is raised again in the loading thread
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_wait_returns_when_the_loading_fails():
+    def loader(startup):
+        with startup.stage("graph"):
+            raise OSError("missing snapshot")
+
+    startup = Startup()
+    thread = startup.start(loader)
+    # Not ready, without waiting for the timeout
+    assert startup.wait(10) is False
+    thread.join(10)
+    assert isinstance(startup.error, OSError)
+    status = startup.status()
+    assert not status["ready"] and "missing snapshot" in status["error"]
+    assert "graph" in status["stages"]
+
+    with pytest.raises(OSError):
+        Startup().load(loader)
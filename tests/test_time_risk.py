@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.NYCRouteManager import NYCRouteManager
+from utils.profiles import compile_profiles
+from utils.risk_builder import crash_buckets
+from utils.route_engine import RouteEngine
+from utils.time_risk import N_BUCKETS, TimeBucketRisk, time_bucket
+
+
+def test_time_bucket():
+    # 2021-01-04 is a Monday
+    assert time_bucket(datetime(2021, 1, 4, 0, 30)) == 0
+    assert time_bucket(datetime(2021, 1, 6, 13, 0)) == 2 * 24 + 13
+    assert time_bucket(datetime(2021, 1, 10, 23, 59)) == N_BUCKETS - 1
+
+
+def test_crash_buckets_of_the_raw_export():
+    crashes = pd.DataFrame(
+        {
+            "crash_date": ["01/04/2021", "01/06/2021", "01/10/2021", "not a date"],
+            "crash_time": ["0:05", "13:37", "23:59:00", "12:00"],
+        }
+    )
+    assert crash_buckets(crashes).tolist() == [0, 2 * 24 + 13, N_BUCKETS - 1, -1]
+
+
+def test_crash_buckets_of_the_preprocessed_files():
+    # The day_of_week column holds the day of the month : the weekday is
+    # taken from the date
+    crashes = pd.DataFrame(
+        {
+            "year": [2021, 2021, 2021, 2021],
+            "month": [1, 1, 2, 1],
+            "day": [4, 6, 30, 10],
+            "hour": [0, 13, 8, 24],
+            "day_of_week": [4, 6, 30, 10],
+        }
+    )
+    assert crash_buckets(crashes).tolist() == [0, 2 * 24 + 13, -1, -1]
+    # Without a date, the day_of_week column is used
+    crashes = pd.DataFrame({"day_of_week": [0, 6, 9, np.nan], "hour": [1, 2, 3, 4]})
+    assert crash_buckets(crashes).tolist() == [1, 6 * 24 + 2, -1, -1]
+
+
+@pytest.fixture
+def manager(snapshot):
+    manager = NYCRouteManager(load=False)
+    manager.profiles = compile_profiles(
+        {"timed": "length * time_factor", "shortest": "length"}
+    )
+    manager.snapshot = snapshot
+    manager._engine = RouteEngine.from_snapshot(snapshot, manager.profiles)
+    rng = np.random.default_rng(4)
+    edges = np.arange(0, snapshot.n_edges, 3)
+    factors = rng.uniform(0.5, 2, (len(edges), N_BUCKETS)).astype(np.float32)
+    manager.time_risk = TimeBucketRisk(edges, factors)
+    manager._time_buckets, manager._time_weights = OrderedDict(), {}
+    return manager
+
+
+def departures(n):
+    # Monday 2021-01-04, one departure per hour
+    return [datetime(2021, 1, 4, hour) for hour in range(n)]
+
+
+def test_time_weights_follow_the_factors(manager, snapshot):
+    with manager.time_profile("timed", departures(3)[2]) as name:
+        factors = manager.time_risk.edge_factors(snapshot.n_edges, 2)
+        expected = RouteEngine(snapshot)
+        expected.set_weights("timed", np.asarray(snapshot.edge_length) * factors)
+        assert manager.engine.pair_weights[name] == pytest.approx(
+            expected.pair_weights["timed"]
+        )
+    with manager.time_profile("shortest", departures(3)[2]) as name:
+        assert name == "shortest"
+
+
+def test_weights_used_by_a_search_are_kept(manager):
+    first, *others = departures(manager.max_time_buckets + 2)
+    with manager.time_profile("timed", first) as name:
+        # The other buckets evict the first one, still used by the search
+        for departure in others:
+            with manager.time_profile("timed", departure):
+                pass
+        assert time_bucket(first) not in manager._time_buckets
+        assert manager.engine.has_weights(name)
+        # The risk changed : the search goes on with its weights
+        manager.clear_time_buckets()
+        assert manager.engine.has_weights(name)
+        with manager.time_profile("timed", first) as new_name:
+            assert new_name != name
+    assert not manager.engine.has_weights(name)
+    assert manager.engine.has_weights(new_name)
+    assert len(manager._time_weights) == len(manager._time_buckets) == 1
+
+
+def test_saved_factors_replace_the_previous_ones(manager, tmp_path):
+    manager.time_risk.save(tmp_path)
+    other = TimeBucketRisk(np.arange(5), np.ones((5, N_BUCKETS), dtype=np.float32))
+    other.save(tmp_path)
+    loaded = TimeBucketRisk.load(tmp_path)
+    assert loaded.edges.tolist() == list(range(5))
+    assert (loaded.factors == 1).all()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "time_risk_edges.npy",
+        "time_risk_factors.npy",
+    ]
@@ -1,17 +1,144 @@
-from flask import Flask, request, render_template
+from flask import Flask, Response, g, request, render_template, jsonify
+from markupsafe import escape
 from utils.coordinates import (
-    get_coordinates,
     LocationUnknownException,
     LocationNotInNyException,
+    get_geocoder,
 )
-from utils.NYCMapManager import NYCMapManager
-from utils.NYCRouteManager import NYCRouteManager
+from utils.route_engine import NoPathException
+from utils.navigation import (
+    NavigationService,
+    OverloadedException,
+    DeadlineExceededException,
+)
+from utils.metrics import metrics, span
+from utils.profiler import PROFILES_DIRPATH, SlowRequestProfiler
+from utils.startup import Startup
+from datetime import datetime
+import atexit
 import os
-
+import time
 
 app = Flask(__name__, template_folder=".")
-route_manager = NYCRouteManager()
-map_manager = NYCMapManager()
+# The script and the style of the pages are cached by the browser
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 12 * 3600
+# Created by load_services : the managers of the networks (see
+# NETWORK_TYPES) and the manager of the default network
+route_managers = None
+route_manager = None
+map_manager = None
+navigation = None
+# Loading state of the services, see /ready
+startup = Startup()
+# Endpoints answered while the services are loading
+STARTUP_ENDPOINTS = ("hello", "map_page", "metrics_page", "health", "ready", "static")
+# Maximum number of alternative routes of each type of /api/routes
+MAX_ALTERNATIVES = 3
+# Maximum cutoff of /api/isochrone by weight : 20 km, or the global risk of
+# about 20 km of streets of average risk
+MAX_ISOCHRONE_CUTOFFS = {"length": 20000, "global_risk": 1000}
+# Maximum number of areas (cutoffs) of /api/isochrone
+MAX_ISOCHRONE_AREAS = 5
+# Metrics of the requests, see /metrics
+request_seconds = metrics.histogram(
+    "http_request_seconds", "Duration of the requests by endpoint"
+)
+requests_total = metrics.counter(
+    "http_requests_total", "Number of requests by endpoint, status and outcome"
+)
+# Opt-in : profiles of the requests slower than PROFILE_SLOW_REQUESTS seconds
+profiler = None
+if os.environ.get("PROFILE_SLOW_REQUESTS"):
+    profiler = SlowRequestProfiler(
+        float(os.environ["PROFILE_SLOW_REQUESTS"]),
+        os.environ.get("PROFILES_DIRPATH", PROFILES_DIRPATH),
+    )
+
+
+def load_services(startup):
+    """
+    Import the managers (osmnx, folium, pandas, ...), map the graph and
+    create the services of the requests, timing each stage.
+    """
+    global route_managers, route_manager, map_manager, navigation
+
+    with startup.stage("import_route_manager"):
+        from utils.networks import NetworkRouteManagers
+    with startup.stage("import_map_manager"):
+        from utils.NYCMapManager import NYCMapManager
+    with startup.stage("route_manager"):
+        # Networks of the `mode` of the requests, the first one by default
+        managers = NetworkRouteManagers(
+            os.environ.get("NETWORK_TYPES", "drive").split(","),
+            # Opt-in : routes searched in the borough cells of the graph
+            partitioned=bool(os.environ.get("PARTITIONED_ROUTES")),
+        )
+    for name, seconds in managers.load_seconds.items():
+        startup.timings[f"route_manager.{name}"] = seconds
+    for manager in managers.managers.values():
+        # Number of processes computing the routes, see gunicorn.conf.py
+        if os.environ.get("ROUTE_WORKERS"):
+            manager.route_workers = int(os.environ["ROUTE_WORKERS"])
+    map_manager = NYCMapManager()
+    with startup.stage("geocoder"):
+        # The offline index of the streets, before the first requests
+        get_geocoder()
+    # Concurrent geocoding, deadlines and rejection of the requests in excess
+    navigation = NavigationService(managers)
+    # Keep the computed routes for the next start
+    atexit.register(managers.save_route_cache)
+    if os.environ.get("LAZY_STARTUP"):
+        # Not preloaded by gunicorn (see post_fork) : forked before the
+        # services are ready, while the server only answers STARTUP_ENDPOINTS
+        with startup.stage("route_pools"):
+            managers.start_route_pools()
+    route_managers = managers
+    route_manager = managers.default
+
+
+# LAZY_STARTUP=1 : the graph is loaded in the background, the server answers
+# at once (/health) and is ready once the graph is mapped (/ready)
+if os.environ.get("LAZY_STARTUP"):
+    startup.start(load_services)
+else:
+    startup.load(load_services)
+
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    if profiler is not None:
+        g.profile = profiler.start()
+    if not startup.ready and request.endpoint not in STARTUP_ENDPOINTS:
+        g.outcome = "starting"
+        msg = "The server is starting, please try again"
+        headers = {"Retry-After": "5"}
+        if request.endpoint == "login":
+            page = render_template("default.html", title="Navigation : Error", data=msg)
+            return page, 503, headers
+        return jsonify(error=msg), 503, headers
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unknown"
+    request_seconds.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    requests_total.inc(
+        endpoint=endpoint,
+        status=response.status_code,
+        outcome=g.get("outcome", "ok"),
+    )
+    if profiler is not None and "profile" in g:
+        profiler.finish(g.pop("profile"), endpoint)
+    return response
+
+
+@app.context_processor
+def network_modes():
+    """Networks offered by the forms of the pages, the default one first"""
+    if route_managers is None:
+        return {"modes": ()}
+    return {"modes": route_managers.network_types}
 
 
 @app.route("/")
@@ -20,6 +147,37 @@ def hello():
     return render_template("default.html", title="Home")
 
 
+@app.route("/map")
+def map_page():
+    """Display the map page, the routes are loaded from /api/routes"""
+    return render_template("map.html")
+
+
+def parse_departure_time(value):
+    """Returns the datetime of a datetime-local input or None"""
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M")
+
+
+def parse_mode(value):
+    """
+    Returns the network type of a `mode` parameter, None (the default
+    network) if it is empty.
+
+    Raises
+    ------
+    ValueError
+        If the network is not hosted, see NETWORK_TYPES.
+    """
+    if not value:
+        return None
+    # The message is rendered in the pages : the input isn't echoed
+    if value not in route_managers:
+        raise ValueError("Unknown mode")
+    return value
+
+
 @app.route("/navigate", methods=["POST"])
 def login():
     """Get the coordinates from adrress"""
@@ -28,29 +186,259 @@ def login():
     to_address = request.form["to_address"]
     route_types = ["safest"]
     route_types.extend(request.form.getlist("type"))
+    # Optional, the risk is then the one of the hour and day of the week
+    try:
+        departure_time = parse_departure_time(request.form.get("departure_time"))
+    except ValueError:
+        g.outcome = "invalid"
+        msg = "Invalid departure time"
+        return (
+            render_template("default.html", title="Navigation : Error", data=msg),
+            400,
+        )
+    # Optional, the network (drive, bike or walk) and the risk of its users
+    try:
+        mode = parse_mode(request.form.get("mode"))
+    except ValueError as err:
+        g.outcome = "invalid"
+        return (
+            render_template("default.html", title="Navigation : Error", data=str(err)),
+            400,
+        )
 
     try:
-        start_location = get_coordinates(from_address)
-        end_location = get_coordinates(to_address)
+        with navigation.admit() as deadline:
+            start_location, end_location = navigation.geocode(
+                from_address, to_address, deadline
+            )
 
-        routes = route_manager.get_routes(start_location, end_location, route_types)
-        data = map_manager.get_map(from_address, to_address, routes=routes)
+            routes = navigation.get_routes(
+                start_location,
+                end_location,
+                route_types,
+                deadline,
+                departure_time=departure_time,
+                mode=mode,
+            )
+            with span("render"):
+                data = map_manager.get_map(from_address, to_address, routes=routes)
 
         return render_template("default.html", title="Navigation", data=data)
         # return render_template("default.html", title="Navigation", start_location=start_location, end_location=end_location)
     except LocationUnknownException:
+        g.outcome = "unknown_address"
         return render_template(
             "default.html", title="Navigation : Error", data="Unknown address"
         )
     except LocationNotInNyException:
+        g.outcome = "not_in_ny"
         return render_template(
             "default.html", title="Navigation : Error", data="Address not in New York"
         )
+    except OverloadedException:
+        g.outcome = "overloaded"
+        msg = "The server is busy, please try again"
+        return (
+            render_template("default.html", title="Navigation : Error", data=msg),
+            503,
+        )
+    except DeadlineExceededException:
+        g.outcome = "deadline"
+        msg = "The search took too long, please try again"
+        return (
+            render_template("default.html", title="Navigation : Error", data=msg),
+            504,
+        )
     except Exception as err:
-        msg = f"Error : {err}"
+        g.outcome = "error"
+        app.logger.exception("Navigation from %r to %r", from_address, to_address)
+        # The page is rendered unescaped (the map) : the message may hold
+        # the input of the request
+        msg = f"Error : {escape(str(err))}"
         return render_template("default.html", title="Navigation : Error", data=msg)
 
 
+@app.route("/api/routes", methods=["GET", "POST"])
+def api_routes():
+    """
+    Returns the routes between two addresses as JSON, with the same
+    parameters as /navigate (from_address, to_address, type, departure_time,
+    mode) :
+        {"from": [lat, lng], "to": [lat, lng], "routes": {type: route}}
+    See RouteGeometry.to_json for the description of a route.
+
+    With `alternatives` (1 to MAX_ALTERNATIVES), up to that number of other
+    routes of each type are added as {"alternatives": {type: [route]}}.
+    """
+    from_address = request.values.get("from_address", "")
+    to_address = request.values.get("to_address", "")
+    route_types = ["safest"]
+    route_types.extend(request.values.getlist("type"))
+
+    try:
+        departure_time = parse_departure_time(request.values.get("departure_time"))
+    except ValueError:
+        g.outcome = "invalid"
+        return jsonify(error="Invalid departure time"), 400
+    try:
+        mode = parse_mode(request.values.get("mode"))
+    except ValueError as err:
+        g.outcome = "invalid"
+        return jsonify(error=str(err)), 400
+    n_alternatives = request.values.get("alternatives", 0, type=int)
+    if not 0 <= n_alternatives <= MAX_ALTERNATIVES:
+        g.outcome = "invalid"
+        return jsonify(error=f"At most {MAX_ALTERNATIVES} alternatives"), 400
+    alternatives = {}
+    try:
+        with navigation.admit() as deadline:
+            start_location, end_location = navigation.geocode(
+                from_address, to_address, deadline
+            )
+            routes = navigation.get_routes(
+                start_location,
+                end_location,
+                route_types,
+                deadline,
+                departure_time=departure_time,
+                mode=mode,
+            )
+            if n_alternatives:
+                for route_type in routes:
+                    alternatives[route_type] = [
+                        route.to_json()
+                        for route in navigation.get_alternative_routes(
+                            start_location,
+                            end_location,
+                            route_type,
+                            deadline,
+                            k=n_alternatives + 1,
+                            departure_time=departure_time,
+                            mode=mode,
+                        )[1:]
+                    ]
+    except LocationUnknownException:
+        g.outcome = "unknown_address"
+        return jsonify(error="Unknown address"), 404
+    except LocationNotInNyException:
+        g.outcome = "not_in_ny"
+        return jsonify(error="Address not in New York"), 404
+    except NoPathException:
+        g.outcome = "no_route"
+        return jsonify(error="No route between the addresses"), 404
+    except OverloadedException:
+        g.outcome = "overloaded"
+        return jsonify(error="The server is busy, please try again"), 503
+    except DeadlineExceededException:
+        g.outcome = "deadline"
+        return jsonify(error="The search took too long, please try again"), 504
+    except Exception as err:
+        g.outcome = "error"
+        app.logger.exception("Routes from %r to %r", from_address, to_address)
+        return jsonify(error=f"Error : {err}"), 500
+
+    return jsonify(
+        {
+            "from": start_location,
+            "to": end_location,
+            "routes": {
+                route_type: route.to_json() for route_type, route in routes.items()
+            },
+            "alternatives": alternatives,
+        }
+    )
+
+
+@app.route("/api/isochrone")
+def api_isochrone():
+    """
+    Returns the areas reachable from a point as a GeoJSON FeatureCollection,
+    see Isochrone.to_geojson. Parameters :
+        - lat, lng : the starting point
+        - cutoff : maximum weight of the paths, repeated for several areas
+          (at most MAX_ISOCHRONE_AREAS, from 0 to MAX_ISOCHRONE_CUTOFFS)
+        - weight : "length" (cutoffs in meters, default) or "global_risk"
+        - mode : network of the paths (see NETWORK_TYPES), default : the
+          first network
+    """
+    try:
+        point = (float(request.args["lat"]), float(request.args["lng"]))
+        cutoffs = [float(cutoff) for cutoff in request.args.getlist("cutoff")]
+    except (KeyError, ValueError):
+        g.outcome = "invalid"
+        return jsonify(error="lat, lng and cutoff are needed"), 400
+    if not cutoffs:
+        g.outcome = "invalid"
+        return jsonify(error="lat, lng and cutoff are needed"), 400
+    weight = request.args.get("weight", "length")
+    if weight not in MAX_ISOCHRONE_CUTOFFS:
+        g.outcome = "invalid"
+        return jsonify(error="weight must be length or global_risk"), 400
+    if len(cutoffs) > MAX_ISOCHRONE_AREAS:
+        g.outcome = "invalid"
+        return jsonify(error=f"At most {MAX_ISOCHRONE_AREAS} cutoffs"), 400
+    # NaN and infinite cutoffs are not in the range
+    max_cutoff = MAX_ISOCHRONE_CUTOFFS[weight]
+    if not all(0 <= cutoff <= max_cutoff for cutoff in cutoffs):
+        g.outcome = "invalid"
+        return jsonify(error=f"The cutoffs must be from 0 to {max_cutoff}"), 400
+    try:
+        mode = parse_mode(request.args.get("mode"))
+    except ValueError as err:
+        g.outcome = "invalid"
+        return jsonify(error=str(err)), 400
+
+    try:
+        with navigation.admit() as deadline:
+            geojson = navigation.get_isochrone(
+                point, cutoffs, deadline, weight=weight, mode=mode
+            )
+    except OverloadedException:
+        g.outcome = "overloaded"
+        return jsonify(error="The server is busy, please try again"), 503
+    except DeadlineExceededException:
+        g.outcome = "deadline"
+        return jsonify(error="The search took too long, please try again"), 504
+    except ValueError as err:
+        g.outcome = "invalid"
+        return jsonify(error=str(err)), 400
+    except Exception as err:
+        g.outcome = "error"
+        app.logger.exception("Isochrone from %r", point)
+        return jsonify(error=f"Error : {err}"), 500
+    return jsonify(geojson)
+
+
+@app.route("/health")
+def health():
+    """Liveness : the server answers, the services may still be loading"""
+    return jsonify(status="ok")
+
+
+@app.route("/ready")
+def ready():
+    """
+    Readiness : 200 once the graph is mapped and the services are created,
+    503 before (or if the loading failed). Returns the loading state, with
+    the seconds of each loading stage, see Startup.status.
+    """
+    return jsonify(startup.status()), 200 if startup.ready else 503
+
+
+@app.route("/metrics")
+def metrics_page():
+    """
+    Returns the metrics in the Prometheus text format : the duration of the
+    requests and of their stages (geocode, snap, search, geometry, render),
+    the length and number of nodes of the routes.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    if startup.ready:
+        # Forked before the threads of the server start
+        route_managers.start_route_pools()
+    # One thread per request, the searches run in the route pool
+    app.run(host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,104 @@
+// Map of the routes returned by /api/routes (see RouteGeometry.to_json)
+
+var ROUTE_COLORS = {
+    shortest: "blue",
+    safest: "green",
+    dangerous: "red",
+    safest_streets: "orange",
+    other: "yellow"
+};
+// Colours of the risk classes 0 to 3 (see RISK_BANDS)
+var RISK_COLORS = ["#00FF00", "#FFFF00", "#FF8C00", "#FF4500"];
+
+var map = L.map("map").setView([40.677834, -74.012443], 10);
+L.tileLayer("https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png", {
+    attribution: "&copy; OpenStreetMap contributors"
+}).addTo(map);
+var routeLayers = L.layerGroup().addTo(map);
+// Crash tiles rendered offline (see utils/crash_tiles.py), hidden by default
+var crashLayer = L.tileLayer("/static/crash_tiles/{z}/{x}/{y}.png", {
+    minZoom: 10,
+    maxNativeZoom: 16,
+    attribution: "NYPD Motor Vehicle Collisions"
+});
+var layerControl = L.control.layers(null, {crashes: crashLayer}, {collapsed: false}).addTo(map);
+var routeOverlays = [];
+
+// Decode a polyline of utils/polyline.py into [lat, lng] points
+function decodePolyline(text) {
+    var points = [], lat = 0, lng = 0, index = 0;
+    while (index < text.length) {
+        var deltas = [];
+        for (var i = 0; i < 2; i++) {
+            var value = 0, shift = 0, byte;
+            do {
+                byte = text.charCodeAt(index++) - 63;
+                value |= (byte & 0x1f) << shift;
+                shift += 5;
+            } while (byte >= 0x20);
+            deltas.push(value & 1 ? ~(value >> 1) : value >> 1);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        points.push([lat / 1e5, lng / 1e5]);
+    }
+    return points;
+}
+
+function showRoutes(data) {
+    routeLayers.clearLayers();
+    routeOverlays.forEach(function (layer) {
+        layerControl.removeLayer(layer);
+        map.removeLayer(layer);
+    });
+    routeOverlays = [];
+
+    var bounds = L.latLngBounds([data.from, data.to]);
+    L.marker(data.from, {title: "From"}).addTo(routeLayers);
+    L.marker(data.to, {title: "To"}).addTo(routeLayers);
+
+    Object.keys(data.routes).forEach(function (routeType) {
+        var route = data.routes[routeType];
+        var points = decodePolyline(route.polyline);
+        var color = ROUTE_COLORS[routeType] || ROUTE_COLORS.other;
+        var lengthKm = (route.length / 1000).toFixed(3);
+
+        var line = L.polyline(points, {weight: 5, color: color, opacity: 0.7});
+        routeLayers.addLayer(line);
+        layerControl.addOverlay(line, routeType + " (" + lengthKm + " km) (" + color + ")");
+
+        var riskView = L.layerGroup(route.segments.map(function (segment) {
+            return L.polyline(points.slice(segment[0], segment[1] + 1), {
+                weight: 5, color: RISK_COLORS[segment[2]], opacity: 1
+            });
+        }));
+        layerControl.addOverlay(riskView, routeType + " (" + lengthKm + " km) (risk view)");
+        routeOverlays.push(line, riskView);
+
+        if (points.length) {
+            bounds.extend(line.getBounds());
+        }
+    });
+    map.fitBounds(bounds);
+}
+
+document.getElementById("navigate").addEventListener("submit", function (event) {
+    event.preventDefault();
+    var message = document.getElementById("message");
+    message.textContent = "Searching...";
+    fetch("/api/routes", {method: "POST", body: new FormData(event.target)})
+        .then(function (response) {
+            return response.json();
+        })
+        .then(function (data) {
+            if (data.error) {
+                message.textContent = data.error;
+                return;
+            }
+            message.textContent = "";
+            showRoutes(data);
+        })
+        .catch(function (err) {
+            message.textContent = "Error : " + err;
+        });
+});
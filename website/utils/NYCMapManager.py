@@ -1,8 +1,8 @@
 import folium
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from folium import plugins
+import numpy as np
+from os import path
+
+from utils.crash_tiles import CRASH_TILES_DIRPATH, ZOOMS
 
 
 class NYCMapManager:
@@ -10,6 +10,9 @@ class NYCMapManager:
     longitude = -74.012443
     crashes_filepath = "data/NYC_crashes_100000_osmid.csv"
     layer_crashes = None
+    # Crash tiles rendered offline (see utils/crash_tiles.py) and their URL
+    crash_tiles_dirpath = CRASH_TILES_DIRPATH
+    crash_tiles_url = "/static/crash_tiles/{z}/{x}/{y}.png"
     default_colors = {
         "shortest": "blue",
         "safest": "green",
@@ -17,6 +20,9 @@ class NYCMapManager:
         "safest_streets": "orange",
         "other": "yellow",
     }
+    # Colours of the risk classes 0 to 3 of the risk view, see
+    # RouteGeometry.risk_classes (same colours as static/map.js)
+    risk_colors = ("#00FF00", "#FFFF00", "#FF8C00", "#FF4500")
 
     range_of_colour = {
         10: "#FF4500",
@@ -75,35 +81,55 @@ class NYCMapManager:
     #                                 fill_opacity=0.7,
     #                                 fill=True).add_to(marker_cluster)
 
+    def get_crashes_layer(self):
+        """
+        Returns the layer of the crash tiles (hidden by default), None if
+        the tiles have not been rendered.
+        """
+        if not path.isfile(path.join(self.crash_tiles_dirpath, "index.json")):
+            return None
+        return folium.TileLayer(
+            tiles=self.crash_tiles_url,
+            attr="NYPD Motor Vehicle Collisions",
+            name="crashes",
+            overlay=True,
+            show=False,
+            min_zoom=min(ZOOMS),
+            max_native_zoom=max(ZOOMS),
+        )
+
     def get_map(
         self, from_address: str, to_address: str, routes=None, use_gradient=True
     ):
         """Return the html code to display map
 
         Args:
-            from_coord (tuple): location coordinates (latitude, longitude)
-            to_coord (tuple): location coordinates (latitude, longitude)
+            from_address (str): address of the starting point
+            to_address (str): address of the destination point
+            routes (dict or RouteGeometry): route_type:RouteGeometry or a
+                single route (see NYCRouteManager.get_routes)
 
         Returns:
             map_nyc._repr_html_(): the map in html format
         """
         map_nyc = folium.Map(location=[self.latitude, self.longitude], zoom_start=10)
         # self.layer_crashes.add_to(map_nyc)
+        layer_crashes = self.get_crashes_layer()
+        if layer_crashes is not None:
+            layer_crashes.add_to(map_nyc)
         marker_added = False
         if routes is not None:
 
             if type(routes) is dict:
+                bounds = []
                 for key in routes:
                     route = routes[key]
+                    if not len(route):
+                        continue
+                    # The coordinates of RouteGeometry are (lng, lat)
                     if not marker_added:
-                        from_point = [
-                            route.iloc[0]["geometry"].xy[1][0],
-                            route.iloc[0]["geometry"].xy[0][0],
-                        ]
-                        to_point = [
-                            route.iloc[-1]["geometry"].xy[1][-1],
-                            route.iloc[-1]["geometry"].xy[0][-1],
-                        ]
+                        from_point = route.coords[0][::-1].tolist()
+                        to_point = route.coords[-1][::-1].tolist()
 
                         folium.Marker(
                             from_point,
@@ -115,57 +141,56 @@ class NYCMapManager:
                             tooltip="To : " + to_address,
                             icon=folium.Icon(color="red"),
                         ).add_to(map_nyc)
+                        marker_added = True
 
-                    length_km = round((route["length"].sum() / 1000), 3)
+                    length_km = round((route.length / 1000), 3)
 
                     if use_gradient:  # Draw the path with gradient
-                        # Transform the risk on a range from 0-10
-                        # route["global_risk"] = round((route["global_risk"]/route["global_risk"].max())*10)
-                        # for path_part, risk in zip(route["geometry"], route["global_risk"]):
-                        #    choropleth = folium.Choropleth(path_part,line_weight=5, line_color=self.range_of_colour[risk], line_opacity=1)
-                        #    layer_group.add_child(choropleth)
                         layer_group = folium.FeatureGroup(
                             name=f"{key} ({length_km} km) (risk view)", show=False
                         ).add_to(map_nyc)
 
-                        def get_colour(feature):
-                            """Maps low values to green and hugh values to red."""
-                            if feature == 0:
-                                return "#00FF00"
-                            elif feature < 3:
-                                return "#FFFF00"
-                            elif feature < 7:
-                                return "#FF8C00"
-                            else:
-                                return "#FF4500"
-
-                        for path_part, risk in zip(
-                            route["geometry"], route["global_risk"]
-                        ):
-                            choropleth = folium.Choropleth(
-                                path_part,
-                                line_weight=5,
-                                line_color=get_colour(risk),
-                                line_opacity=1,
-                            )
-                            layer_group.add_child(choropleth)
-
-                    color = self.default_colors[key]
+                        # One multi-line per risk class, made of the runs of
+                        # consecutive edges of that class
+                        line = route.line_coords()[:, ::-1].tolist()
+                        firsts, lasts, classes = route.risk_runs()
+                        for risk_class in np.unique(classes).tolist():
+                            runs = np.flatnonzero(classes == risk_class).tolist()
+                            folium.PolyLine(
+                                [line[firsts[i] : lasts[i] + 1] for i in runs],
+                                weight=5,
+                                color=self.risk_colors[risk_class],
+                                opacity=1,
+                            ).add_to(layer_group)
+
+                    color = self.default_colors.get(key, self.default_colors["other"])
                     layer_group = folium.FeatureGroup(
                         name=f"{key} ({length_km} km) ({color})"
                     ).add_to(map_nyc)
-                    choropleth = folium.Choropleth(
-                        route, line_weight=5, line_color=color, line_opacity=0.7
+                    folium.PolyLine(
+                        route.line_coords()[:, ::-1].tolist(),
+                        weight=5,
+                        color=color,
+                        opacity=0.7,
+                    ).add_to(layer_group)
+
+                    bounds.append(route.bounds)
+                if bounds:
+                    tb = np.array(bounds)
+                    map_nyc.fit_bounds(
+                        [
+                            (tb[:, 1].min(), tb[:, 0].min()),
+                            (tb[:, 3].max(), tb[:, 2].max()),
+                        ]
                     )
-                    layer_group.add_child(choropleth)
-
-                    tb = route.total_bounds
-                map_nyc.fit_bounds([(tb[1], tb[0]), (tb[3], tb[2])])
-            else:
-                folium.Choropleth(
-                    routes, line_weight=5, line_color="blue", line_opacity=1
+            elif len(routes):
+                folium.PolyLine(
+                    routes.line_coords()[:, ::-1].tolist(),
+                    weight=5,
+                    color="blue",
+                    opacity=1,
                 ).add_to(map_nyc)
-                tb = routes.total_bounds
+                tb = routes.bounds
                 map_nyc.fit_bounds([(tb[1], tb[0]), (tb[3], tb[2])])
             folium.LayerControl().add_to(map_nyc)
         # folium.Marker([G.nodes[origin_node]['y'], G.nodes[origin_node]['x']],
@@ -1,8 +1,115 @@
-import osmnx as ox
-import networkx as nx
-
+import multiprocessing
+import threading
+import time
+import numpy as np
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
 from os import path
 
+from utils.graph_snapshot import GraphSnapshot
+from utils.profiles import (
+    PROFILES,
+    Profile,
+    ProfileException,
+    compile_profiles,
+    profile_weights,
+    profiles_digest,
+    read_profiles,
+)
+from utils.route_engine import RouteEngine, NoPathException
+from utils.partition import BOROUGH_COLUMNS, PartitionedGraph, node_cells
+from utils.contraction import ContractionHierarchy, graph_digest, weights_digest
+from utils.spatial_index import SpatialIndex, EdgeSnap
+from utils.route_cache import RouteCache
+from utils.file_lock import file_lock
+from utils.route_pool import RoutePool
+from utils.route_geometry import RouteGeometry
+from utils.isochrone import Isochrone
+from utils.metrics import (
+    length_band,
+    observe_route,
+    span,
+    stage_labels,
+    stage_seconds,
+)
+from utils.startup import timed
+from utils.alternatives import alternative_routes, MAX_OVERLAP, MAX_STRETCH
+from utils.time_risk import TimeBucketRisk, time_bucket
+from utils.risk_builder import (
+    accumulate_since,
+    compute_edge_risk,
+    crash_severity,
+    global_risk_of,
+    load_risk_state,
+    network_severity,
+    read_crashes,
+    risk_state_files,
+    save_risk_state,
+    street_risk,
+)
+
+# NOTE :
+# osmnx and networkx are imported by the functions using them : the routes
+# only use the snapshot arrays, and this module (so the website) starts
+# faster without them.
+
+# id:manager of the route pools, inherited by their processes when forked
+_pool_managers = {}
+
+
+def _init_pool_process(manager_id):
+    """
+    Initialize a process of the route pool of a manager : its locks were
+    held by the thread forking it (see NYCRouteManager.get_route_pool),
+    which doesn't exist in the process.
+    """
+    manager = _pool_managers[manager_id]
+    manager._route_pool_lock = threading.Lock()
+    manager._snapshot_lock = threading.Lock()
+    manager._engine_lock = threading.Lock()
+    manager._time_buckets_lock = threading.Lock()
+    manager._reset_time_pins()
+    if manager.partition is not None:
+        manager.partition._cells_lock = threading.Lock()
+
+
+def _start_pool_process():
+    """Task starting the processes of the route pool, see get_route_pool"""
+
+
+def _compute_pool_route(manager_id, node_from, node_to, profile, departure_time=None):
+    """
+    Compute a route in a process of the route pool of a manager, returns
+    the route and the duration (in seconds) of the search.
+    """
+    start = time.perf_counter()
+    route = _pool_managers[manager_id]._compute_route(
+        node_from, node_to, weight=profile, departure_time=departure_time
+    )
+    return route, time.perf_counter() - start
+
+
+def _compute_pool_alternatives(manager_id, source, target, profile, **kwargs):
+    """
+    Compute alternative routes in a process of the route pool of a manager,
+    see NYCRouteManager._compute_alternatives.
+    """
+    return _pool_managers[manager_id]._compute_alternatives(
+        source, target, profile, **kwargs
+    )
+
+
+def _compute_pool_isochrone(manager_id, point, cutoffs, weight="length"):
+    """
+    Compute the GeoJSON of an isochrone in a process of the route pool of a
+    manager, see NYCRouteManager.get_isochrone_geojson.
+    """
+    manager = _pool_managers[manager_id]
+    return manager.get_isochrone(point, max(cutoffs), weight).to_geojson(cutoffs)
+
 
 def download_osm(query="New York City, New York, USA", network_type="drive"):
     """
@@ -33,6 +140,8 @@ def download_osm(query="New York City, New York, USA", network_type="drive"):
     -------
     G : networkx.MultiDiGraph
     """
+    import osmnx as ox
+
     return ox.graph_from_place(query, network_type=network_type)
 
 
@@ -52,6 +161,8 @@ def save_osm(G, filepath):
     -------
     None
     """
+    import osmnx as ox
+
     ox.save_graphml(G, filepath=filepath)
 
 
@@ -80,6 +191,7 @@ def load_osm(
     # Use specific_dtypes to convert risk to float to avoid error as
     #   TypeError: unsupported operand type(s) for +: 'int' and 'str'
     # during the route computing on the risk attributes
+    import osmnx as ox
 
     G = ox.load_graphml(
         filepath=filepath, node_dtypes=specific_dtypes, edge_dtypes=specific_dtypes
@@ -87,9 +199,13 @@ def load_osm(
     return G
 
 
-def set_risk_to_graph(G, risk_path):
+def set_risk_to_graph(G, risk_path, severity=crash_severity):
     """
-    Append risk attributes to the nodes and the edges of a graph.
+    Append risk attributes to the edges of a graph.
+
+    Each crash is snapped on its nearest edge (see risk_builder) :
+        - risk : sum of the severity of the crashes of the street
+        - global_risk : risk per 100 meters of street
 
     Parameters
     ----------
@@ -97,15 +213,31 @@ def set_risk_to_graph(G, risk_path):
         input graph
     risk_path : string or pathlib.Path
         path to the DataFrame with the crash information file including ext.
+    severity : function
+        returns the severity of each crash of a DataFrame, see
+        risk_builder.network_severity
 
     Returns
     -------
     G : networkx.MultiDiGraph
     """
-    # TODO use DF crashes to computes the risk
-    nodes_proj, edges_proj = ox.graph_to_gdfs(G, nodes=True, edges=True)
-    edges_proj["risk"] = edges_proj["length"] % 1
-    G = ox.graph_from_gdfs(nodes_proj, edges_proj)
+    # Snap the crashes on the edges with the arrays of the graph
+    snapshot = GraphSnapshot.from_graph(G)
+    risk, global_risk = compute_edge_risk(
+        snapshot, SpatialIndex.build(snapshot), risk_path, severity=severity
+    )
+    edge_sources = snapshot.node_ids[snapshot.edge_source].tolist()
+    edge_targets = snapshot.node_ids[snapshot.edge_target].tolist()
+    for u, v, k, edge_risk, edge_global_risk in zip(
+        edge_sources,
+        edge_targets,
+        snapshot.edge_key.tolist(),
+        risk.tolist(),
+        global_risk.tolist(),
+    ):
+        data = G.edges[u, v, k]
+        data["risk"] = edge_risk
+        data["global_risk"] = edge_global_risk
     return G
 
 
@@ -120,15 +252,93 @@ class NYCRouteManager:
         - the more dangerous
     """
 
+    # Street network of OSM (see download_osm), its files are named after it
+    # in data_dirpath (see set_network_type)
+    network_type = "drive"
+    data_dirpath = "data"
+    # Node table and its spatial index shared with the managers of the other
+    # networks (see networks.SharedNodes), None if not shared
+    nodes = None
     # OSM files
     osm_filepath = "data/NYC_drive.osm"
     osm_risk_filepath = "data/NYC_drive_risk.osm"
+    # Memory-mappable arrays built from osm_risk_filepath
+    snapshot_dirpath = "data/NYC_drive_risk.snapshot"
     # Crashes statistics data
-    crash_weight_filepath = "data/NYC_crashes.csv"
-    # Map networkx including risk
-    G_risk = None
-
-    def __init__(self, reload_data=False):
+    crash_weight_filepath = "data/data_10000_out_final.csv"
+    # Map networkx including risk (loaded on demand, see G_risk)
+    _G_risk = None
+    # Arrays of the map including risk
+    snapshot = None
+    # Held while the snapshot or its risk is checked and mapped again
+    _snapshot_lock = threading.Lock()
+    # Shortest path engine on the snapshot arrays (see engine)
+    _engine = None
+    _engine_lock = threading.Lock()
+    # If True, the routes are searched in the borough cells of partition
+    # and the engine of the whole graph is only built when needed
+    partitioned = False
+    # Cells and overlay of the graph, saved in partition_dirpath
+    partition = None
+    partition_dirpath = "data/NYC_drive_risk.cells"
+    # Maximum number of cell engines kept by each process
+    partition_max_cells = 2
+    # profile:ContractionHierarchy used instead of the engine searches
+    hierarchies = {}
+    # Grid index of the nodes and edges, saved with the snapshot
+    spatial_index = None
+    # If True, the routes start and end on the nearest edge of the points
+    # instead of their nearest node (no detour on long blocks)
+    snap_to_edges = False
+    # Route types accepted by get_routes (names of the engine profiles)
+    route_types = ("safest", "shortest", "dangerous", "safest_streets")
+    # name:Profile of the engine, compiled from PROFILES and profiles_filepath
+    profiles = None
+    # JSON file of profile definitions (name:definition) added to or
+    # replacing PROFILES, read again when it changes (see refresh_profiles)
+    profiles_filepath = "data/route_profiles.json"
+    _profiles_mtime = None
+    # Error of the last profiles file read by refresh_profiles, if invalid
+    profiles_error = None
+    # Number of processes computing the routes of get_routes concurrently
+    route_workers = 4
+    _route_pool = None
+    _route_pool_lock = threading.Lock()
+    # Edge attributes used as weight and the matching engine profile
+    weight_profiles = {"length": "shortest", "global_risk": "safest"}
+    # Profiles searched with A* (only admissible on lengths, so only used
+    # while their weight is the length)
+    astar_profiles = ("shortest",)
+    # Profiles with a Contraction Hierarchy, saved next to osm_risk_filepath
+    hierarchy_profiles = ("shortest", "safest", "safest_streets", "dangerous")
+    # Hour by day of week factors of the risk, saved with the snapshot
+    time_risk = None
+    # Number of time buckets whose weights are kept in the engine
+    max_time_buckets = 4
+    # bucket:key of its weights (see time_profile), the last used last
+    _time_buckets = None
+    # key:[names of the engine weights, number of searches using them]
+    _time_weights = None
+    # Increased when the weights of the buckets are cleared
+    _time_generation = 0
+    _time_buckets_lock = threading.Lock()
+    # Cache of the computed routes (see route_key)
+    route_cache = None
+    # Maximum total number of nodes of the cached routes
+    route_cache_max_nodes = 2000000
+    # File where the route cache is kept between restarts, None to disable
+    route_cache_filepath = "data/NYC_drive_risk.routes.json"
+    # stage:duration in seconds of the last load_snapshot
+    load_seconds = {}
+
+    def __init__(
+        self,
+        reload_data=False,
+        partitioned=False,
+        network_type=None,
+        nodes=None,
+        load=True,
+    ):
         """
         Initialize the NYCRouteManager
 
@@ -139,12 +349,65 @@ class NYCRouteManager:
             will be be reloaded
             Otherwhise, it will try load the saved Graph or create it if the
             OSM file is missing.
+        partitioned : boolean
+            If True, route in the borough cells of the graph (see
+            load_partition) instead of the engine of the whole graph
+        network_type : string
+            network of OSM ("drive", "bike", "walk", ...), its files are
+            `{data_dirpath}/NYC_{network_type}*`, default : the drive files
+        nodes : SharedNodes
+            node table shared with the managers of other networks
+        load : boolean
+            If False, the graph is loaded later (see load_risk_graph)
+        """
+        self.partitioned = partitioned
+        if network_type is not None:
+            self.set_network_type(network_type)
+        self.nodes = nodes
+        self.profiles = self.read_profiles()
+        self.route_types = self.profile_route_types(self.profiles)
+        if load:
+            self.load_risk_graph(reload_data)
+
+    @property
+    def engine(self):
+        """
+        Shortest path engine of the whole graph, built on the first use
+        when the manager is partitioned (time profiles, edge snapping,
+        isochrones, alternatives).
+        """
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    self._engine = RouteEngine.from_snapshot(
+                        self.snapshot, self.profiles
+                    )
+        return self._engine
+
+    def set_network_type(self, network_type):
         """
-        self.load_risk_graph(reload_data)
+        Route on another network of OSM : its files are named after it
+        (`{data_dirpath}/NYC_{network_type}.osm`, ...) and its risk counts
+        the victims of its users (see risk_builder.NETWORK_SEVERITY). Call
+        before loading the graph.
+        """
+        prefix = path.join(self.data_dirpath, f"NYC_{network_type}")
+        self.network_type = network_type
+        self.osm_filepath = f"{prefix}.osm"
+        self.osm_risk_filepath = f"{prefix}_risk.osm"
+        self.snapshot_dirpath = f"{prefix}_risk.snapshot"
+        self.partition_dirpath = f"{prefix}_risk.cells"
+        if self.route_cache_filepath is not None:
+            self.route_cache_filepath = f"{prefix}_risk.routes.json"
+
+    @property
+    def crash_severity(self):
+        """Severity function of the crashes for the users of the network"""
+        return network_severity(self.network_type)
 
     def load_risk_graph(self, reload_data=False):
         """
-        Load the NYC streets network graph including risk into G_risk
+        Load the NYC streets network graph including risk
 
         Parameters
         ----------
@@ -154,21 +417,687 @@ class NYCRouteManager:
             Otherwhise, it will try load the saved Graph or create it if the
             OSM file is missing.
         """
+        self.prepare_snapshot(reload_data)
+        self.load_snapshot()
+
+    def prepare_snapshot(self, reload_data=False):
+        """
+        Download the network, compute its risk and save its snapshot unless
+        the saved snapshot is fresh. The snapshot is not mapped, see
+        load_snapshot.
+
+        Parameters
+        ----------
+        reload_data : boolean
+            If True, the OSM information and the risk associated to the Graph
+            will be be reloaded
+        """
         G = None
+        self._G_risk = None
         # Download the NYC_Network Graph with OSMNX
         if not path.isfile(self.osm_filepath) or reload_data:
-            G = download_osm()
+            G = download_osm(network_type=self.network_type)
             save_osm(G, self.osm_filepath)
         # Load the NYC_Network Graph with risk
         if not path.isfile(self.osm_risk_filepath) or reload_data:
             if G is None:
                 G = load_osm(self.osm_filepath)
             # create file with risk
-            self.G_risk = set_risk_to_graph(G, self.crash_weight_filepath)
+            self._G_risk = set_risk_to_graph(
+                G, self.crash_weight_filepath, self.crash_severity
+            )
             # Save file for a future usage
-            save_osm(self.G_risk, self.osm_risk_filepath)
+            save_osm(self._G_risk, self.osm_risk_filepath)
+        elif GraphSnapshot.is_fresh(self.snapshot_dirpath, self.osm_risk_filepath):
+            # Fast path : map the arrays, the GraphML is parsed on demand
+            return
         else:
-            self.G_risk = load_osm(self.osm_risk_filepath)
+            self._G_risk = load_osm(self.osm_risk_filepath)
+
+        self.save_snapshot(load=False)
+
+    def save_snapshot(self, load=True):
+        """
+        Build the snapshot of G_risk, save it in snapshot_dirpath and
+        load it (unless load is False).
+        """
+        snapshot = GraphSnapshot.from_graph(self.G_risk, source=self.osm_risk_filepath)
+        snapshot.save(self.snapshot_dirpath)
+        if load:
+            self.load_snapshot()
+
+    def load_snapshot(self):
+        """
+        Map the snapshot saved in snapshot_dirpath, create its route engine,
+        load (or build) its spatial index and load the Contraction
+        Hierarchies built for its weights.
+
+        Partitioned, the partition is loaded (or built) instead of the
+        engine and of the hierarchies.
+        """
+        self.shutdown_route_pool()
+        self.load_seconds = OrderedDict()
+        with timed(self.load_seconds, "snapshot"):
+            shared = self.nodes.snapshot if self.nodes is not None else None
+            self.snapshot = GraphSnapshot.load(self.snapshot_dirpath, nodes=shared)
+            if shared is not None and self.snapshot.node_ids is not shared.node_ids:
+                self.snapshot = self.share_nodes(self.snapshot)
+        self._engine = None
+        if not self.partitioned:
+            with timed(self.load_seconds, "engine"):
+                self._engine = RouteEngine.from_snapshot(self.snapshot, self.profiles)
+        with timed(self.load_seconds, "spatial_index"):
+            node_index = self.nodes.index if self.nodes is not None else None
+            self.spatial_index = SpatialIndex.load(
+                self.snapshot, self.snapshot_dirpath, node_index
+            )
+            if self.spatial_index is None:
+                self.spatial_index = SpatialIndex.build(self.snapshot, nodes=node_index)
+                self.spatial_index.save(self.snapshot_dirpath)
+        self.partition = None
+        if self.partitioned:
+            with timed(self.load_seconds, "partition"):
+                self.partition = self.load_partition()
+        self.time_risk = TimeBucketRisk.load(self.snapshot_dirpath)
+        self._time_buckets = OrderedDict()
+        self._time_weights = {}
+        with timed(self.load_seconds, "hierarchies"):
+            self.load_hierarchies()
+        with timed(self.load_seconds, "route_cache"):
+            self.route_cache = RouteCache(self.route_cache_max_nodes)
+            if self.route_cache_filepath is not None:
+                self.route_cache.load(
+                    self.route_cache_filepath, version=self.route_cache_version()
+                )
+
+    def share_nodes(self, snapshot):
+        """
+        Save a snapshot again on the shared node table (see
+        GraphSnapshot.reindex) and map it.
+
+        The edges keep their order : the risk, the risk state and the time
+        risk are kept, the spatial index is built again and the
+        Contraction Hierarchies no longer match the node indices (see
+        load_hierarchies). Only one process saves it (under a file lock),
+        the other ones map the saved one.
+
+        Returns
+        -------
+        GraphSnapshot
+            the snapshot on the shared nodes, or the snapshot itself if
+            some of its nodes are not in the table (built since)
+        """
+        table = self.nodes.snapshot
+        with file_lock(f"{self.snapshot_dirpath}.lock"):
+            # Saved again by another process meanwhile
+            saved = GraphSnapshot.load(self.snapshot_dirpath, nodes=table)
+            if saved.node_ids is table.node_ids:
+                return saved
+            try:
+                snapshot = saved.reindex(table)
+            except KeyError:
+                return snapshot
+            keep = risk_state_files(self.snapshot_dirpath) + [
+                f"{name}.npy" for name in TimeBucketRisk.array_names
+            ]
+            snapshot.save(self.snapshot_dirpath, keep=keep)
+        return GraphSnapshot.load(self.snapshot_dirpath, nodes=table)
+
+    def load_hierarchies(self):
+        """
+        Load the Contraction Hierarchies contracted with the current
+        weights of the engine (none when partitioned).
+        """
+        self.hierarchies = {}
+        if self.partitioned:
+            return
+        graph = graph_digest(self.engine.pair_indptr, self.engine.pair_target)
+        for profile in self.hierarchy_profiles:
+            if profile not in self.profiles:
+                continue
+            hierarchy = ContractionHierarchy.load(self.hierarchy_filepath(profile))
+            # A hierarchy contracted with other weights or on other node
+            # indices (see share_nodes) would give wrong routes
+            if (
+                hierarchy is not None
+                and hierarchy.graph_digest == graph
+                and hierarchy.weights_digest
+                == weights_digest(self.engine.pair_weights[profile])
+            ):
+                self.hierarchies[profile] = hierarchy
+
+    def update_risk(self, crash_filepath=None):
+        """
+        Ingest the crashes newer than the last update and replace the risk
+        of the edges, without reloading the topology of the graph.
+
+        The severity snapped on each edge and the watermark (hour of the
+        most recent crash ingested, see accumulate_since) are saved in the
+        snapshot directory. The first update (no saved state) ingests the
+        whole file. Without new crashes, the risk is not written again.
+
+        The new risk arrays are saved in the snapshot (see
+        GraphSnapshot.write_risk), the other processes pick them up with
+        refresh_risk. G_risk keeps the risk of the GraphML file.
+
+        Parameters
+        ----------
+        crash_filepath : string or pathlib.Path
+            path to the crash file, default : crash_weight_filepath
+
+        Returns
+        -------
+        int
+            the new watermark (YYYYMMDDHH)
+        """
+        crash_filepath = crash_filepath or self.crash_weight_filepath
+        edge_severity, since, seen = load_risk_state(self.snapshot_dirpath)
+        new_severity, watermark, new_seen = accumulate_since(
+            self.snapshot,
+            self.spatial_index,
+            read_crashes(crash_filepath),
+            since=since,
+            seen=seen,
+            severity=self.crash_severity,
+        )
+        if edge_severity is None:
+            edge_severity = np.zeros(self.snapshot.n_edges)
+        elif watermark == since and new_seen == sorted(seen):
+            # No new crash : the risk version is kept
+            return watermark
+        edge_severity = edge_severity + new_severity
+        # State first : the risk can always be recomputed from it
+        save_risk_state(self.snapshot_dirpath, edge_severity, watermark, new_seen)
+        risk = street_risk(self.snapshot, edge_severity)
+        global_risk = global_risk_of(self.snapshot, risk)
+        if self.partitioned:
+            # Overlay first : the other processes load it with the new risk
+            self.build_partition(snapshot=self.snapshot.with_risk(risk, global_risk))
+        self.snapshot.write_risk(self.snapshot_dirpath, risk, global_risk)
+        self.apply_risk()
+        return watermark
+
+    def refresh_snapshot(self):
+        """
+        Map the snapshot again if it has been saved again (in any process,
+        see save_snapshot) since it was mapped, else refresh its risk and
+        the route profiles.
+
+        The server processes forked from a loaded manager keep routing on
+        the previous snapshot while the new one is written, then switch to
+        it on their next request without being restarted.
+
+        Returns
+        -------
+        bool
+            True if the snapshot, its risk or the profiles have changed
+        """
+        with self._snapshot_lock:
+            if self.snapshot.is_current(self.snapshot_dirpath):
+                try:
+                    changed = self.refresh_risk()
+                except FileNotFoundError:
+                    # Being replaced by save : mapped on the next request
+                    changed = False
+                return self.refresh_profiles() or changed
+            try:
+                self.load_snapshot()
+            except FileNotFoundError:
+                # Replaced at this very moment, mapped on the next request
+                return False
+            return True
+
+    def refresh_risk(self):
+        """
+        Use the risk arrays saved by update_risk (in any process) if they
+        have changed since they were mapped.
+
+        Returns
+        -------
+        bool
+            True if the risk has changed
+        """
+        if not self.snapshot.reload_risk(self.snapshot_dirpath):
+            return False
+        self.apply_risk()
+        return True
+
+    def apply_risk(self):
+        """
+        Recompute the weights of the engine from the current risk arrays.
+
+        Partitioned, the overlay of the new risk is loaded (or built). The
+        hierarchies contracted with the previous weights are dropped
+        and the route pool processes are restarted with the new weights.
+        """
+        if self._engine is not None:
+            self._engine.load_profiles()
+        if self.partitioned:
+            self.partition = self.load_partition()
+        self.clear_time_buckets()
+        self.load_hierarchies()
+        self.route_cache.clear()
+        self.shutdown_route_pool()
+
+    def read_profiles(self):
+        """
+        Compile the route profiles : PROFILES, with the definitions of
+        profiles_filepath (if the file exists) added or replacing them.
+
+        Returns
+        -------
+        dict
+            name:Profile
+
+        Raises
+        ------
+        ProfileException
+            If a definition of the file is not valid.
+        """
+        definitions = dict(PROFILES)
+        self._profiles_mtime = None
+        if self.profiles_filepath is not None and path.isfile(self.profiles_filepath):
+            self._profiles_mtime = path.getmtime(self.profiles_filepath)
+            definitions.update(read_profiles(self.profiles_filepath))
+        return compile_profiles(definitions)
+
+    def refresh_profiles(self):
+        """
+        Use the profiles of profiles_filepath if the file has changed (or
+        has been created or removed) since it was read.
+
+        An invalid file is kept in profiles_error and the current profiles
+        are kept until the file changes again.
+
+        Returns
+        -------
+        bool
+            True if the profiles have changed
+        """
+        mtime = None
+        if self.profiles_filepath is not None and path.isfile(self.profiles_filepath):
+            mtime = path.getmtime(self.profiles_filepath)
+        if mtime == self._profiles_mtime:
+            return False
+        try:
+            profiles = self.read_profiles()
+        except ProfileException as err:
+            self._profiles_mtime = mtime
+            self.profiles_error = err
+            return False
+        self.profiles_error = None
+        if profiles_digest(profiles) == profiles_digest(self.profiles):
+            return False
+        self.set_profiles(profiles)
+        return True
+
+    def profile_route_types(self, profiles):
+        """Returns the route types of profiles, the known ones first"""
+        return tuple(name for name in self.route_types if name in profiles) + tuple(
+            name for name in profiles if name not in self.route_types
+        )
+
+    def set_profile(self, name, definition):
+        """
+        Compile a profile definition and route with it, replacing the
+        profile of the same name (see set_profiles). It is kept until the
+        profiles file changes.
+
+        Parameters
+        ----------
+        name : string
+            name of the profile, added to route_types if new
+        definition : string or dict
+            weight expression or dict with the `weight` expression and the
+            `fill` values, see profiles.PROFILES
+
+        Raises
+        ------
+        ProfileException
+            If the definition is not valid (the profiles are unchanged).
+        """
+        profiles = dict(self.profiles)
+        profiles[name] = Profile.from_definition(name, definition)
+        self.set_profiles(profiles)
+
+    def set_profiles(self, profiles):
+        """
+        Replace the route profiles : the weights of the engine are computed
+        again without changing its searches.
+
+        Partitioned, the partition of these profiles is loaded (or built).
+        The time buckets, the cached routes and the hierarchies contracted
+        with other weights are dropped and the route pool processes are
+        restarted with the new weights.
+
+        Parameters
+        ----------
+        profiles : dict
+            name:Profile (see profiles.compile_profiles)
+        """
+        # Evaluated before any change : an invalid profile (e.g. negative
+        # weights) leaves the manager unchanged
+        if self._engine is not None:
+            self._engine.load_profiles(profiles)
+        else:
+            profile_weights(self.snapshot, profiles)
+        self.clear_time_buckets()
+        self.profiles = dict(profiles)
+        self.route_types = self.profile_route_types(profiles)
+        if self.partitioned:
+            self.partition = self.load_partition()
+        self.load_hierarchies()
+        self.route_cache.clear()
+        self.shutdown_route_pool()
+
+    def load_partition(self):
+        """
+        Load the partition of the snapshot saved in partition_dirpath, or
+        build and save it if it has been computed with another snapshot,
+        another risk or other profiles.
+
+        Returns
+        -------
+        PartitionedGraph
+        """
+        partition = PartitionedGraph.load(
+            self.snapshot,
+            self.partition_dirpath,
+            self.partition_max_cells,
+            profiles=self.profiles,
+        )
+        if partition is None:
+            partition = self.build_partition()
+        return partition
+
+    def build_partition(self, crash_filepath=None, snapshot=None):
+        """
+        Build the partition of the snapshot with its current risk and save
+        it in partition_dirpath.
+
+        The borough of the nodes is read from the crashes (see
+        partition.node_cells), the one saved with the previous partition
+        of this snapshot is kept unless a crash file is given.
+
+        Parameters
+        ----------
+        crash_filepath : string or pathlib.Path
+            path to the crash file giving the boroughs, default : the
+            boroughs of the saved partition or crash_weight_filepath
+        snapshot : GraphSnapshot
+            the snapshot with the risk to use, default : self.snapshot
+
+        Returns
+        -------
+        PartitionedGraph
+        """
+        snapshot = snapshot or self.snapshot
+        node_cell = None
+        if crash_filepath is None:
+            node_cell = PartitionedGraph.load_node_cell(
+                snapshot, self.partition_dirpath
+            )
+        if node_cell is None:
+            node_cell = node_cells(
+                snapshot,
+                self.spatial_index,
+                read_crashes(
+                    crash_filepath or self.crash_weight_filepath,
+                    columns=BOROUGH_COLUMNS,
+                ),
+            )
+        partition = PartitionedGraph.build(
+            snapshot,
+            node_cell,
+            max_cells=self.partition_max_cells,
+            profiles=self.profiles,
+        )
+        partition.save(self.partition_dirpath)
+        return partition
+
+    def build_time_risk(self, crash_filepath=None):
+        """
+        Compute the hour by day of week factors of the risk from a crash
+        file and save them in the snapshot directory.
+
+        This is an offline preprocessing step (see utils/time_risk.py),
+        the factors are applied on the current global risk, so they don't
+        need to be rebuilt on each update_risk.
+
+        Parameters
+        ----------
+        crash_filepath : string or pathlib.Path
+            path to the crash file, default : crash_weight_filepath
+        """
+        crash_filepath = crash_filepath or self.crash_weight_filepath
+        time_risk = TimeBucketRisk.build(
+            self.snapshot,
+            self.spatial_index,
+            read_crashes(crash_filepath),
+            severity=self.crash_severity,
+        )
+        time_risk.save(self.snapshot_dirpath)
+        self.time_risk = TimeBucketRisk.load(self.snapshot_dirpath)
+        self.clear_time_buckets()
+        self.route_cache.clear()
+        self.shutdown_route_pool()
+
+    @property
+    def time_profiles(self):
+        """Profiles depending on the departure time (see time_profile)"""
+        return tuple(
+            name for name, profile in self.profiles.items() if profile.uses_time
+        )
+
+    def uses_astar(self, profile):
+        """
+        True if a profile is searched with A* : the haversine potential is
+        only admissible while the weight of the profile is the length (a
+        redefined profile, see set_profile, is searched with Dijkstra).
+        """
+        return (
+            profile in self.astar_profiles
+            and profile in self.profiles
+            and self.profiles[profile].weight == "length"
+        )
+
+    def uses_time_risk(self, profile, departure_time):
+        """True if the weights of a profile depend on the departure time"""
+        return (
+            departure_time is not None
+            and self.time_risk is not None
+            and profile in self.time_profiles
+        )
+
+    @contextmanager
+    def time_profile(self, profile, departure_time):
+        """
+        Returns the name of the engine weights of a profile at a departure
+        time, to use in a `with` block : `{profile}@{key}` for the
+        time_profiles, computed with the global risk and the risk factors
+        of the time bucket on the first use.
+
+        The weights of the last max_time_buckets buckets are kept, and the
+        ones used by a search until the end of its block even if other
+        buckets are used meanwhile. The Contraction Hierarchies are only
+        built for the weights without departure time.
+
+        Parameters
+        ----------
+        profile : string
+            name of the engine profile
+        departure_time : datetime.datetime
+            departure time, None for the weights without departure time
+
+        Yields
+        ------
+        string
+        """
+        if not self.uses_time_risk(profile, departure_time):
+            yield profile
+            return
+        key = self._pin_time_bucket(time_bucket(departure_time))
+        try:
+            yield f"{profile}@{key}"
+        finally:
+            with self._time_buckets_lock:
+                self._time_weights[key][1] -= 1
+                self._drop_time_weights(key)
+
+    def _pin_time_bucket(self, bucket):
+        """
+        Returns the key of the weights of a time bucket, computed if needed,
+        and counts one more search using them.
+        """
+        with self._time_buckets_lock:
+            key = self._time_buckets.get(bucket)
+            if key is not None:
+                self._time_buckets.move_to_end(bucket)
+            else:
+                # Weights computed again after a clear have another key
+                key = f"{bucket}.{self._time_generation}"
+                time_factor = self.time_risk.edge_factors(self.snapshot.n_edges, bucket)
+                weights = self.engine.profile_weights(
+                    profiles=self.time_profiles,
+                    global_risk=self.snapshot.edge_global_risk * time_factor,
+                    time_factor=time_factor,
+                    bucket=bucket,
+                )
+                for name, edge_weights in weights.items():
+                    self.engine.set_weights(f"{name}@{key}", edge_weights)
+                self._time_buckets[bucket] = key
+                pins = self._time_weights.get(key, [None, 0])[1]
+                self._time_weights[key] = [list(weights), pins]
+            self._time_weights[key][1] += 1
+            while len(self._time_buckets) > self.max_time_buckets:
+                _, oldest = self._time_buckets.popitem(last=False)
+                self._drop_time_weights(oldest)
+        return key
+
+    def _drop_time_weights(self, key):
+        """
+        Remove the weights of a key from the engine if no bucket nor search
+        uses them anymore, to call with the _time_buckets_lock.
+        """
+        names, pins = self._time_weights.get(key, (None, 0))
+        if names is None or pins > 0 or key in self._time_buckets.values():
+            return
+        for name in names:
+            self.engine.remove_weights(f"{name}@{key}")
+        del self._time_weights[key]
+
+    def _reset_time_pins(self):
+        """
+        Forget the searches using the weights of the time buckets, run by
+        threads which don't exist in a forked process.
+        """
+        for key in list(self._time_weights or ()):
+            self._time_weights[key][1] = 0
+            self._drop_time_weights(key)
+
+    def clear_time_buckets(self):
+        """Forget the weights of the time buckets (computed with old risk)"""
+        with self._time_buckets_lock:
+            if self._time_buckets is None:
+                return
+            keys = list(self._time_buckets.values())
+            self._time_buckets = OrderedDict()
+            self._time_generation += 1
+            # The weights used by a search are removed at its end
+            for key in keys:
+                self._drop_time_weights(key)
+
+    def route_cache_version(self):
+        """
+        Version of the graph, of its risk and of the profiles, saved with
+        the route cache
+        """
+        return (
+            f"{self.snapshot.snapshot_id}:{self.snapshot.risk_version}:"
+            f"{profiles_digest(self.profiles)}"
+        )
+
+    def save_route_cache(self):
+        """Save the route cache in route_cache_filepath (if set)"""
+        if self.route_cache_filepath is not None and self.route_cache is not None:
+            self.route_cache.save(
+                self.route_cache_filepath, version=self.route_cache_version()
+            )
+
+    def route_key(self, node_from, node_to, weight, departure_time=None):
+        """
+        Returns the key of a route in the route cache : the snapped ends,
+        the profile, the time bucket and the version of the risk.
+
+        Returns None for the weights computed by networkx (not cached).
+        """
+        profile = (
+            self.weight_profiles.get(weight, weight) if type(weight) is str else None
+        )
+        if profile is None or not self.has_profile(profile):
+            return None
+        bucket = None
+        if self.uses_time_risk(profile, departure_time):
+            bucket = time_bucket(departure_time)
+        return (
+            self._end_key(node_from),
+            self._end_key(node_to),
+            profile,
+            bucket,
+            self.snapshot.risk_version,
+        )
+
+    def has_profile(self, profile):
+        """True if the routes of a profile are computed on the snapshot arrays"""
+        if self.partition is not None and profile in self.partition.profiles:
+            return True
+        return self.engine.has_weights(profile)
+
+    @staticmethod
+    def _end_key(end):
+        if isinstance(end, EdgeSnap):
+            return (int(end.edge), float(end.fraction))
+        return int(end)
+
+    def hierarchy_filepath(self, profile):
+        """Path of the Contraction Hierarchy file of a profile"""
+        return f"{path.splitext(self.osm_risk_filepath)[0]}.ch_{profile}.npz"
+
+    def build_hierarchy(self, profile, verbose=False):
+        """
+        Contract the graph with the weights of a profile, save the
+        hierarchy next to osm_risk_filepath and use it for the next routes.
+
+        This is an offline preprocessing step, it takes several minutes on
+        the NYC streets network. See utils/contraction.py.
+
+        Parameters
+        ----------
+        profile : string
+            name of the engine profile
+        verbose : boolean
+            If True, print the progress of the contraction
+        """
+        hierarchy = ContractionHierarchy.build(
+            self.engine.pair_indptr,
+            self.engine.pair_target,
+            self.engine.pair_weights[profile],
+            verbose=verbose,
+        )
+        hierarchy.save(self.hierarchy_filepath(profile))
+        self.hierarchies[profile] = hierarchy
+
+    @property
+    def G_risk(self):
+        """
+        The NYC streets network graph including risk.
+
+        The GraphML file is only parsed the first time the graph is needed,
+        the routes of the engine profiles only use the snapshot arrays.
+        """
+        if self._G_risk is None:
+            self._G_risk = load_osm(self.osm_risk_filepath)
+        return self._G_risk
 
     def get_nearest_node(self, point, return_dist=False):
         """
@@ -195,7 +1124,61 @@ class NYCRouteManager:
             where dist is the distance (in meters) between the point
             and nearest node
         """
-        return ox.get_nearest_node(self.G_risk, point, return_dist=return_dist)
+        if return_dist:
+            nodes, dists = self.get_nearest_nodes([point], return_dist=True)
+            return nodes[0], dists[0]
+        return self.get_nearest_nodes([point])[0]
+
+    def get_nearest_nodes(self, points, return_dist=False):
+        """
+        Find the nearest node of many points at once with the spatial index.
+
+        Parameters
+        ----------
+        points : list
+            The (lat, lng) or (y, x) points
+        return_dist : bool
+            Optionally also return the distances (in meters)
+            between the points and their nearest node
+
+        Returns
+        -------
+        list or tuple of (list, list)
+            Nearest node IDs or optionally a tuple of (node IDs, dists)
+        """
+        lats, lngs = np.asarray(points, dtype=float).reshape(-1, 2).T
+        result = self.spatial_index.nearest_nodes(lats, lngs, return_dist=return_dist)
+        if return_dist:
+            nodes, dists = result
+            return self.snapshot.node_ids[nodes].tolist(), dists.tolist()
+        return self.snapshot.node_ids[result].tolist()
+
+    def get_nearest_edges(self, points):
+        """
+        Snap many points at once on their nearest edge.
+
+        Parameters
+        ----------
+        points : list
+            The (lat, lng) or (y, x) points
+
+        Returns
+        -------
+        list of EdgeSnap
+            index of the edge in the snapshot, position of the point along
+            the edge (0 to 1) and distance (in meters) to the edge
+        """
+        lats, lngs = np.asarray(points, dtype=float).reshape(-1, 2).T
+        return self.spatial_index.nearest_edges(lats, lngs)
+
+    def snap_point(self, point):
+        """
+        Returns the nearest node ID of a point, or its EdgeSnap if
+        snap_to_edges is True.
+        """
+        if self.snap_to_edges:
+            return self.get_nearest_edges([point])[0]
+        return self.get_nearest_node(point)
 
     def convert_route_to_gdf(self, route):
         """
@@ -213,6 +1196,8 @@ class NYCRouteManager:
         geopandas.GeoDataFrame
             List of the edges defined in the route
         """
+        import osmnx as ox
+
         # Extracted from ox.plot_route_folium()
         node_pairs = zip(route[:-1], route[1:])
         uvk = (
@@ -227,7 +1212,26 @@ class NYCRouteManager:
 
         return gdf_edges
 
-    def get_route(self, point_from, point_to, weight="length"):
+    def convert_route_to_geometry(self, route):
+        """
+        Convert a route to a RouteGeometry, built from the snapshot arrays
+        without the graph (see RouteGeometry.to_gdf for a GeoDataFrame).
+
+        Parameters
+        ----------
+        route : list
+            List of nodes in a route.
+
+        Returns
+        -------
+        RouteGeometry
+            Geometry and attributes of the edges defined in the route
+        """
+        if self.partition is not None:
+            return RouteGeometry.from_route(self.snapshot, self.partition, route)
+        return RouteGeometry.from_route(self.snapshot, self.engine, route)
+
+    def get_route(self, point_from, point_to, weight="length", departure_time=None):
         """
         Returns the shortest weighted path from point_from to point_to in
         the NYC streets network.
@@ -236,7 +1240,9 @@ class NYCRouteManager:
         these geographic points.
 
         Uses Dijkstra's Method to compute the shortest weighted path
-        between two nodes in a graph.
+        between two nodes in a graph, or the Contraction Hierarchy of the
+        profile when it has been built (see build_hierarchy). On equal
+        weights, both can return different paths with the same weight.
 
         Parameters
         ----------
@@ -247,7 +1253,12 @@ class NYCRouteManager:
             Destination point
 
         weight : string or function
-            If this is a string, then edge weights will be accessed via the
+            If this is the name of a profile of the engine (shortest,
+            safest, safest_streets, dangerous) or an edge attribute in
+            `weight_profiles`, the path is computed on the snapshot arrays.
+
+            Otherwise the path is computed by networkx on G_risk :
+            if this is a string, then edge weights will be accessed via the
             edge attribute with this key (that is, the weight of the edge
             joining `u` to `v` will be ``G.edges[u, v][weight]``). If no
             such edge attribute exists, the weight of the edge is assumed to
@@ -259,69 +1270,186 @@ class NYCRouteManager:
             dictionary of edge attributes for that edge. The function must
             return a number.
 
+        departure_time : datetime.datetime
+            If set, the risk of the profiles is the one of the hour and day
+            of the week of the departure (see time_profile)
+
         Returns
         -------
-        geopandas.GeoDataFrame
-            List of the edges defined in the route
+        RouteGeometry
+            Geometry and attributes of the edges defined in the route
 
         Raises
         ------
-        NodeNotFound
-            If `point_from` is not in NYC streets network.
-
-        NetworkXNoPath
+        NoPathException
             If no path exists between point_from and point_to.
         """
-        # Search the nodes from and to
-        node_from = self.get_nearest_node(point_from)
-        node_to = self.get_nearest_node(point_to)
+        self.refresh_snapshot()
+        # Search the nodes (or edges) from and to
+        node_from = self.snap_point(point_from)
+        node_to = self.snap_point(point_to)
 
         # Compute the shortest weigthed way
-        route = nx.dijkstra_path(self.G_risk, node_from, node_to, weight=weight)
+        route = self.compute_route(
+            node_from, node_to, weight=weight, departure_time=departure_time
+        )
+
+        return self.convert_route_to_geometry(route)
+
+    def compute_route(self, node_from, node_to, weight="length", departure_time=None):
+        """
+        Returns the list of nodes of the shortest weighted path between
+        two nodes of the NYC streets network.
+
+        The nodes can be EdgeSnap (see snap_point) : the path then starts
+        with the snapped edge of node_from and ends with the snapped edge
+        of node_to.
 
-        return self.convert_route_to_gdf(route)
+        The routes of the engine profiles are cached (see route_key).
+
+        See get_route(self, point_from, point_to, weight=weight,
+        departure_time=departure_time) for more information.
+        """
+        key = self.route_key(node_from, node_to, weight, departure_time)
+        if key is None:
+            return self._compute_route(node_from, node_to, weight, departure_time)
+        route = self.route_cache.get(key)
+        if route is None:
+            route = self._compute_route(node_from, node_to, weight, departure_time)
+            self.route_cache.put(key, route)
+        return route
+
+    def _compute_route(self, node_from, node_to, weight="length", departure_time=None):
+        """Compute a route without the route cache, see compute_route"""
+        profile = (
+            self.weight_profiles.get(weight, weight) if type(weight) is str else None
+        )
+        snapped = isinstance(node_from, EdgeSnap) or isinstance(node_to, EdgeSnap)
+        if profile is None or not self.has_profile(profile):
+            if snapped:
+                raise ValueError("Edge snapping needs an engine profile as weight")
+            import networkx as nx
+
+            try:
+                return nx.dijkstra_path(self.G_risk, node_from, node_to, weight=weight)
+            except nx.NetworkXNoPath as err:
+                raise NoPathException(err)
+
+        with self.time_profile(profile, departure_time) as profile:
+            if snapped:
+                path = self._compute_snapped_route(node_from, node_to, profile)
+                return self.snapshot.node_ids[path].tolist()
+
+            source = self.snapshot.node_index(node_from)
+            target = self.snapshot.node_index(node_to)
+            if self.partition is not None and profile in self.partition.profiles:
+                path = self.partition.shortest_path(source, target, weight=profile)
+            elif profile in self.hierarchies:
+                path = self.hierarchies[profile].shortest_path(source, target)
+            else:
+                path = self.engine.shortest_path(
+                    source,
+                    target,
+                    weight=profile,
+                    heuristic=self.uses_astar(profile),
+                )
+            return self.snapshot.node_ids[path].tolist()
+
+    def _snap_ends(self, end, profile):
+        """
+        Returns the (u, v, fraction, u->v weight, v->u weight) of an
+        EdgeSnap or a node ID. The weights are NaN for a missing edge.
+        """
+        if not isinstance(end, EdgeSnap):
+            node = self.snapshot.node_index(end)
+            return node, node, 0.0, 0.0, float("nan")
+        weights = self.engine.pair_weights[profile]
+        u = int(self.snapshot.edge_source[end.edge])
+        v = int(self.snapshot.edge_target[end.edge])
+        forward = self.engine.pair_index(u, v)
+        backward = self.engine.pair_index(v, u)
+        return (
+            u,
+            v,
+            end.fraction,
+            weights[forward],
+            weights[backward] if backward >= 0 else float("nan"),
+        )
+
+    def _compute_snapped_route(self, end_from, end_to, profile):
+        """
+        Returns the node indices of the path between two EdgeSnap (or node
+        IDs). The points in the middle of an edge are reached from both
+        ends of the edge (and of the reverse edge on two-way streets).
+        """
+        u_from, v_from, f_from, w_from, w_from_back = self._snap_ends(end_from, profile)
+        u_to, v_to, f_to, w_to, w_to_back = self._snap_ends(end_to, profile)
+
+        # Both points on the same street : no search when it can be followed
+        if (u_to, v_to) == (v_from, u_from) and u_from != v_from:
+            u_to, v_to, f_to = u_from, v_from, 1 - f_to
+        if (u_from, v_from) == (u_to, v_to) and u_from != v_from:
+            if f_from <= f_to:
+                return [u_from, v_from]
+            if not np.isnan(w_from_back):
+                return [v_from, u_from]
+
+        sources = {v_from: (1 - f_from) * w_from}
+        if not np.isnan(w_from_back) and u_from != v_from:
+            sources[u_from] = f_from * w_from_back
+        targets = {u_to: f_to * w_to}
+        if not np.isnan(w_to_back) and u_to != v_to:
+            targets[v_to] = (1 - f_to) * w_to_back
+
+        if profile in self.hierarchies:
+            path = self.hierarchies[profile].shortest_path_between(sources, targets)
+        else:
+            path = self.engine.shortest_path_between(sources, targets, weight=profile)
+
+        # Add the snapped edges, in the direction they are driven
+        if u_from != v_from:
+            path.insert(0, u_from if path[0] == v_from else v_from)
+        if u_to != v_to:
+            path.append(v_to if path[-1] == u_to else u_to)
+        return path
 
     def get_safest_route(self, point_from, point_to):
         """
         Returns the safest path from point_from to point_to in
         the NYC streets network.
 
-        Call `get_route` using `risk` as weigth
+        Call `get_route` using the `safest` profile (`global_risk`)
+        as weigth
 
         See get_route(self, point_from, point_to, weight=weight) for more information.
 
         """
-        return self.get_route(point_from, point_to, weight="global_risk")
+        return self.get_route(point_from, point_to, weight="safest")
 
     def get_safest_streets_route(self, point_from, point_to):
         """
         Returns the safest path from point_from to point_to in
         the NYC streets network by looking for a short disance.
 
-        Call `get_route` using `custom_value` as weight
+        Call `get_route` using the `safest_streets` profile
+        (`length * (global_risk + 1)`) as weight
 
         See get_route(self, point_from, point_to, weight=weight)
         for more information.
         """
-
-        def safest_street_weight(u, v, d):
-            length = d[0].get("length", 0)
-            global_risk = d[0].get("global_risk", 0)
-            return length * (global_risk + 1)
-
-        return self.get_route(point_from, point_to, weight=safest_street_weight)
+        return self.get_route(point_from, point_to, weight="safest_streets")
 
     def get_shortest_route(self, point_from, point_to):
         """
         Returns the shortest path from point_from to point_to in
         the NYC streets network.
 
-        Call `get_route` using `length` as weight
+        Call `get_route` using the `shortest` profile (`length`) as weight
 
         See get_route(self, point_from, point_to, weight=weight)
         for more information.
         """
-        return self.get_route(point_from, point_to, weight="length")
+        return self.get_route(point_from, point_to, weight="shortest")
 
     # Sample to compute weigth with function
     # Source : https://networkx.org/documentation/stable/reference/algorithms/generated/networkx.algorithms.shortest_paths.weighted.dijkstra_path.html?highlight=dijkstra_path#networkx.algorithms.shortest_paths.weighted.dijkstra_path
@@ -336,44 +1464,485 @@ class NYCRouteManager:
         Returns the dangerous path from point_from to point_to in
         the NYC streets network.
 
-        Call `get_route` using `global_risk * -1` as weight
+        Call `get_route` using the `dangerous` profile (`length` * banded
+        `global_risk`, see profiles.PROFILES) as weight
 
         See get_route(self, point_from, point_to, weight=weight)
         for more information.
         """
+        return self.get_route(point_from, point_to, weight="dangerous")
+
+    def get_isochrone(self, point, cutoff, weight="length"):
+        """
+        Returns the nodes reachable from a point within a maximum weight,
+        e.g. 2000 meters (weight "length") or a risk budget (weight
+        "global_risk"), and the area they cover.
 
-        def most_dangerous_weight(u, v, d):
-            edge_risk = d[0].get("global_risk", 0)
-            edge_length = d[0].get("length", 1)
-            if edge_risk == 0:
-                edge_risk = 1000
-            elif edge_risk < 3:
-                edge_risk = 500
-            elif edge_risk < 7:
-                edge_risk = 250
-            elif edge_risk < 10:
-                edge_risk = 100
+        Parameters
+        ----------
+        point : tuple
+            The (lat, lng) or (y, x) point
+        cutoff : float
+            maximum weight of the paths
+        weight : string
+            edge attribute (see weight_profiles) or route type
+
+        Returns
+        -------
+        Isochrone
+        """
+        profile = self.weight_profiles.get(weight, weight)
+        if not self.engine.has_weights(profile):
+            raise ValueError(f"Unknown weight : {weight}")
+        self.refresh_snapshot()
+        u, v, fraction, weight_uv, weight_vu = self._snap_ends(
+            self.snap_point(point), profile
+        )
+        # A point in the middle of an edge starts from its two ends
+        sources = {v: (1 - fraction) * weight_uv}
+        if not np.isnan(weight_vu) and u != v:
+            sources[u] = fraction * weight_vu
+        return Isochrone.search(
+            self.snapshot, self.engine, sources, cutoff, weight=profile
+        )
+
+    def get_isochrone_geojson(self, point, cutoffs, weight="length", timeout=None):
+        """
+        Returns the areas reachable from a point within several cutoffs as
+        GeoJSON, see get_isochrone and Isochrone.to_geojson.
+
+        With a timeout, the search and the areas are computed in the route
+        pool (see get_route_pool).
+
+        Parameters
+        ----------
+        point : tuple
+            The (lat, lng) or (y, x) point
+        cutoffs : list
+            maximum weights of the paths of the areas
+        weight : string
+            edge attribute (see weight_profiles) or route type
+        timeout : float
+            maximum time (in seconds) to wait for the route pool, None to
+            compute the areas in this process
+
+        Returns
+        -------
+        dict
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError
+            If the areas are not computed before the timeout (see
+            compute_routes).
+        """
+
+        pool = self.get_route_pool() if timeout is not None else None
+        if pool is None:
+            return self.get_isochrone(point, max(cutoffs), weight).to_geojson(cutoffs)
+        return self.pool_result(
+            pool, _compute_pool_isochrone, (id(self), point, cutoffs, weight), timeout
+        )
+
+    def get_alternative_routes(
+        self,
+        point_from,
+        point_to,
+        route_type="safest",
+        k=3,
+        max_overlap=MAX_OVERLAP,
+        stretch=MAX_STRETCH,
+        departure_time=None,
+        timeout=None,
+    ):
+        """
+        Returns up to k different routes of a type between two points,
+        see alternatives.alternative_routes. The routes start and end on
+        the nearest nodes of the points.
+
+        With a timeout, the search runs in the route pool (see
+        get_route_pool) : the two search trees of the alternatives are much
+        larger than the ones of a route.
+
+        Parameters
+        ----------
+        point_from : tuple
+            The (lat, lng) or (y, x) point from
+        point_to : tuple
+            The (lat, lng) or (y, x) point to
+        route_type : string
+            route type (name of an engine profile)
+        k : int
+            maximum number of routes
+        max_overlap : float
+            maximum part (0 to 1) of the length of a route on the previous
+            ones
+        stretch : float
+            maximum weight of a route relative to the best route
+        departure_time : datetime.datetime
+            If set, the risk is the one of the hour and day of the week
+        timeout : float
+            maximum time (in seconds) to wait for the search of the route
+            pool, None to search in this process
+
+        Returns
+        -------
+        list of RouteGeometry
+            the best route first
+
+        Raises
+        ------
+        NoPathException
+            If no path exists between point_from and point_to.
+        concurrent.futures.TimeoutError
+            If the search is not done before the timeout (see
+            compute_routes).
+        """
+        profile = self.weight_profiles.get(route_type, route_type)
+        if not self.engine.has_weights(profile):
+            raise ValueError(f"Unknown route type : {route_type}")
+        self.refresh_snapshot()
+        source = self.snapshot.node_index(self.get_nearest_node(point_from))
+        target = self.snapshot.node_index(self.get_nearest_node(point_to))
+        kwargs = dict(
+            k=k,
+            max_overlap=max_overlap,
+            stretch=stretch,
+            departure_time=departure_time,
+        )
+        pool = self.get_route_pool() if timeout is not None else None
+        if pool is not None:
+            paths = self.pool_result(
+                pool,
+                _compute_pool_alternatives,
+                (id(self), source, target, profile),
+                timeout,
+                kwargs,
+            )
+        else:
+            paths = self._compute_alternatives(source, target, profile, **kwargs)
+        return [
+            self.convert_route_to_geometry(self.snapshot.node_ids[path].tolist())
+            for path in paths
+        ]
+
+    def _compute_alternatives(
+        self,
+        source,
+        target,
+        profile,
+        k=3,
+        max_overlap=MAX_OVERLAP,
+        stretch=MAX_STRETCH,
+        departure_time=None,
+    ):
+        """
+        Compute the alternative routes between two node indices, see
+        get_alternative_routes. Returns the node indices of each route.
+        """
+        with self.time_profile(profile, departure_time) as profile:
+            return alternative_routes(
+                self.engine,
+                source,
+                target,
+                weight=profile,
+                k=k,
+                max_overlap=max_overlap,
+                stretch=stretch,
+                heuristic=self.uses_astar(profile),
+            )
+
+    def get_routes(
+        self,
+        point_from: tuple,
+        point_to: tuple,
+        route_types: list,
+        departure_time=None,
+        timeout=None,
+    ):
+        """
+        Returns the paths from point_from to point_to in the NYC streets
+        network for several route types.
+
+        The nearest nodes of the points are searched once for all the route
+        types and the routes are computed concurrently (see compute_routes).
+
+        Parameters
+        ----------
+        point_from : tuple(latitude, longitude)
+            Starting point
+        point_to : tuple(latitude, longitude)
+            Destination point
+        route_types : list
+            route types among `route_types`, the others are ignored
+        departure_time : datetime.datetime
+            If set, the risk of the profiles is the one of the hour and day
+            of the week of the departure (see time_profile)
+        timeout : float
+            If set, maximum time (in seconds) of the searches, see
+            compute_routes
+
+        Returns
+        -------
+        dict
+            route_type:RouteGeometry of the edges of the route
+        """
+        route_types = [
+            rt for rt in dict.fromkeys(route_types) if rt in self.route_types
+        ]
+        self.refresh_snapshot()
+        with span("snap"):
+            node_from = self.snap_point(point_from)
+            node_to = self.snap_point(point_to)
+
+        durations = {}
+        routes = self.compute_routes(
+            node_from,
+            node_to,
+            route_types,
+            departure_time,
+            timeout=timeout,
+            durations=durations,
+        )
+        geometries = {}
+        for route_type, route in routes.items():
+            with span("geometry", profile=route_type) as labels:
+                geometries[route_type] = self.convert_route_to_geometry(route)
+                labels["length"] = length_band(geometries[route_type].length)
+            if route_type in durations:
+                stage_seconds.observe(
+                    durations[route_type],
+                    **stage_labels(
+                        "search", profile=route_type, length=labels["length"]
+                    ),
+                )
+            observe_route(route_type, geometries[route_type])
+        return geometries
+
+    def compute_routes(
+        self,
+        node_from,
+        node_to,
+        profiles,
+        departure_time=None,
+        timeout=None,
+        durations=None,
+    ):
+        """
+        Returns the lists of nodes of the paths between two nodes for
+        several profiles.
+
+        The cached routes are returned first (see route_key). The
+        profiles answered by a Contraction Hierarchy are computed in
+        this process. When several profiles need a full search, they are
+        dispatched to the route pool, so the request costs about the
+        slowest profile instead of the sum of all of them. With a timeout,
+        even a single full search is dispatched to the route pool, so the
+        request can stop waiting for it.
+
+        Parameters
+        ----------
+        node_from : int
+            Starting node ID
+        node_to : int
+            Destination node ID
+        profiles : list
+            names of the engine profiles
+        departure_time : datetime.datetime
+            departure time, see time_profile
+        timeout : float
+            maximum time (in seconds) to wait for the searches of the
+            route pool, None to wait for them
+        durations : dict
+            If set, the duration (in seconds) of the search of each
+            computed (not cached) route is added to it by profile
+
+        Returns
+        -------
+        dict
+            profile:list of node IDs
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError
+            If the searches are not done before the timeout (see
+            pool_result).
+        """
+        end = time.monotonic() + timeout if timeout is not None else None
+        routes, keys = {}, {}
+        for profile in profiles:
+            keys[profile] = self.route_key(node_from, node_to, profile, departure_time)
+            if keys[profile] is not None:
+                route = self.route_cache.get(keys[profile])
+                if route is not None:
+                    routes[profile] = route
+        searched = [
+            profile
+            for profile in profiles
+            if profile not in routes
+            and (
+                profile not in self.hierarchies
+                or self.uses_time_risk(profile, departure_time)
+            )
+        ]
+        dispatched = len(searched) > 1 or (searched and timeout is not None)
+        pool = self.get_route_pool() if dispatched else None
+        args, futures = {}, {}
+        if pool is not None:
+            for profile in searched:
+                args[profile] = (id(self), node_from, node_to, profile, departure_time)
+                futures[profile] = pool.submit(_compute_pool_route, *args[profile])
+
+        for profile in profiles:
+            if profile in routes:
+                continue
+            if profile in futures:
+                remaining = max(end - time.monotonic(), 0) if end is not None else None
+                try:
+                    routes[profile], duration = self.pool_result(
+                        pool,
+                        _compute_pool_route,
+                        args[profile],
+                        remaining,
+                        future=futures[profile],
+                    )
+                except TimeoutError:
+                    # The other searches of the request aren't waited for
+                    for future in futures.values():
+                        if not future.done() and not future.cancel():
+                            self.retire_route_pool(pool, future)
+                    raise
             else:
-                edge_risk = 1
-            return edge_length * edge_risk
-
-        return self.get_route(point_from, point_to, weight=most_dangerous_weight)
-
-    def get_routes(self, point_from: tuple, point_to: tuple, route_types: list):
-        routes = {}
-        for route_type in route_types:
-            route = None
-            if route_type == "safest":
-                route = self.get_safest_route(point_from, point_to)
-            elif route_type == "shortest":
-                route = self.get_shortest_route(point_from, point_to)
-            elif route_type == "dangerous":
-                route = self.get_most_dangerous_route(point_from, point_to)
-            elif route_type == "safest_streets":
-                route = self.get_safest_streets_route(point_from, point_to)
-            if route is not None:
-                routes[route_type] = route
-        return routes
+                start = time.perf_counter()
+                routes[profile] = self._compute_route(
+                    node_from, node_to, weight=profile, departure_time=departure_time
+                )
+                duration = time.perf_counter() - start
+            if durations is not None:
+                durations[profile] = duration
+            if keys[profile] is not None:
+                self.route_cache.put(keys[profile], routes[profile])
+        return {profile: routes[profile] for profile in profiles}
+
+    def get_route_pool(self):
+        """
+        Returns the pool of processes computing the routes, created on the
+        first call.
+
+        The processes are forked from this one, so they share the pages of
+        the snapshot and inherit the route engine without loading anything.
+        They are all forked at once, while this thread holds the locks of
+        the state they read : no other thread is then changing that state
+        or holding a lock the processes would inherit held (and wait on
+        forever). Better, fork the pool before the server threads start
+        (see networks.NetworkRouteManagers.start_route_pools).
+
+        Returns None if the pool is disabled (route_workers < 2) or if the
+        platform can't fork.
+        """
+        if self.route_workers < 2:
+            return None
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        # Several server threads can ask for the pool at once
+        with self._route_pool_lock:
+            if self._route_pool is None:
+                _pool_managers[id(self)] = self
+                pool = RoutePool(
+                    ProcessPoolExecutor(
+                        max_workers=self.route_workers,
+                        mp_context=multiprocessing.get_context("fork"),
+                        initializer=_init_pool_process,
+                        initargs=(id(self),),
+                    )
+                )
+                with ExitStack() as stack:
+                    for lock in self._fork_locks():
+                        stack.enter_context(lock)
+                    # With fork, the first task forks all the processes
+                    pool.submit(_start_pool_process)
+                self._route_pool = pool
+            return self._route_pool
+
+    def _fork_locks(self):
+        """Locks of the state read by the processes of the route pool"""
+        locks = [self._snapshot_lock, self._time_buckets_lock, self._engine_lock]
+        if self.partition is not None:
+            locks.append(self.partition._cells_lock)
+        return locks
+
+    def pool_result(self, pool, fn, args, timeout, kwargs=None, future=None):
+        """
+        Returns the result of a task of the route pool.
+
+        A task not done before the timeout is cancelled, or the pool is
+        retired if it's running (see retire_route_pool) : its process would
+        stay busy, unseen by the next requests. A task failing because a
+        process of the pool died (killed when out of memory, ...) is
+        submitted once again to a new pool, within the same timeout.
+
+        Parameters
+        ----------
+        pool : RoutePool
+            the route pool running the task
+        fn : function
+            the task, called in a process of the pool
+        args : tuple
+            positional arguments of the task
+        timeout : float
+            maximum time (in seconds) to wait, None to wait for the result
+        kwargs : dict
+            keyword arguments of the task
+        future : concurrent.futures.Future
+            future of the task if it's already submitted
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError
+            If the task is not done before the timeout.
+        concurrent.futures.process.BrokenProcessPool
+            If the processes of the new pool died too.
+        """
+        kwargs = kwargs or {}
+        end = time.monotonic() + timeout if timeout is not None else None
+        if future is None:
+            future = pool.submit(fn, *args, **kwargs)
+        for retry in (True, False):
+            remaining = max(end - time.monotonic(), 0) if end is not None else None
+            try:
+                return future.result(timeout=remaining)
+            except TimeoutError:
+                if not future.cancel():
+                    self.retire_route_pool(pool, future)
+                raise
+            except BrokenProcessPool:
+                self.retire_route_pool(pool, future)
+                if not retry:
+                    raise
+                pool = self.get_route_pool()
+                future = pool.submit(fn, *args, **kwargs)
+
+    def retire_route_pool(self, pool, future):
+        """
+        Retire a route pool because of a running task no request waits
+        for anymore : a new pool is forked by the next get_route_pool and
+        the processes of this one are terminated once its other tasks are
+        done (see RoutePool).
+        """
+        with self._route_pool_lock:
+            if self._route_pool is pool:
+                self._route_pool = None
+        pool.abandon(future)
+
+    def shutdown_route_pool(self):
+        """
+        Stop the processes of the route pool, they are forked again with
+        the current graph on the next get_routes.
+        """
+        if self._route_pool is not None:
+            self._route_pool.shutdown(wait=False)
+            self._route_pool = None
+            _pool_managers.pop(id(self), None)
 
 
 if __name__ == "__main__":
@@ -402,21 +1971,21 @@ if __name__ == "__main__":
 
     # ROUTE SEARCH
     print(f"[!] Start Shortest Route Search: {datetime.now()}")
-    route = nyc_manager.get_shortest_route(from_point, to_point)
+    route = nyc_manager.get_shortest_route(from_point, to_point).to_gdf()
     print("Shape : ", route.shape)
     print(route.head())
     print(route.columns)
     print(f"[!] End Shortest Route Search: {datetime.now()}")
 
     print(f"[!] Start Safest Route Search: {datetime.now()}")
-    route = nyc_manager.get_safest_route(from_point, to_point)
+    route = nyc_manager.get_safest_route(from_point, to_point).to_gdf()
     print("Shape : ", route.shape)
     print(route.head())
     print(route.columns)
     print(f"[!] End Safest Route Search: {datetime.now()}")
 
     print(f"[!] Start Dangerous Route Search: {datetime.now()}")
-    route = nyc_manager.get_most_dangerous_route(from_point, to_point)
+    route = nyc_manager.get_most_dangerous_route(from_point, to_point).to_gdf()
     print("Shape : ", route.shape)
     print(route.head())
     print(route.columns)
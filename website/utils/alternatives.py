@@ -0,0 +1,146 @@
+import numpy as np
+
+from utils.route_engine import NoPathException, haversine_to
+
+# Maximum part (of its length) of an alternative route on the previous routes
+MAX_OVERLAP = 0.5
+# Maximum weight of an alternative route, relative to the best route
+MAX_STRETCH = 1.25
+
+
+def alternative_routes(
+    engine,
+    source,
+    target,
+    weight="shortest",
+    k=3,
+    max_overlap=MAX_OVERLAP,
+    stretch=MAX_STRETCH,
+    heuristic=False,
+):
+    """
+    Returns up to k different routes between two nodes, the best first.
+
+    The alternatives are found with the via-node method, from two search
+    trees only :
+        - a forward tree from the source, going on up to stretch * the
+          weight of the best route once the target is settled (only on
+          the nodes whose route can be light enough with heuristic)
+        - a reverse tree from the target, on the nodes of the first one
+          whose route can be light enough (the distance from the source
+          of a node bounds the weight of its route)
+    The route through a node (best path to it, then best path from it) is
+    at most `stretch` times heavier than the best route when the sum of
+    its distances in the two trees is. The routes through the longest
+    plateaus (parts of a route in both trees) are tried first, one per
+    plateau. A route is kept if it has no loop and if at most
+    `max_overlap` of its length is on the routes already kept.
+
+    Parameters
+    ----------
+    engine : RouteEngine
+        route engine of the graph
+    source : int
+        index of the starting node
+    target : int
+        index of the destination node
+    weight : string
+        name of the engine profile
+    k : int
+        maximum number of routes
+    max_overlap : float
+        maximum part (0 to 1) of the length of a route on the previous ones
+    stretch : float
+        maximum weight of a route relative to the best route
+    heuristic : boolean
+        If True, the great-circle distance to the target bounds the
+        weight of the rest of the routes. It's only admissible when the
+        weights are lengths in meters.
+
+    Returns
+    -------
+    list
+        node indices of each route
+
+    Raises
+    ------
+    NoPathException
+        If no path exists between source and target.
+    """
+    potential = None
+    if heuristic:
+        # Slightly scaled down to absorb the rounding of the OSM lengths
+        potential = (haversine_to(engine.snapshot, target) * 0.999).tolist()
+    forward = engine.shortest_path_tree(
+        {source: 0},
+        weight=weight,
+        targets={target},
+        stretch=stretch,
+        potential=potential,
+    )
+    best = engine.tree_path(forward, target)
+    if k < 2 or source == target:
+        return [best]
+    limit = forward.dist[target] * stretch
+    potential = [float("inf")] * engine.n_nodes
+    for v, d in forward.dist.items():
+        potential[v] = d
+    backward = engine.shortest_path_tree(
+        {target: 0}, weight=weight, cutoff=limit, reverse=True, potential=potential
+    )
+    edge_length = np.asarray(engine.snapshot.edge_length)
+
+    def pair_lengths(pairs):
+        lengths = edge_length[engine.pair_edge[np.array(pairs, dtype=np.int64)]]
+        return np.nan_to_num(lengths).tolist()
+
+    # The edges v -> w on the best path to w and on the best path from v
+    # form "plateaus" : the routes through a long plateau are locally
+    # shortest on all its length, they are tried first
+    plateau_nodes = [
+        v
+        for v in backward.dist
+        if backward.pred[v] >= 0 and forward.pred[backward.pred[v]] == v
+    ]
+    plateau_length = dict(
+        zip(
+            plateau_nodes,
+            pair_lengths([backward.pred_pair[v] for v in plateau_nodes]),
+        )
+    )
+    plateaus = []
+    for v in plateau_nodes:
+        u = forward.pred[v]
+        if u in plateau_length and backward.pred[u] == v:
+            # Not the first node of its plateau
+            continue
+        if forward.dist[v] + backward.dist[v] > limit:
+            continue
+        length, w = 0.0, v
+        while w in plateau_length:
+            length += plateau_length[w]
+            w = backward.pred[w]
+        plateaus.append((-length, v))
+    plateaus.sort()
+
+    routes = [best]
+    used_pairs = {forward.pred_pair[v] for v in best[1:]}
+    for _, via in plateaus:
+        to_via = engine.tree_path(forward, via)
+        from_via = engine.tree_path(backward, via)
+        route = to_via + from_via[1:]
+        if len(set(route)) < len(route):
+            continue
+        pairs = [forward.pred_pair[v] for v in to_via[1:]]
+        pairs += [backward.pred_pair[v] for v in from_via[:-1]]
+        lengths = pair_lengths(pairs)
+        shared = sum(
+            length for pair, length in zip(pairs, lengths) if pair in used_pairs
+        )
+        if shared > max_overlap * sum(lengths):
+            continue
+        routes.append(route)
+        used_pairs.update(pairs)
+        if len(routes) == k:
+            break
+    return routes
@@ -0,0 +1,319 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.polyline import encode_polyline
+from utils.route_geometry import RouteGeometry
+
+# Columns of the origin-destination files, an "id" column is optional
+OD_COLUMNS = ["from_lat", "from_lng", "to_lat", "to_lng"]
+# Pairs read (and routes kept in memory) at once
+BATCH_CHUNKSIZE = 50000
+
+# Manager of the batch pool processes (see batch_routes)
+_batch_manager = None
+
+
+def read_od_pairs(filepath, chunksize=BATCH_CHUNKSIZE):
+    """
+    Read an origin-destination file by chunks.
+
+    Parameters
+    ----------
+    filepath : string or pathlib.Path
+        path to a CSV or Parquet (.parquet) file with the OD_COLUMNS
+    chunksize : int
+        number of pairs of each chunk
+
+    Returns
+    -------
+    iterator of pandas.DataFrame
+        id and OD_COLUMNS of the pairs, the id is the row number if the
+        file has no "id" column
+    """
+    if str(filepath).endswith(".parquet"):
+        # Imported here : pyarrow is only needed for the Parquet files
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(filepath)
+        columns = OD_COLUMNS + ["id"] * ("id" in parquet_file.schema.names)
+        chunks = (
+            batch.to_pandas()
+            for batch in parquet_file.iter_batches(
+                batch_size=chunksize, columns=columns
+            )
+        )
+    else:
+        chunks = pd.read_csv(
+            filepath,
+            chunksize=chunksize,
+            usecols=lambda column: column in OD_COLUMNS or column == "id",
+        )
+    first_row = 0
+    for chunk in chunks:
+        chunk = chunk.reset_index(drop=True)
+        if "id" not in chunk:
+            chunk["id"] = np.arange(first_row, first_row + len(chunk))
+        first_row += len(chunk)
+        yield chunk[["id"] + OD_COLUMNS]
+
+
+class _ResultWriter:
+    """Appends DataFrames to a CSV or Parquet (.parquet) file"""
+
+    def __init__(self, filepath):
+        self.filepath = str(filepath)
+        self._parquet_writer = None
+        self._header = True
+
+    def write(self, results):
+        if self.filepath.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(results, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.filepath, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            results.to_csv(
+                self.filepath,
+                mode="w" if self._header else "a",
+                header=self._header,
+                index=False,
+            )
+        self._header = False
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def route_from(route_manager, source, targets, profile="safest", geometry=False):
+    """
+    Compute the routes from one node to many nodes with one search tree.
+
+    Parameters
+    ----------
+    route_manager : NYCRouteManager
+        manager of the graph
+    source : int
+        index of the starting node
+    targets : list
+        (pair id, index of the destination node) of each route
+    profile : string
+        route type (name of an engine profile)
+    geometry : boolean
+        If True, add the line of each route encoded with encode_polyline
+
+    Returns
+    -------
+    list of dict
+        id, from_node and to_node (OSM IDs), length (meters), global_risk
+        (summed on the edges), cost (weight of the profile), n_edges and
+        optionally polyline of each route. The length, global_risk and cost
+        are NaN if there is no route.
+    """
+    snapshot, engine = route_manager.snapshot, route_manager.engine
+    tree = engine.shortest_path_tree(
+        {source: 0}, weight=profile, targets={target for _, target in targets}
+    )
+    rows = []
+    for pair_id, target in targets:
+        row = {
+            "id": pair_id,
+            "from_node": int(snapshot.node_ids[source]),
+            "to_node": int(snapshot.node_ids[target]),
+            "length": np.nan,
+            "global_risk": np.nan,
+            "cost": np.nan,
+            "n_edges": 0,
+        }
+        if geometry:
+            row["polyline"] = None
+        if target in tree.dist:
+            path = engine.tree_path(tree, target)
+            edges = engine.tree_edges(tree, path)
+            row["length"] = float(np.nansum(np.asarray(snapshot.edge_length)[edges]))
+            row["global_risk"] = float(
+                np.nansum(np.asarray(snapshot.edge_global_risk)[edges])
+            )
+            row["cost"] = tree.dist[target]
+            row["n_edges"] = len(edges)
+            if geometry:
+                route = snapshot.node_ids[path].tolist()
+                line = RouteGeometry.from_route(snapshot, engine, route).line_coords()
+                row["polyline"] = encode_polyline(line)
+        rows.append(row)
+    return rows
+
+
+def _route_from_pool(args):
+    """Entry point of the batch pool processes, see route_from"""
+    return route_from(_batch_manager, *args)
+
+
+def batch_routes(route_manager, chunks, profile="safest", geometry=False, workers=None):
+    """
+    Compute the routes of chunks of origin-destination pairs.
+
+    The points are snapped on their nearest node, the pairs of a chunk
+    are grouped by origin node and the routes of a group are computed with
+    one search tree (see route_from). The groups are shared between
+    processes forked from this one, they inherit the loaded graph.
+
+    Parameters
+    ----------
+    route_manager : NYCRouteManager
+        manager of the graph
+    chunks : iterable of pandas.DataFrame
+        id and OD_COLUMNS of the pairs, see read_od_pairs
+    profile : string
+        route type (name of an engine profile)
+    geometry : boolean
+        If True, add the line of each route encoded with encode_polyline
+    workers : int
+        number of processes, default : the number of CPUs, no pool if < 2
+
+    Returns
+    -------
+    iterator of pandas.DataFrame
+        the routes of each chunk, see route_from
+    """
+    global _batch_manager
+
+    if profile not in route_manager.route_types:
+        raise ValueError(f"Unknown route type : {profile}")
+    route_manager.refresh_snapshot()
+    workers = workers or multiprocessing.cpu_count()
+    pool = None
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        _batch_manager = route_manager
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        )
+    try:
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            index = route_manager.spatial_index
+            sources = index.nearest_nodes(
+                chunk["from_lat"].to_numpy(dtype=float),
+                chunk["from_lng"].to_numpy(dtype=float),
+            )
+            targets = index.nearest_nodes(
+                chunk["to_lat"].to_numpy(dtype=float),
+                chunk["to_lng"].to_numpy(dtype=float),
+            )
+            groups = {}
+            for pair_id, source, target in zip(
+                chunk["id"].tolist(), sources.tolist(), targets.tolist()
+            ):
+                groups.setdefault(source, []).append((pair_id, target))
+            tasks = [
+                (source, group, profile, geometry) for source, group in groups.items()
+            ]
+            if pool is None:
+                results = (route_from(route_manager, *task) for task in tasks)
+            else:
+                results = pool.map(
+                    _route_from_pool,
+                    tasks,
+                    chunksize=max(1, len(tasks) // (workers * 4)),
+                )
+            yield pd.DataFrame([row for rows in results for row in rows])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def route_od_file(
+    route_manager,
+    input_filepath,
+    output_filepath,
+    profile="safest",
+    geometry=False,
+    workers=None,
+    chunksize=BATCH_CHUNKSIZE,
+):
+    """
+    Compute the routes of the pairs of an origin-destination file and
+    write them chunk by chunk, only one chunk is held in memory.
+
+    Parameters
+    ----------
+    route_manager : NYCRouteManager
+        manager of the graph
+    input_filepath : string or pathlib.Path
+        CSV or Parquet file of the pairs, see read_od_pairs
+    output_filepath : string or pathlib.Path
+        CSV or Parquet (.parquet) file of the routes, see route_from
+    profile : string
+        route type (name of an engine profile)
+    geometry : boolean
+        If True, add the line of each route encoded with encode_polyline
+    workers : int
+        number of processes, see batch_routes
+    chunksize : int
+        number of pairs read at once
+
+    Returns
+    -------
+    int
+        number of pairs routed
+    """
+    writer = _ResultWriter(output_filepath)
+    n_pairs = 0
+    try:
+        for results in batch_routes(
+            route_manager,
+            read_od_pairs(input_filepath, chunksize),
+            profile=profile,
+            geometry=geometry,
+            workers=workers,
+        ):
+            writer.write(results)
+            n_pairs += len(results)
+    finally:
+        writer.close()
+    return n_pairs
+
+
+if __name__ == "__main__":
+    # Batch routing : PYTHONPATH=website python -m utils.batch pairs.csv routes.csv
+    import argparse
+
+    from datetime import datetime
+    from utils.NYCRouteManager import NYCRouteManager
+
+    parser = argparse.ArgumentParser(
+        description="Compute the routes of an origin-destination file"
+    )
+    parser.add_argument(
+        "input", help="CSV or Parquet file with " + ", ".join(OD_COLUMNS)
+    )
+    parser.add_argument("output", help="CSV or Parquet file of the routes")
+    parser.add_argument("--type", default="safest", help="route type")
+    parser.add_argument(
+        "--geometry", action="store_true", help="add the encoded line of the routes"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="processes")
+    parser.add_argument("--chunksize", type=int, default=BATCH_CHUNKSIZE)
+    args = parser.parse_args()
+
+    print(f"[!] Start Loading: {datetime.now()}")
+    nyc_manager = NYCRouteManager()
+    print(f"[!] Start Batch Routing: {datetime.now()}")
+    n_pairs = route_od_file(
+        nyc_manager,
+        args.input,
+        args.output,
+        profile=args.type,
+        geometry=args.geometry,
+        workers=args.workers,
+        chunksize=args.chunksize,
+    )
+    print(f"[!] End Batch Routing: {datetime.now()} ({n_pairs} pairs)")
@@ -0,0 +1,391 @@
+import json
+import resource
+import time
+
+import networkx as nx
+import numpy as np
+
+from os import makedirs, path
+
+from shapely.geometry import LineString
+
+from utils.route_engine import EARTH_RADIUS_M, NoPathException, haversine_to
+
+# Great-circle distance (in meters) between the ends of the pairs of each
+# band of the workload
+DISTANCE_BANDS = {
+    "short": (500, 2000),
+    "medium": (2000, 8000),
+    "long": (8000, 30000),
+}
+# Stages timed for each pair (render : the map of the routes of all profiles)
+STAGES = ("snap", "search", "geometry", "render")
+PERCENTILES = (50, 95, 99)
+# Side (in nodes) of the synthetic grid : about the size of the NYC graph
+SYNTHETIC_SIZE = 235
+# Files of the synthetic graph, kept between runs
+SYNTHETIC_DIRPATH = "data/benchmark"
+
+
+def synthetic_graph(size=SYNTHETIC_SIZE, seed=0):
+    """
+    Build a grid streets network of size x size intersections, about
+    150 m apart around NYC, with the attributes of the risk graph.
+
+    About 10 % of the streets are missing, 5 % of them have a parallel
+    edge and 30 % of them a curved geometry. The risk and the global_risk
+    are drawn at random (the global_risk with many streets without
+    crashes, as in the real data).
+
+    Parameters
+    ----------
+    size : int
+        number of nodes on each side of the grid
+    seed : int
+        seed of the random generator, the same seed gives the same graph
+
+    Returns
+    -------
+    networkx.MultiDiGraph
+    """
+    rng = np.random.default_rng(seed)
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    x = -74.15 + np.arange(size) * 0.0018 + rng.uniform(-2e-4, 2e-4, (size, size))
+    y = (
+        40.55
+        + np.arange(size)[:, None] * 0.00135
+        + rng.uniform(-2e-4, 2e-4, (size, size))
+    )
+    for i in range(size):
+        for j in range(size):
+            G.add_node(i * size + j + 1, x=float(x[i, j]), y=float(y[i, j]))
+
+    scale_y = np.pi / 180 * EARTH_RADIUS_M
+    scale_x = scale_y * np.cos(np.radians(40.7))
+    osmid = 1
+    for i in range(size):
+        for j in range(size):
+            for di, dj in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+                k, l = i + di, j + dj
+                if not (0 <= k < size and 0 <= l < size) or rng.random() < 0.1:
+                    continue
+                n_edges = 2 if rng.random() < 0.05 else 1
+                for _ in range(n_edges):
+                    dx = (x[k, l] - x[i, j]) * scale_x
+                    dy = (y[k, l] - y[i, j]) * scale_y
+                    data = {
+                        "osmid": osmid,
+                        "length": round(
+                            float(np.hypot(dx, dy)) * rng.uniform(1, 1.3), 3
+                        ),
+                        "risk": float(rng.random()),
+                        "global_risk": float(rng.choice([0, 0, 0, 1, 2, 4, 8, 12])),
+                        "name": f"Street {i}" if di == 0 else f"Avenue {j}",
+                    }
+                    if rng.random() < 0.3:
+                        mid = (
+                            (x[i, j] + x[k, l]) / 2 + 1e-4,
+                            (y[i, j] + y[k, l]) / 2 + 1e-4,
+                        )
+                        data["geometry"] = LineString(
+                            [(x[i, j], y[i, j]), mid, (x[k, l], y[k, l])]
+                        )
+                    G.add_edge(i * size + j + 1, k * size + l + 1, **data)
+                    osmid += 1
+    return G
+
+
+def synthetic_manager(dirpath=SYNTHETIC_DIRPATH, size=SYNTHETIC_SIZE, seed=0):
+    """
+    Returns a NYCRouteManager of a synthetic graph (see synthetic_graph),
+    whose files are kept in a directory : the graph and its snapshot are
+    only built by the first run.
+
+    The route cache is disabled and the routes are computed in this
+    process (no route pool).
+
+    Parameters
+    ----------
+    dirpath : string
+        directory of the graph files
+    size : int
+        number of nodes on each side of the grid
+    seed : int
+        seed of the random generator
+
+    Returns
+    -------
+    type
+        subclass of NYCRouteManager reading the synthetic files
+    """
+    from utils.NYCRouteManager import NYCRouteManager, save_osm
+
+    prefix = path.join(dirpath, f"synthetic_{size}_{seed}")
+    osm_filepath = f"{prefix}.osm"
+    if not path.isfile(osm_filepath):
+        makedirs(dirpath, exist_ok=True)
+        save_osm(synthetic_graph(size, seed), osm_filepath)
+    return type(
+        "SyntheticRouteManager",
+        (NYCRouteManager,),
+        {
+            # The synthetic graph already has its risk
+            "osm_filepath": osm_filepath,
+            "osm_risk_filepath": osm_filepath,
+            "snapshot_dirpath": f"{prefix}.snapshot",
+            "route_cache_filepath": None,
+            "route_workers": 0,
+        },
+    )
+
+
+def od_workload(snapshot, n_pairs=50, seed=0, bands=None):
+    """
+    Draw origin-destination pairs in each distance band.
+
+    The points are drawn near random nodes (up to about 30 m away), so
+    they are snapped as user points would be.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    n_pairs : int
+        number of pairs of each band
+    seed : int
+        seed of the random generator, the same seed gives the same pairs
+    bands : dict
+        name:(minimum, maximum) distance in meters, default : DISTANCE_BANDS
+
+    Returns
+    -------
+    list of tuple
+        (band, (lat, lng) from, (lat, lng) to) of each pair
+    """
+    rng = np.random.default_rng(seed)
+    bands = bands or DISTANCE_BANDS
+    node_x, node_y = np.asarray(snapshot.node_x), np.asarray(snapshot.node_y)
+
+    def point(node):
+        lat, lng = rng.uniform(-2.5e-4, 2.5e-4, 2) + (node_y[node], node_x[node])
+        return (float(lat), float(lng))
+
+    pairs = []
+    for band, (min_dist, max_dist) in bands.items():
+        n_band, n_tries = 0, 0
+        while n_band < n_pairs and n_tries < 100 * n_pairs:
+            n_tries += 1
+            source = int(rng.integers(snapshot.n_nodes))
+            dists = haversine_to(snapshot, source)
+            candidates = np.flatnonzero((dists >= min_dist) & (dists < max_dist))
+            if not len(candidates):
+                continue
+            pairs.append((band, point(source), point(int(rng.choice(candidates)))))
+            n_band += 1
+    return pairs
+
+
+def summarize(durations):
+    """
+    Returns the count, mean and PERCENTILES (p50, ...) in milliseconds of
+    durations in seconds.
+    """
+    if not durations:
+        return {"count": 0}
+    ms = np.asarray(durations) * 1000
+    stats = {"count": len(ms), "mean": float(ms.mean())}
+    for q, value in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+        stats[f"p{q}"] = float(value)
+    return stats
+
+
+def run_benchmark(route_manager, pairs, profiles=None, render=True):
+    """
+    Time the stages of the routes of a workload.
+
+    For each pair, the points are snapped once (snap), then the route of
+    each profile is searched without the route cache (search) and
+    converted to a RouteGeometry (geometry). The map of the routes of
+    all the profiles is rendered once (render), as /navigate does.
+
+    Parameters
+    ----------
+    route_manager : NYCRouteManager
+        manager of the graph
+    pairs : list
+        (band, from point, to point), see od_workload
+    profiles : list
+        route types, default : all the route types of the manager
+    render : boolean
+        If False, the maps are not rendered
+
+    Returns
+    -------
+    dict
+        name:statistics (see summarize) of each stage, and of the search
+        by profile (search:<profile>) and by band (search:<band>)
+    """
+    from utils.NYCMapManager import NYCMapManager
+
+    profiles = profiles or route_manager.route_types
+    map_manager = NYCMapManager()
+    durations = {stage: [] for stage in STAGES}
+    for profile in profiles:
+        durations[f"search:{profile}"] = []
+    for band in dict.fromkeys(band for band, _, _ in pairs):
+        durations[f"search:{band}"] = []
+    n_missing = 0
+    for band, point_from, point_to in pairs:
+        start = time.perf_counter()
+        node_from = route_manager.snap_point(point_from)
+        node_to = route_manager.snap_point(point_to)
+        durations["snap"].append(time.perf_counter() - start)
+
+        routes = {}
+        for profile in profiles:
+            start = time.perf_counter()
+            try:
+                route = route_manager._compute_route(node_from, node_to, profile)
+            except NoPathException:
+                n_missing += 1
+                continue
+            duration = time.perf_counter() - start
+            for name in ("search", f"search:{profile}", f"search:{band}"):
+                durations[name].append(duration)
+
+            start = time.perf_counter()
+            routes[profile] = route_manager.convert_route_to_geometry(route)
+            durations["geometry"].append(time.perf_counter() - start)
+
+        if render and routes:
+            start = time.perf_counter()
+            map_manager.get_map("From", "To", routes=routes)
+            durations["render"].append(time.perf_counter() - start)
+
+    results = {name: summarize(values) for name, values in durations.items()}
+    results["search"]["missing"] = n_missing
+    return results
+
+
+def peak_rss():
+    """Returns the peak resident memory of this process in bytes (Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def regressions(results, baseline, tolerance=0.2, percentile="p95"):
+    """
+    Compare the results of a benchmark with the ones of a baseline run.
+
+    Parameters
+    ----------
+    results : dict
+        results of benchmark (as written by the __main__ of this module)
+    baseline : dict
+        results of the baseline run
+    tolerance : float
+        accepted slowdown (0.2 : 20 % slower)
+    percentile : string
+        statistic of the stages compared
+
+    Returns
+    -------
+    list of tuple
+        (name, baseline value, value) of each stage slower than
+        tolerance, and of the mapped load time and peak_rss
+    """
+    slower = []
+    compared = [
+        (name, baseline["stages"][name].get(percentile), stats.get(percentile))
+        for name, stats in results["stages"].items()
+        if name in baseline["stages"]
+    ]
+    # The first load can include the build of the snapshot
+    compared.append(
+        ("load", baseline["load"].get("mapped"), results["load"].get("mapped"))
+    )
+    compared.append(("peak_rss", baseline.get("peak_rss"), results["peak_rss"]))
+    for name, old, new in compared:
+        if old and new is not None and new > old * (1 + tolerance):
+            slower.append((name, old, new))
+    return slower
+
+
+if __name__ == "__main__":
+    # Benchmark : PYTHONPATH=website python -m utils.benchmark [--real]
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Time the stages of the routes of a fixed workload"
+    )
+    parser.add_argument(
+        "--real", action="store_true", help="use the NYC graph instead of a grid"
+    )
+    parser.add_argument("--size", type=int, default=SYNTHETIC_SIZE, help="grid side")
+    parser.add_argument("--pairs", type=int, default=50, help="pairs by band")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-render", action="store_true", help="skip the maps")
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON file of the results to compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.real:
+        from utils.NYCRouteManager import NYCRouteManager as manager_class
+
+        manager_class.route_cache_filepath = None
+        manager_class.route_workers = 0
+    else:
+        manager_class = synthetic_manager(size=args.size, seed=args.seed)
+
+    load = {}
+    start = time.perf_counter()
+    route_manager = manager_class()
+    load["first"] = time.perf_counter() - start
+    # Second load : the snapshot is only mapped
+    start = time.perf_counter()
+    route_manager = manager_class()
+    load["mapped"] = time.perf_counter() - start
+
+    pairs = od_workload(route_manager.snapshot, args.pairs, seed=args.seed)
+    stages = run_benchmark(route_manager, pairs, render=not args.no_render)
+    results = {
+        "graph": {
+            "source": route_manager.osm_risk_filepath,
+            "n_nodes": route_manager.snapshot.n_nodes,
+            "n_edges": route_manager.snapshot.n_edges,
+            "n_pairs": len(pairs),
+            "seed": args.seed,
+        },
+        "load": load,
+        "stages": stages,
+        "peak_rss": peak_rss(),
+    }
+
+    graph = results["graph"]
+    print(
+        f"[!] {graph['n_nodes']} nodes, {graph['n_edges']} edges, "
+        f"{graph['n_pairs']} pairs"
+    )
+    print(f"[!] Load : {load['first']:.2f} s, mapped : {load['mapped']:.2f} s")
+    print(f"{'stage':<24}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, stats in stages.items():
+        if stats["count"]:
+            print(
+                f"{name:<24}{stats['count']:>7}"
+                + "".join(
+                    f"{stats[key]:>10.2f}" for key in ("mean", "p50", "p95", "p99")
+                )
+            )
+    print(f"[!] Peak RSS : {results['peak_rss'] / 2**20:.0f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for name, old, new in slower:
+            print(f"[!] Regression of {name} : {old:.2f} -> {new:.2f}")
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,400 @@
+import hashlib
+
+import numpy as np
+
+from heapq import heappush, heappop
+from os import path
+
+from utils.route_engine import NoPathException
+
+
+def weights_digest(weights):
+    """
+    Digest of a weight array, used to check that a hierarchy has been
+    contracted with the weights currently used by the engine.
+    """
+    return hashlib.sha1(np.ascontiguousarray(weights, dtype=float)).hexdigest()
+
+
+def graph_digest(indptr, targets):
+    """
+    Digest of the CSR arrays of a graph, used to check that a hierarchy has
+    been contracted on the node indices currently used by the engine (a
+    snapshot reindexed on a shared node table keeps its weights, not its
+    node indices).
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(indptr, dtype=np.int64))
+    digest.update(np.ascontiguousarray(targets, dtype=np.int64))
+    return digest.hexdigest()
+
+
+def _witness_search(out, source, excluded, max_cost, max_settled):
+    """
+    Dijkstra from source in the remaining graph, without the node being
+    contracted, stopped after max_cost or max_settled nodes.
+    """
+    dist = {source: 0}
+    fringe = [(0, source)]
+    settled = 0
+    while fringe:
+        d, u = heappop(fringe)
+        if d > dist[u]:
+            continue
+        if d > max_cost or settled >= max_settled:
+            break
+        settled += 1
+        for x, w in out[u].items():
+            if x == excluded:
+                continue
+            x_dist = d + w
+            if x_dist < dist.get(x, float("inf")):
+                dist[x] = x_dist
+                heappush(fringe, (x_dist, x))
+    return dist
+
+
+def _csr(n_nodes, source, target, weight):
+    """Sort edges by source and return (indptr, target, weight) arrays"""
+    source = np.asarray(source, dtype=np.int64)
+    order = np.argsort(source, kind="stable")
+    indptr = np.searchsorted(source[order], np.arange(n_nodes + 1))
+    return (
+        indptr.astype(np.int64),
+        np.asarray(target, dtype=np.int32)[order],
+        np.asarray(weight, dtype=float)[order],
+    )
+
+
+class ContractionHierarchy:
+    """
+    Contraction Hierarchy of a weighted graph.
+
+    The nodes are contracted one by one (by increasing edge difference),
+    adding a shortcut u -> w through the contracted node v when no other
+    path u -> w is as short as u -> v -> w. The queries are then answered
+    by a bidirectional Dijkstra which only goes "up" the hierarchy and the
+    shortcuts of the resulting path are unpacked to the original nodes.
+
+    The node indices are the ones of the RouteEngine the hierarchy has been
+    built from : `graph_digest` identifies its arrays and `weights_digest`
+    the contracted weights.
+    """
+
+    array_names = (
+        "rank",
+        "up_indptr",
+        "up_target",
+        "up_weight",
+        "down_indptr",
+        "down_target",
+        "down_weight",
+        "shortcut_keys",
+        "shortcut_middle",
+    )
+
+    def __init__(self, arrays, weights_digest=None, graph_digest=None):
+        """
+        Initialize the ContractionHierarchy
+
+        Parameters
+        ----------
+        arrays : dict
+            name:numpy.ndarray for each name of `array_names`
+        weights_digest : string
+            digest of the contracted weights
+        graph_digest : string
+            digest of the contracted graph (see graph_digest)
+        """
+        for name in self.array_names:
+            setattr(self, name, np.asarray(arrays[name]))
+        self.weights_digest = weights_digest
+        self.graph_digest = graph_digest
+        self.n_nodes = len(self.rank)
+        self._up = (self.up_indptr.tolist(), self.up_target.tolist())
+        self._up_weight = self.up_weight.tolist()
+        self._down = (self.down_indptr.tolist(), self.down_target.tolist())
+        self._down_weight = self.down_weight.tolist()
+
+    @classmethod
+    def build(cls, indptr, targets, weights, max_settled=500, verbose=False):
+        """
+        Contract a graph.
+
+        Parameters
+        ----------
+        indptr : numpy.ndarray
+            CSR index of the edges of each node
+        targets : numpy.ndarray
+            target node of each edge
+        weights : numpy.ndarray
+            weight of each edge, the edges with a NaN or infinite weight
+            are ignored
+        max_settled : int
+            maximum number of nodes settled by a witness search, a lower
+            value makes the preprocessing faster but adds more shortcuts
+        verbose : boolean
+            If True, print the progress of the contraction
+
+        Returns
+        -------
+        ContractionHierarchy
+        """
+        n_nodes = len(indptr) - 1
+        indptr, targets = np.asarray(indptr).tolist(), np.asarray(targets).tolist()
+        digest = weights_digest(weights)
+        graph = graph_digest(indptr, targets)
+        weights = np.asarray(weights, dtype=float).tolist()
+
+        out = [{} for _ in range(n_nodes)]
+        inc = [{} for _ in range(n_nodes)]
+        for u in range(n_nodes):
+            for i in range(indptr[u], indptr[u + 1]):
+                v, w = targets[i], weights[i]
+                if v == u or not w < float("inf"):
+                    continue
+                if w < out[u].get(v, float("inf")):
+                    out[u][v] = w
+                    inc[v][u] = w
+
+        middle = {}
+        deleted = [0] * n_nodes
+
+        def shortcuts_of(v):
+            shortcuts = []
+            for u, u_weight in inc[v].items():
+                costs = {x: u_weight + w for x, w in out[v].items() if x != u}
+                if not costs:
+                    continue
+                dist = _witness_search(out, u, v, max(costs.values()), max_settled)
+                for x, cost in costs.items():
+                    if dist.get(x, float("inf")) > cost:
+                        shortcuts.append((u, x, cost))
+            return shortcuts
+
+        def priority(v, shortcuts):
+            return len(shortcuts) - len(inc[v]) - len(out[v]) + deleted[v]
+
+        queue = []
+        for v in range(n_nodes):
+            heappush(queue, (priority(v, shortcuts_of(v)), v))
+
+        rank = [0] * n_nodes
+        up_edges, down_edges = ([], [], []), ([], [], [])
+        contracted = 0
+        while queue:
+            _, v = heappop(queue)
+            if rank[v]:
+                continue
+            # Lazy update : contract v only if it's still the best candidate
+            shortcuts = shortcuts_of(v)
+            current = priority(v, shortcuts)
+            if queue and current > queue[0][0]:
+                heappush(queue, (current, v))
+                continue
+
+            contracted += 1
+            rank[v] = contracted
+            for x, w in out[v].items():
+                up_edges[0].append(v)
+                up_edges[1].append(x)
+                up_edges[2].append(w)
+                del inc[x][v]
+                deleted[x] += 1
+            for u, w in inc[v].items():
+                down_edges[0].append(v)
+                down_edges[1].append(u)
+                down_edges[2].append(w)
+                del out[u][v]
+                deleted[u] += 1
+            for u, x, cost in shortcuts:
+                if cost < out[u].get(x, float("inf")):
+                    out[u][x] = cost
+                    inc[x][u] = cost
+                    middle[(u, x)] = v
+            out[v], inc[v] = {}, {}
+            if verbose and contracted % 5000 == 0:
+                print(f"[!] Contracted {contracted}/{n_nodes} nodes")
+
+        keys = sorted(u * n_nodes + x for u, x in middle)
+        arrays = {"rank": np.array(rank, dtype=np.int64)}
+        arrays["up_indptr"], arrays["up_target"], arrays["up_weight"] = _csr(
+            n_nodes, *up_edges
+        )
+        arrays["down_indptr"], arrays["down_target"], arrays["down_weight"] = _csr(
+            n_nodes, *down_edges
+        )
+        arrays["shortcut_keys"] = np.array(keys, dtype=np.int64)
+        arrays["shortcut_middle"] = np.array(
+            [middle[divmod(key, n_nodes)] for key in keys], dtype=np.int64
+        )
+        return cls(arrays, weights_digest=digest, graph_digest=graph)
+
+    def save(self, filepath):
+        """
+        Save the hierarchy to a `.npz` file.
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the file including extension
+        """
+        arrays = {name: getattr(self, name) for name in self.array_names}
+        with open(filepath, "wb") as f:
+            np.savez(
+                f,
+                weights_digest=np.array(self.weights_digest),
+                graph_digest=np.array(self.graph_digest),
+                **arrays,
+            )
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load a hierarchy saved with `save`.
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the file including extension
+
+        Returns
+        -------
+        ContractionHierarchy or None if the file doesn't exist
+        """
+        if not path.isfile(filepath):
+            return None
+        with np.load(filepath) as data:
+            arrays = {name: data[name] for name in cls.array_names}
+            digest = str(data["weights_digest"])
+            # Hierarchies saved without it are contracted on unknown indices
+            graph = str(data["graph_digest"]) if "graph_digest" in data else None
+        return cls(arrays, weights_digest=digest, graph_digest=graph)
+
+    def shortest_path(self, source, target):
+        """
+        Returns the shortest weighted path from source to target.
+
+        Parameters
+        ----------
+        source : int
+            index of the starting node
+        target : int
+            index of the destination node
+
+        Returns
+        -------
+        list
+            indices of the nodes of the path
+
+        Raises
+        ------
+        NoPathException
+            If no path exists between source and target.
+        """
+        if source == target:
+            return [source]
+        return self.shortest_path_between({source: 0}, {target: 0})
+
+    def shortest_path_between(self, sources, targets):
+        """
+        Returns the shortest weighted path from any of the sources to any
+        of the targets.
+
+        See RouteEngine.shortest_path_between for more information.
+
+        Parameters
+        ----------
+        sources : dict
+            index of a starting node:offset
+        targets : dict
+            index of a destination node:offset
+
+        Returns
+        -------
+        list
+            indices of the nodes of the path
+
+        Raises
+        ------
+        NoPathException
+            If no path exists between the sources and the targets.
+        """
+        inf = float("inf")
+        dists = (dict(sources), dict(targets))
+        preds = ({node: -1 for node in sources}, {node: -1 for node in targets})
+        fringes = (
+            sorted((d, node) for node, d in sources.items()),
+            sorted((d, node) for node, d in targets.items()),
+        )
+        graphs = ((self._up, self._up_weight), (self._down, self._down_weight))
+        best, meeting = inf, -1
+        for node in dists[0]:
+            if node in dists[1] and dists[0][node] + dists[1][node] < best:
+                best, meeting = dists[0][node] + dists[1][node], node
+
+        while True:
+            searching = False
+            for side in (0, 1):
+                fringe, dist, pred = fringes[side], dists[side], preds[side]
+                if not fringe or fringe[0][0] >= best:
+                    continue
+                searching = True
+                d, v = heappop(fringe)
+                if d > dist[v]:
+                    continue
+                (indptr, targets), weights = graphs[side]
+                other = dists[1 - side]
+                for i in range(indptr[v], indptr[v + 1]):
+                    x = targets[i]
+                    x_dist = d + weights[i]
+                    if x_dist < dist.get(x, inf):
+                        dist[x] = x_dist
+                        pred[x] = v
+                        heappush(fringe, (x_dist, x))
+                        if x in other and x_dist + other[x] < best:
+                            best, meeting = x_dist + other[x], x
+            if not searching:
+                break
+
+        if meeting < 0:
+            raise NoPathException(f"No path between {sources} and {targets}")
+
+        up_path = [meeting]
+        while preds[0][up_path[-1]] >= 0:
+            up_path.append(preds[0][up_path[-1]])
+        up_path.reverse()
+        down_path = [meeting]
+        while preds[1][down_path[-1]] >= 0:
+            down_path.append(preds[1][down_path[-1]])
+        return self._unpack(up_path + down_path[1:])
+
+    def _unpack(self, path):
+        """Replace the shortcuts of a path by the original nodes"""
+        nodes = [path[0]]
+        for u, w in zip(path[:-1], path[1:]):
+            stack = [(u, w)]
+            while stack:
+                a, b = stack.pop()
+                key = a * self.n_nodes + b
+                i = np.searchsorted(self.shortcut_keys, key)
+                if i < len(self.shortcut_keys) and self.shortcut_keys[i] == key:
+                    m = int(self.shortcut_middle[i])
+                    stack.append((m, b))
+                    stack.append((a, m))
+                else:
+                    nodes.append(b)
+        return nodes
+
+
+if __name__ == "__main__":
+    # Offline preprocessing : PYTHONPATH=website python -m utils.contraction
+    from datetime import datetime
+    from utils.NYCRouteManager import NYCRouteManager
+
+    nyc_manager = NYCRouteManager()
+    for profile in nyc_manager.hierarchy_profiles:
+        if profile not in nyc_manager.profiles:
+            continue
+        print(f"[!] Start Contraction {profile}: {datetime.now()}")
+        nyc_manager.build_hierarchy(profile, verbose=True)
+        print(f"[!] End Contraction {profile}: {datetime.now()}")
@@ -1,5 +1,21 @@
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+import threading
+
+from utils.geocoder import (
+    CachedGeocoder,
+    GeocoderChain,
+    LocalGeocoder,
+    NominatimGeocoder,
+)
+
+# Offline index of the streets, see utils/geocoder.py
+GEOCODER_FILEPATH = "data/NYC_geocoder.npz"
+# Results of the remote geocoder
+GEOCODE_CACHE_FILEPATH = "data/geocode_cache.sqlite"
+
+# Geocoder used by get_coordinates (created on the first call)
+_geocoder = None
+# The first calls come from several geocoding threads at once
+_geocoder_lock = threading.Lock()
 
 
 class LocationUnknownException(Exception):
@@ -10,18 +26,49 @@ class LocationNotInNyException(Exception):
     pass
 
 
-def __do_geocode(address: str, attempt: int = 1, max_attempts: int = 5) -> object:
-    geolocator = Nominatim(user_agent="nyc-navigation")
-    try:
-        return geolocator.geocode(address)
-    except GeocoderTimedOut:
-        if attempt <= max_attempts:
-            return __do_geocode(address, attempt=attempt + 1)
-        raise
+def default_geocoder():
+    """
+    Returns the local index of the streets (if it has been built) with
+    the cached Nominatim geocoder as fallback.
+    """
+    geocoders = []
+    local_geocoder = LocalGeocoder.load(GEOCODER_FILEPATH)
+    if local_geocoder is not None:
+        geocoders.append(local_geocoder)
+    geocoders.append(CachedGeocoder(NominatimGeocoder(), GEOCODE_CACHE_FILEPATH))
+    return GeocoderChain(geocoders)
+
+
+def get_geocoder():
+    """Returns the geocoder used by get_coordinates"""
+    global _geocoder
+
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                _geocoder = default_geocoder()
+    return _geocoder
+
+
+def set_geocoder(geocoder):
+    """
+    Replace the geocoder used by get_coordinates (for instance by a
+    StubGeocoder in the tests).
+
+    Parameters
+    ----------
+    geocoder : object
+        geocoder with a `geocode(address)` method returning an object with
+        latitude, longitude and address attributes or None
+    """
+    global _geocoder
+
+    with _geocoder_lock:
+        _geocoder = geocoder
 
 
 def get_coordinates(address: str):
-    location = __do_geocode(address)
+    location = get_geocoder().geocode(address)
     if location == None:
         # return "unknown address"
         raise LocationUnknownException
@@ -0,0 +1,325 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from os import path
+
+from utils.risk_builder import RAW_COLUMNS, crash_timestamps, read_crashes
+
+# Numeric columns of a crash dataset and their dtype
+NUMERIC_COLUMNS = dict(
+    {
+        "latitude": np.float64,
+        "longitude": np.float64,
+        "year": np.int16,
+        "month": np.int8,
+        "day": np.int8,
+        "day_of_week": np.int8,
+        "hour": np.int8,
+        "minute": np.int8,
+        "zip_code": np.int32,
+    },
+    **{column: np.int16 for column in RAW_COLUMNS.values()},
+)
+# Categorical columns of a crash dataset and the vocabulary of their codes
+CATEGORY_COLUMNS = dict(
+    {
+        "borough": "borough",
+        "on_street_name": "street",
+        "off_street_name": "street",
+    },
+    **{f"contributing_factor_vehicle_{i}": "contributing_factor" for i in range(1, 6)},
+    **{f"vehicle_type_code_{i}": "vehicle_type" for i in range(1, 6)},
+)
+# Dtype of the codes of each vocabulary
+CODE_DTYPES = {
+    "borough": np.int8,
+    "street": np.int32,
+    "contributing_factor": np.int16,
+    "vehicle_type": np.int16,
+}
+# Code of the missing values of the categorical columns
+MISSING_CODE = -1
+
+# Raw columns read by ingest
+INGEST_COLUMNS = (
+    ["latitude", "longitude", "crash_date", "crash_time", "zip_code"]
+    + list(RAW_COLUMNS.values())
+    + list(CATEGORY_COLUMNS)
+)
+
+
+class CrashDataset:
+    """
+    Columnar, memory-mappable copy of the NYPD collisions history.
+
+    Each column is a `.npy` file of a directory (as the GraphSnapshot) :
+        - the dates are split in small integers (year, month, day,
+          day_of_week, hour, minute)
+        - the victims are counted in int16, the zip codes in int32 (0 if
+          unknown)
+        - the names (borough, streets, contributing factors, vehicle
+          types) are stored as codes in the vocabularies of meta.json, -1
+          if missing, instead of one float column per value
+
+    Loading a dataset only maps the files, read_crashes reads it by chunks
+    as a crash file.
+    """
+
+    format_version = 1
+    meta_filename = "meta.json"
+
+    def __init__(self, columns, meta):
+        """
+        Initialize the CrashDataset
+
+        Parameters
+        ----------
+        columns : dict
+            name:numpy.ndarray, the NUMERIC_COLUMNS and the codes of the
+            CATEGORY_COLUMNS
+        meta : dict
+            n_rows and the vocabularies (name:list of values) of the codes
+        """
+        self.columns = columns
+        self.meta = meta
+
+    def __len__(self):
+        return self.meta["n_rows"]
+
+    @staticmethod
+    def _encode(values, vocabulary):
+        """
+        Codes of values in a vocabulary (value:code), the new values are
+        added to it.
+        """
+        values = values.astype(object).where(values.notna(), None)
+        values = values.map(
+            lambda value: (str(value).strip() or None) if value is not None else None
+        )
+        for value in values.dropna().unique():
+            if value not in vocabulary:
+                vocabulary[value] = len(vocabulary)
+        codes = values.map(vocabulary).fillna(MISSING_CODE)
+        return codes.to_numpy(dtype=np.int32)
+
+    @staticmethod
+    def _parse_times(chunk):
+        """
+        Date columns of the crashes parsed from crash_date ("2020-12-03" or
+        "2020-12-03T00:00:00.000") and crash_time ("13:37" or "13:37:00").
+
+        Returns
+        -------
+        pandas.DataFrame
+            year, month, day, day_of_week, hour and minute, NaN if the date
+            is invalid
+        """
+        date = pd.to_datetime(chunk["crash_date"], errors="coerce")
+        time = chunk["crash_time"].astype(str).str.split(":", n=2, expand=True)
+        hour = pd.to_numeric(time[0], errors="coerce")
+        minute = pd.to_numeric(time[1], errors="coerce") if 1 in time else np.nan
+        return pd.DataFrame(
+            {
+                "year": date.dt.year,
+                "month": date.dt.month,
+                "day": date.dt.day,
+                "day_of_week": date.dt.dayofweek,
+                "hour": hour.where((hour >= 0) & (hour < 24)),
+                "minute": minute,
+            },
+            index=chunk.index,
+        )
+
+    @classmethod
+    def ingest(cls, filepath, dirpath, chunksize=500000):
+        """
+        Build a dataset from the raw NYPD export, by chunks : only one
+        chunk and the vocabularies are held in memory.
+
+        The rows without coordinates or with an invalid date are dropped.
+        The columns are appended chunk by chunk to raw files, then turned
+        into `.npy` files. The dataset is written in a temporary directory
+        which replaces the previous one once complete.
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the raw CSV export
+        dirpath : string or pathlib.Path
+            path to the dataset directory
+        chunksize : int
+            number of rows read at once
+
+        Returns
+        -------
+        CrashDataset
+            the saved dataset, mapped
+        """
+        dirpath = str(dirpath).rstrip(os.sep)
+        tmp_dirpath = f"{dirpath}.tmp"
+        os.makedirs(tmp_dirpath, exist_ok=True)
+        dtypes = dict(
+            NUMERIC_COLUMNS, **{c: CODE_DTYPES[v] for c, v in CATEGORY_COLUMNS.items()}
+        )
+        files = {
+            name: open(path.join(tmp_dirpath, f"{name}.bin"), "wb") for name in dtypes
+        }
+        vocabularies = {name: {} for name in set(CATEGORY_COLUMNS.values())}
+        n_rows, n_dropped = 0, 0
+        first_hour, last_hour = None, None
+        try:
+            for chunk in read_crashes(filepath, chunksize, columns=INGEST_COLUMNS):
+                times = cls._parse_times(chunk)
+                valid = times[["year", "month", "day", "hour"]].notna().all(axis=1)
+                n_dropped += int((~valid).sum())
+                chunk, times = chunk[valid], times[valid].fillna(0)
+                if not len(chunk):
+                    continue
+                values = {
+                    "latitude": chunk["latitude"],
+                    "longitude": chunk["longitude"],
+                    "zip_code": pd.to_numeric(chunk["zip_code"], errors="coerce"),
+                }
+                values.update(times)
+                for column in RAW_COLUMNS.values():
+                    values[column] = pd.to_numeric(chunk[column], errors="coerce")
+                for name, dtype in NUMERIC_COLUMNS.items():
+                    array = values[name].fillna(0).to_numpy(dtype=dtype)
+                    files[name].write(array.tobytes())
+                for name, vocabulary in CATEGORY_COLUMNS.items():
+                    codes = cls._encode(chunk[name], vocabularies[vocabulary])
+                    if len(vocabularies[vocabulary]) > np.iinfo(dtypes[name]).max:
+                        raise ValueError(f"Too many values of {vocabulary}")
+                    files[name].write(codes.astype(dtypes[name]).tobytes())
+
+                hours = crash_timestamps(times)
+                if first_hour is None:
+                    first_hour, last_hour = hours.min(), hours.max()
+                first_hour = min(first_hour, hours.min())
+                last_hour = max(last_hour, hours.max())
+                n_rows += len(chunk)
+        finally:
+            for f in files.values():
+                f.close()
+
+        for name, dtype in dtypes.items():
+            bin_filepath = path.join(tmp_dirpath, f"{name}.bin")
+            with open(path.join(tmp_dirpath, f"{name}.npy"), "wb") as f:
+                np.lib.format.write_array_header_1_0(
+                    f,
+                    {
+                        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                        "fortran_order": False,
+                        "shape": (n_rows,),
+                    },
+                )
+                with open(bin_filepath, "rb") as bin_file:
+                    shutil.copyfileobj(bin_file, f, 2**24)
+            os.remove(bin_filepath)
+        meta = {
+            "format": cls.format_version,
+            "n_rows": n_rows,
+            "n_dropped": n_dropped,
+            "first_hour": None if first_hour is None else int(first_hour),
+            "last_hour": None if last_hour is None else int(last_hour),
+            "source": path.abspath(str(filepath)),
+            "categories": {
+                name: list(vocabulary) for name, vocabulary in vocabularies.items()
+            },
+        }
+        with open(path.join(tmp_dirpath, cls.meta_filename), "w") as f:
+            json.dump(meta, f)
+
+        if path.isdir(dirpath):
+            old_dirpath = f"{dirpath}.old"
+            os.rename(dirpath, old_dirpath)
+            os.rename(tmp_dirpath, dirpath)
+            shutil.rmtree(old_dirpath)
+        else:
+            os.rename(tmp_dirpath, dirpath)
+        return cls.load(dirpath)
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode="r"):
+        """
+        Load a dataset saved with `ingest`.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the dataset directory
+        mmap_mode : string or None
+            see numpy.load, default : the files are mapped read-only
+
+        Returns
+        -------
+        CrashDataset
+        """
+        dirpath = str(dirpath)
+        with open(path.join(dirpath, cls.meta_filename)) as f:
+            meta = json.load(f)
+        if meta.get("format") != cls.format_version:
+            raise ValueError(f"Unsupported crash dataset format : {meta.get('format')}")
+        columns = {
+            name: np.load(path.join(dirpath, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in list(NUMERIC_COLUMNS) + list(CATEGORY_COLUMNS)
+        }
+        return cls(columns, meta)
+
+    def categories(self, column):
+        """Returns the values of the codes of a categorical column"""
+        return self.meta["categories"][CATEGORY_COLUMNS[column]]
+
+    def chunks(self, columns=None, chunksize=500000):
+        """
+        Read the dataset by chunks, as read_crashes reads a crash file.
+
+        Parameters
+        ----------
+        columns : list
+            columns to read, the ones not in the dataset are ignored,
+            default : all
+        chunksize : int
+            number of rows read at once
+
+        Yields
+        ------
+        pandas.DataFrame
+            the NUMERIC_COLUMNS and the values (None if missing) of the
+            CATEGORY_COLUMNS
+        """
+        if columns is None:
+            columns = list(NUMERIC_COLUMNS) + list(CATEGORY_COLUMNS)
+        columns = [c for c in columns if c in self.columns]
+        values = {
+            c: np.array(self.categories(c) + [None], dtype=object)
+            for c in columns
+            if c in CATEGORY_COLUMNS
+        }
+        for start in range(0, len(self), chunksize):
+            chunk = {}
+            for name in columns:
+                array = self.columns[name][start : start + chunksize]
+                # The code -1 (missing) picks the last value : None
+                chunk[name] = values[name][array] if name in values else array
+            yield pd.DataFrame(chunk)
+
+
+if __name__ == "__main__":
+    # Crash dataset : PYTHONPATH=website python -m utils.crash_dataset raw.csv dir
+    import sys
+
+    from datetime import datetime
+
+    if len(sys.argv) != 3:
+        sys.exit("Usage : python -m utils.crash_dataset <raw CSV> <dataset directory>")
+    print(f"[!] Start Crash Dataset: {datetime.now()}")
+    dataset = CrashDataset.ingest(sys.argv[1], sys.argv[2])
+    print(
+        f"[!] End Crash Dataset: {datetime.now()} ({len(dataset)} crashes, "
+        f"{dataset.meta['n_dropped']} dropped)"
+    )
@@ -0,0 +1,224 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from os import path
+
+from utils.risk_builder import crash_severity, read_crashes
+
+# Directory of the tiles, served by Flask as /static/crash_tiles
+CRASH_TILES_DIRPATH = "website/static/crash_tiles"
+# Size (in pixels) of the tiles and of the cells the crashes are summed in
+TILE_SIZE = 256
+CELL_SIZE = 8
+# Zoom levels of the tiles, the map scales the last one on higher zooms
+ZOOMS = tuple(range(10, 17))
+# Colours of the cells from the lowest to the highest severity (RGBA)
+COLOR_STOPS = np.array(
+    [[255, 195, 0, 110], [199, 0, 57, 170], [88, 24, 69, 220]], dtype=float
+)
+
+
+def mercator_pixels(lats, lngs, zoom):
+    """
+    Web Mercator pixel coordinates of points at a zoom level (the ones of
+    the OSM and Leaflet tiles).
+
+    Parameters
+    ----------
+    lats : numpy.ndarray
+        latitudes of the points
+    lngs : numpy.ndarray
+        longitudes of the points
+    zoom : int
+        zoom level
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray)
+        x and y pixel coordinates
+    """
+    scale = TILE_SIZE * 2**zoom
+    lats = np.radians(np.clip(lats, -85.05112878, 85.05112878))
+    x = (np.asarray(lngs, dtype=float) + 180) / 360 * scale
+    y = (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / np.pi) / 2 * scale
+    return x, y
+
+
+def aggregate_crashes(chunks, zooms=ZOOMS, severity=crash_severity):
+    """
+    Sum the number and the severity of the crashes in the cells of the
+    tiles of several zoom levels.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        crashes, see risk_builder.read_crashes
+    zooms : list
+        zoom levels
+    severity : function
+        returns the severity of each crash of a DataFrame
+
+    Returns
+    -------
+    dict
+        zoom:(cell keys, count, severity) of the cells with crashes, the key
+        of a cell is `cell_y * cells_per_row + cell_x`
+    """
+    cells = {
+        zoom: (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)) for zoom in zooms
+    }
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        lats = chunk["latitude"].to_numpy(dtype=float)
+        lngs = chunk["longitude"].to_numpy(dtype=float)
+        chunk_severity = severity(chunk)
+        for zoom in zooms:
+            cells_per_row = TILE_SIZE * 2**zoom // CELL_SIZE
+            x, y = mercator_pixels(lats, lngs, zoom)
+            chunk_keys = (y // CELL_SIZE).astype(np.int64) * cells_per_row + (
+                x // CELL_SIZE
+            ).astype(np.int64)
+            keys, counts, severities = cells[zoom]
+            # Reduced after each chunk, the memory is bounded by the cells
+            keys, inverse = np.unique(
+                np.concatenate((keys, chunk_keys)), return_inverse=True
+            )
+            inverse = inverse.ravel()
+            counts = np.bincount(
+                inverse, weights=np.concatenate((counts, np.ones(len(chunk_keys))))
+            )
+            severities = np.bincount(
+                inverse, weights=np.concatenate((severities, chunk_severity))
+            )
+            cells[zoom] = (keys, counts, severities)
+    return cells
+
+
+def cell_colors(values, max_value):
+    """RGBA colour of cells from their value, on a logarithmic scale"""
+    scale = np.log1p(values) / np.log1p(max(max_value, 1))
+    position = np.clip(scale, 0, 1) * (len(COLOR_STOPS) - 1)
+    low = np.minimum(position.astype(int), len(COLOR_STOPS) - 2)
+    fraction = (position - low)[:, None]
+    colors = COLOR_STOPS[low] * (1 - fraction) + COLOR_STOPS[low + 1] * fraction
+    return colors.astype(np.uint8)
+
+
+def write_tiles(cells, dirpath=CRASH_TILES_DIRPATH):
+    """
+    Render the aggregated crashes as PNG tiles `{dirpath}/{z}/{x}/{y}.png`,
+    only the tiles with crashes are written.
+
+    The colour of a cell is given by the severity of its crashes, scaled
+    on the 99th percentile of the cells of the zoom level. An index.json
+    with the zoom levels and the extent of the tiles is written too.
+
+    Parameters
+    ----------
+    cells : dict
+        zoom:(cell keys, count, severity), see aggregate_crashes
+    dirpath : string or pathlib.Path
+        path to the tiles directory
+
+    Returns
+    -------
+    int
+        number of tiles written
+    """
+    # Imported here : Pillow is only needed to render the tiles
+    from PIL import Image
+
+    cells_per_tile = TILE_SIZE // CELL_SIZE
+    index = {"tile_size": TILE_SIZE, "cell_size": CELL_SIZE, "zooms": {}}
+    n_tiles = 0
+    for zoom, (keys, counts, severities) in cells.items():
+        if not len(keys):
+            continue
+        cells_per_row = TILE_SIZE * 2**zoom // CELL_SIZE
+        cell_y, cell_x = np.divmod(keys, cells_per_row)
+        tile_x, tile_y = cell_x // cells_per_tile, cell_y // cells_per_tile
+        colors = cell_colors(severities, np.percentile(severities, 99))
+
+        tile_keys = tile_x * 2**zoom + tile_y
+        order = np.argsort(tile_keys, kind="stable")
+        starts = np.flatnonzero(np.diff(tile_keys[order], prepend=-1))
+        for cells_of_tile in np.split(order, starts[1:]):
+            x, y = int(tile_x[cells_of_tile[0]]), int(tile_y[cells_of_tile[0]])
+            pixels = np.zeros((cells_per_tile, cells_per_tile, 4), dtype=np.uint8)
+            pixels[
+                cell_y[cells_of_tile] % cells_per_tile,
+                cell_x[cells_of_tile] % cells_per_tile,
+            ] = colors[cells_of_tile]
+            pixels = pixels.repeat(CELL_SIZE, axis=0).repeat(CELL_SIZE, axis=1)
+            os.makedirs(path.join(dirpath, str(zoom), str(x)), exist_ok=True)
+            Image.fromarray(pixels, "RGBA").save(
+                path.join(dirpath, str(zoom), str(x), f"{y}.png")
+            )
+            n_tiles += 1
+
+        index["zooms"][zoom] = {
+            "min_x": int(tile_x.min()),
+            "max_x": int(tile_x.max()),
+            "min_y": int(tile_y.min()),
+            "max_y": int(tile_y.max()),
+            "crashes": int(counts.sum()),
+        }
+    with open(path.join(dirpath, "index.json"), "w") as f:
+        json.dump(index, f)
+    return n_tiles
+
+
+def build_crash_tiles(crash_filepath, dirpath=CRASH_TILES_DIRPATH, zooms=ZOOMS):
+    """
+    Aggregate a crash file and render its tiles.
+
+    Parameters
+    ----------
+    crash_filepath : string or pathlib.Path
+        path to the crash file, see risk_builder.read_crashes
+    dirpath : string or pathlib.Path
+        path to the tiles directory
+    zooms : list
+        zoom levels
+
+    Returns
+    -------
+    int
+        number of tiles written
+    """
+    chunks = read_crashes(
+        crash_filepath,
+        columns=["latitude", "longitude", "persons_injured", "persons_killed"],
+    )
+    cells = aggregate_crashes(chunks, zooms)
+
+    # Rendered aside then swapped : no mix of old and new tiles is served
+    dirpath = str(dirpath).rstrip(os.sep)
+    tmp_dirpath, old_dirpath = f"{dirpath}.tmp", f"{dirpath}.old"
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    os.makedirs(tmp_dirpath)
+    n_tiles = write_tiles(cells, tmp_dirpath)
+    if path.isdir(dirpath):
+        os.rename(dirpath, old_dirpath)
+    os.rename(tmp_dirpath, dirpath)
+    shutil.rmtree(old_dirpath, ignore_errors=True)
+    return n_tiles
+
+
+if __name__ == "__main__":
+    # Offline preprocessing : PYTHONPATH=website python -m utils.crash_tiles
+    import sys
+
+    from datetime import datetime
+    from utils.NYCRouteManager import NYCRouteManager
+
+    crash_filepath = (
+        sys.argv[1] if len(sys.argv) > 1 else NYCRouteManager.crash_weight_filepath
+    )
+    print(f"[!] Start Crash Tiles: {datetime.now()}")
+    n_tiles = build_crash_tiles(crash_filepath)
+    print(f"[!] End Crash Tiles: {datetime.now()} ({n_tiles} tiles)")
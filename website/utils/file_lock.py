@@ -0,0 +1,22 @@
+import fcntl
+
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(filepath):
+    """
+    Exclusive lock between the processes (the gunicorn workers, ...) held
+    during a `with` block, on a lock file created if needed.
+
+    Parameters
+    ----------
+    filepath : string or pathlib.Path
+        path to the lock file
+    """
+    with open(filepath, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,584 @@
+import difflib
+import re
+import sqlite3
+
+import numpy as np
+
+from collections import namedtuple
+from os import path
+
+# NOTE :
+# pandas is imported by the methods building the index : the geocoding of
+# the website only reads the saved arrays, and starts faster without it.
+
+# Same attributes as the geopy Location used by coordinates.get_coordinates
+GeocodeResult = namedtuple("GeocodeResult", ["latitude", "longitude", "address"])
+
+# Abbreviations of the street names and their normalized word
+ABBREVIATIONS = {
+    "st": "street",
+    "str": "street",
+    "ave": "avenue",
+    "av": "avenue",
+    "blvd": "boulevard",
+    "rd": "road",
+    "pl": "place",
+    "dr": "drive",
+    "ln": "lane",
+    "ct": "court",
+    "ter": "terrace",
+    "sq": "square",
+    "pkwy": "parkway",
+    "expy": "expressway",
+    "hwy": "highway",
+    "bway": "broadway",
+    "e": "east",
+    "w": "west",
+    "n": "north",
+    "s": "south",
+}
+ORDINALS = {
+    "first": "1",
+    "second": "2",
+    "third": "3",
+    "fourth": "4",
+    "fifth": "5",
+    "sixth": "6",
+    "seventh": "7",
+    "eighth": "8",
+    "ninth": "9",
+    "tenth": "10",
+    "eleventh": "11",
+    "twelfth": "12",
+}
+# End of an address which doesn't help to find it in New York
+PLACE_SUFFIX = re.compile(
+    r"[,\s]*\b(new york city|new york|nyc|ny|usa|united states|manhattan|"
+    r"brooklyn|queens|the bronx|bronx|staten island)$"
+)
+INTERSECTION_SEPARATORS = re.compile(r"\s*(?:&|/|@|\band\b|\bat\b)\s*")
+ZIP_CODE = re.compile(r"\b(1\d{4})\b")
+# Number of names of a prefix search looked at to find the best one
+PREFIX_SCAN = 50
+# Tables of the local index : kind of place and columns of its keys
+TABLES = ("street", "street_zip", "intersection", "zip")
+
+
+def normalize(name):
+    """
+    Normalize a street name : lowercase, no punctuation, full words for
+    the abbreviations and numbers for the ordinals ("W 103rd St." and
+    "West 103 Street" are both "west 103 street").
+
+    Parameters
+    ----------
+    name : string
+        street name
+
+    Returns
+    -------
+    string
+    """
+    name = re.sub(r"[^a-z0-9&/@ -]", " ", str(name).lower())
+    name = re.sub(r"\b(\d+)(st|nd|rd|th)\b", r"\1", name)
+    words = [ABBREVIATIONS.get(w, ORDINALS.get(w, w)) for w in name.split()]
+    return " ".join(words)
+
+
+def edge_names(data):
+    """Normalized names of an edge of an OSM graph (name can be a list)"""
+    names = data.get("name")
+    if not names:
+        return []
+    if isinstance(names, str):
+        names = [names]
+    return [n for n in (normalize(name) for name in names) if n]
+
+
+class LocalGeocoder:
+    """
+    Offline geocoder of the New York streets and intersections.
+
+    The index is built from the street names of the OSM graph and from the
+    `on_street_name`/`off_street_name`/`zip_code` of the crash data. It is
+    made of tables of sorted normalized keys and their point :
+        - street : a node of the street near its centroid
+        - street_zip : centroid of the crashes of a street in a zip code
+        - intersection : "name|other name" (sorted) node where they cross
+        - zip : centroid of the crashes of a zip code
+
+    The addresses are looked up by exact key, then by prefix ("west 103"
+    finds "west 103 street") and by fuzzy matching (typos). An address
+    with a house number isn't answered : the index can't place it on the
+    street, so a remote geocoder does it better.
+    """
+
+    def __init__(self, tables):
+        """
+        Initialize the LocalGeocoder
+
+        Parameters
+        ----------
+        tables : dict
+            kind:(keys, latitudes, longitudes) for each kind of TABLES, the
+            keys are sorted
+        """
+        self.tables = tables
+        self._street_names = tables["street"][0].tolist()
+
+    @classmethod
+    def build(cls, G=None, crashes=()):
+        """
+        Build the index from a graph and crashes.
+
+        Parameters
+        ----------
+        G : networkx.MultiDiGraph
+            OSM graph with `name` edge attributes
+        crashes : iterable of pandas.DataFrame
+            crashes with latitude, longitude, on_street_name,
+            off_street_name and zip_code columns, see
+            risk_builder.read_crashes
+
+        Returns
+        -------
+        LocalGeocoder
+        """
+        import pandas as pd
+
+        points = {kind: pd.DataFrame(columns=["key", "lat", "lng"]) for kind in TABLES}
+        # Crashes first, the graph points replace them on the same keys
+        for kind, df in cls._crash_points(crashes).items():
+            points[kind] = df
+        if G is not None:
+            for kind, df in cls._graph_points(G).items():
+                points[kind] = pd.concat([points[kind], df]).drop_duplicates(
+                    "key", keep="last"
+                )
+
+        tables = {}
+        for kind, df in points.items():
+            df = df.sort_values("key")
+            tables[kind] = (
+                df["key"].to_numpy(dtype=str),
+                df["lat"].to_numpy(dtype=float),
+                df["lng"].to_numpy(dtype=float),
+            )
+        return cls(tables)
+
+    @staticmethod
+    def _graph_points(G):
+        """Street and intersection points of the nodes of a graph"""
+        import pandas as pd
+
+        rows = []
+        for u, v, data in G.edges(data=True):
+            for name in edge_names(data):
+                rows.append((name, u))
+                rows.append((name, v))
+        df = pd.DataFrame(rows, columns=["key", "node"]).drop_duplicates()
+        df["lat"] = [G.nodes[node]["y"] for node in df["node"].tolist()]
+        df["lng"] = [G.nodes[node]["x"] for node in df["node"].tolist()]
+
+        # The node of each street nearest to its centroid
+        centroid = df.groupby("key")[["lat", "lng"]].transform("mean")
+        dist = (df["lat"] - centroid["lat"]) ** 2 + (df["lng"] - centroid["lng"]) ** 2
+        streets = df.assign(dist=dist).sort_values("dist").drop_duplicates("key")
+
+        pairs = df.merge(df, on="node")
+        pairs = pairs[pairs["key_x"] < pairs["key_y"]]
+        intersections = pd.DataFrame(
+            {
+                "key": pairs["key_x"] + "|" + pairs["key_y"],
+                "lat": pairs["lat_x"],
+                "lng": pairs["lng_x"],
+            }
+        ).drop_duplicates("key")
+        return {
+            "street": streets[["key", "lat", "lng"]],
+            "intersection": intersections,
+        }
+
+    @staticmethod
+    def _crash_points(crashes):
+        """Centroids of the crashes by street, intersection and zip code"""
+        import pandas as pd
+
+        names = {}
+        parts = {kind: [] for kind in TABLES}
+        for chunk in crashes:
+            df = pd.DataFrame({"lat": chunk["latitude"], "lng": chunk["longitude"]})
+            for column in ("on_street_name", "off_street_name"):
+                values = chunk[column].fillna("")
+                for value in values.unique():
+                    if value not in names:
+                        names[value] = normalize(value)
+                df[column] = values.map(names)
+            zip_code = pd.to_numeric(chunk["zip_code"], errors="coerce")
+            df["zip"] = zip_code.fillna(0).astype(np.int64).astype(str)
+            df = df[(df["on_street_name"] != "") & (df["on_street_name"] != "unknown")]
+
+            keys = {
+                "street": df["on_street_name"],
+                "street_zip": df["on_street_name"] + "|" + df["zip"],
+                "intersection": np.where(
+                    df["on_street_name"] < df["off_street_name"],
+                    df["on_street_name"] + "|" + df["off_street_name"],
+                    df["off_street_name"] + "|" + df["on_street_name"],
+                ),
+                "zip": df["zip"],
+            }
+            valid = {
+                "street": np.ones(len(df), dtype=bool),
+                "street_zip": (df["zip"] != "0").to_numpy(),
+                "intersection": (
+                    (df["off_street_name"] != "")
+                    & (df["off_street_name"] != "unknown")
+                    & (df["off_street_name"] != df["on_street_name"])
+                ).to_numpy(),
+                "zip": (df["zip"] != "0").to_numpy(),
+            }
+            for kind in TABLES:
+                sums = (
+                    df[["lat", "lng"]]
+                    .assign(key=np.asarray(keys[kind]), count=1)[valid[kind]]
+                    .groupby("key")
+                    .sum()
+                )
+                parts[kind].append(sums)
+
+        points = {}
+        for kind, sums in parts.items():
+            if not sums:
+                continue
+            total = pd.concat(sums).groupby(level=0).sum()
+            points[kind] = pd.DataFrame(
+                {
+                    "key": total.index.to_numpy(),
+                    "lat": (total["lat"] / total["count"]).to_numpy(),
+                    "lng": (total["lng"] / total["count"]).to_numpy(),
+                }
+            )
+        return points
+
+    def save(self, filepath):
+        """
+        Save the index to a `.npz` file.
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the file including extension
+        """
+        arrays = {}
+        for kind, (keys, lats, lngs) in self.tables.items():
+            arrays[f"{kind}_keys"] = keys
+            arrays[f"{kind}_lat"] = lats
+            arrays[f"{kind}_lng"] = lngs
+        with open(filepath, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load an index saved with `save`.
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the file including extension
+
+        Returns
+        -------
+        LocalGeocoder or None if the file doesn't exist
+        """
+        if not path.isfile(filepath):
+            return None
+        with np.load(filepath) as data:
+            tables = {
+                kind: (data[f"{kind}_keys"], data[f"{kind}_lat"], data[f"{kind}_lng"])
+                for kind in TABLES
+            }
+        return cls(tables)
+
+    def _lookup(self, kind, key):
+        """Returns the (lat, lng) of a key of a table or None"""
+        keys, lats, lngs = self.tables[kind]
+        i = int(np.searchsorted(keys, key))
+        if i < len(keys) and keys[i] == key:
+            return float(lats[i]), float(lngs[i])
+        return None
+
+    def suggest(self, prefix, limit=10):
+        """
+        Returns the street names starting with a prefix, shortest first.
+
+        Parameters
+        ----------
+        prefix : string
+            beginning of a street name
+        limit : int
+            maximum number of names returned
+
+        Returns
+        -------
+        list of string
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        keys = self.tables["street"][0]
+        start = int(np.searchsorted(keys, prefix))
+        end = int(np.searchsorted(keys, prefix + "\uffff"))
+        names = keys[start : min(end, start + PREFIX_SCAN)].tolist()
+        return sorted(names, key=len)[:limit]
+
+    def resolve_street(self, name):
+        """
+        Returns the street name of the index matching a name : the same
+        normalized name, the shortest one starting with it or the closest
+        one. None if nothing is close enough.
+        """
+        name = normalize(name)
+        if not name:
+            return None
+        if self._lookup("street", name) is not None:
+            return name
+        names = self.suggest(name, limit=1)
+        if names:
+            return names[0]
+        close = difflib.get_close_matches(name, self._street_names, n=1, cutoff=0.85)
+        return close[0] if close else None
+
+    def geocode(self, address):
+        """
+        Geocode an address : a street, an intersection ("X & Y", "X and Y",
+        "X at Y", "X / Y") or a zip code, optionally followed by the city
+        and a zip code.
+
+        Parameters
+        ----------
+        address : string
+            the address
+
+        Returns
+        -------
+        GeocodeResult or None if the address isn't in the index
+        """
+        text = str(address).lower()
+        zip_code = ZIP_CODE.search(text)
+        zip_code = zip_code.group(1) if zip_code else None
+        text = ZIP_CODE.sub(" ", text).strip(" ,")
+        # Only at the end : "New York Avenue" is a street
+        while PLACE_SUFFIX.search(text):
+            text = PLACE_SUFFIX.sub("", text).strip(" ,")
+        text = re.sub(r"[,\s]+", " ", text).strip()
+
+        if not text:
+            point = self._lookup("zip", zip_code) if zip_code else None
+            return self._result(point, zip_code)
+
+        parts = [part for part in INTERSECTION_SEPARATORS.split(text) if part]
+        if len(parts) == 2:
+            names = sorted(self.resolve_street(part) or "" for part in parts)
+            if not all(names):
+                return None
+            key = "|".join(names)
+            return self._result(self._lookup("intersection", key), " & ".join(names))
+        if len(parts) != 1:
+            return None
+
+        words = text.split()
+        if len(words) > 1 and re.fullmatch(r"\d+(-\d+)?", words[0]):
+            # A house number unless the number is the street name ("103 street")
+            if normalize(" ".join(words[1:])) not in ABBREVIATIONS.values():
+                return None
+        name = self.resolve_street(text)
+        if name is None:
+            return None
+        point = None
+        if zip_code:
+            point = self._lookup("street_zip", f"{name}|{zip_code}")
+        if point is None:
+            point = self._lookup("street", name)
+        return self._result(point, name)
+
+    @staticmethod
+    def _result(point, name):
+        if point is None:
+            return None
+        return GeocodeResult(point[0], point[1], f"{name.title()}, New York")
+
+
+class NominatimGeocoder:
+    """
+    Remote geocoder using the Nominatim API through geopy.
+
+    A single client is used, with at most one request per second (the
+    Nominatim usage policy) and a few retries on the timeouts.
+    """
+
+    def __init__(self, user_agent="nyc-navigation", timeout=5, max_retries=4):
+        """
+        Initialize the NominatimGeocoder
+
+        Parameters
+        ----------
+        user_agent : string
+            user agent sent to Nominatim
+        timeout : float
+            timeout (in seconds) of a request
+        max_retries : int
+            number of retries after a failed request
+        """
+        # Imported here : geopy is only needed for the remote geocoding
+        from geopy.geocoders import Nominatim
+        from geopy.extra.rate_limiter import RateLimiter
+
+        geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+        self._geocode = RateLimiter(
+            geolocator.geocode,
+            min_delay_seconds=1,
+            max_retries=max_retries,
+            swallow_exceptions=False,
+        )
+
+    def geocode(self, address):
+        """
+        Geocode an address.
+
+        Returns
+        -------
+        GeocodeResult or None if the address is unknown
+        """
+        location = self._geocode(address)
+        if location is None:
+            return None
+        return GeocodeResult(location.latitude, location.longitude, location.address)
+
+
+class CachedGeocoder:
+    """
+    Persistent cache of the results of a geocoder in a SQLite file, the
+    unknown addresses are cached too.
+    """
+
+    def __init__(self, geocoder, filepath):
+        """
+        Initialize the CachedGeocoder
+
+        Parameters
+        ----------
+        geocoder : object
+            geocoder with a `geocode(address)` method
+        filepath : string or pathlib.Path
+            path to the SQLite file, created if needed
+        """
+        self.geocoder = geocoder
+        self.filepath = str(filepath)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS geocode (query TEXT PRIMARY KEY, "
+                "latitude REAL, longitude REAL, address TEXT)"
+            )
+
+    def _connect(self):
+        # A connection per call : the server threads can't share one
+        return sqlite3.connect(self.filepath, timeout=10)
+
+    def geocode(self, address):
+        """
+        Geocode an address with the cache or the geocoder.
+
+        Returns
+        -------
+        GeocodeResult or None if the address is unknown
+        """
+        query = " ".join(str(address).lower().split())
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT latitude, longitude, address FROM geocode WHERE query = ?",
+                (query,),
+            ).fetchone()
+        if row is not None:
+            return GeocodeResult(*row) if row[2] is not None else None
+
+        result = self.geocoder.geocode(address)
+        row = tuple(result) if result is not None else (None, None, None)
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)", (query,) + row
+            )
+        return result
+
+
+class StubGeocoder:
+    """
+    Geocoder answering from a dict, without network or index (tests and
+    local development).
+    """
+
+    def __init__(self, locations=None):
+        """
+        Initialize the StubGeocoder
+
+        Parameters
+        ----------
+        locations : dict
+            address:(latitude, longitude)
+        """
+        self.locations = {
+            " ".join(address.lower().split()): point
+            for address, point in (locations or {}).items()
+        }
+
+    def geocode(self, address):
+        point = self.locations.get(" ".join(str(address).lower().split()))
+        if point is None:
+            return None
+        return GeocodeResult(point[0], point[1], f"{address}, New York")
+
+
+class GeocoderChain:
+    """Geocoders tried in order until one of them finds the address"""
+
+    def __init__(self, geocoders):
+        """
+        Initialize the GeocoderChain
+
+        Parameters
+        ----------
+        geocoders : list
+            geocoders with a `geocode(address)` method
+        """
+        self.geocoders = list(geocoders)
+
+    def geocode(self, address):
+        for geocoder in self.geocoders:
+            result = geocoder.geocode(address)
+            if result is not None:
+                return result
+        return None
+
+
+if __name__ == "__main__":
+    # Offline preprocessing : PYTHONPATH=website python -m utils.geocoder
+    from datetime import datetime
+    from utils.coordinates import GEOCODER_FILEPATH
+    from utils.NYCRouteManager import NYCRouteManager
+    from utils.risk_builder import read_crashes
+
+    print(f"[!] Start Geocoder Index: {datetime.now()}")
+    nyc_manager = NYCRouteManager()
+    crashes = read_crashes(
+        nyc_manager.crash_weight_filepath,
+        columns=[
+            "latitude",
+            "longitude",
+            "on_street_name",
+            "off_street_name",
+            "zip_code",
+        ],
+    )
+    LocalGeocoder.build(nyc_manager.G_risk, crashes).save(GEOCODER_FILEPATH)
+    print(f"[!] End Geocoder Index: {datetime.now()}")
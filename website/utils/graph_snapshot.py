@@ -0,0 +1,551 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from os import path
+
+
+class GraphSnapshot:
+    """
+    Compact, memory-mappable copy of the NYC streets network.
+
+    The MultiDiGraph is stored as a set of NumPy arrays in a directory:
+        - the nodes are sorted by OSM id and addressed by their index
+        - the edges are stored in CSR order (all the edges leaving the node
+          `i` are between `indptr[i]` and `indptr[i + 1]`) keeping the
+          adjacency order of the source graph
+        - the edge geometries are flattened in `geom_x`/`geom_y`, the points
+          of the edge `e` are between `geom_offsets[e]` and
+          `geom_offsets[e + 1]`
+
+    Missing numeric edge attributes are stored as NaN.
+
+    Loading a snapshot only maps the files (`numpy.load(mmap_mode="r")`),
+    so the pages are shared through the page cache between all the
+    processes reading the same snapshot.
+
+    The snapshots of several networks can share their nodes (see reindex) :
+    they are then built on the same node table and map its arrays once.
+
+    The risk arrays can be replaced without touching the topology (see
+    write_risk) : each version is written in new files and `risk_version`
+    in meta.json points to the current one. Each save gives a new
+    `snapshot_id`, the processes mapping a replaced snapshot can tell it
+    with is_current.
+    """
+
+    format_version = 1
+    meta_filename = "meta.json"
+    array_names = (
+        "node_ids",
+        "node_x",
+        "node_y",
+        "indptr",
+        "edge_target",
+        "edge_key",
+        "edge_length",
+        "edge_risk",
+        "edge_global_risk",
+        "geom_offsets",
+        "geom_x",
+        "geom_y",
+    )
+    risk_names = ("edge_risk", "edge_global_risk")
+    node_names = ("node_ids", "node_x", "node_y")
+
+    def __init__(self, arrays, meta=None):
+        """
+        Initialize the GraphSnapshot
+
+        Parameters
+        ----------
+        arrays : dict
+            name:numpy.ndarray for each name of `array_names`
+        meta : dict
+            information stored next to the arrays (source file, ...)
+        """
+        missing = [name for name in self.array_names if name not in arrays]
+        if missing:
+            raise ValueError(f"Missing snapshot arrays : {missing}")
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+        self.meta = dict(meta or {})
+        self._edge_source = None
+
+    @property
+    def risk_version(self):
+        """Version of the risk arrays, incremented by write_risk"""
+        return self.meta.get("risk_version", 0)
+
+    @property
+    def snapshot_id(self):
+        """Identifier of the saved snapshot, changed by each save"""
+        return self.meta.get("snapshot_id")
+
+    @classmethod
+    def _array_filepath(cls, dirpath, name, meta):
+        version = meta.get("risk_version", 0)
+        if version and name in cls.risk_names:
+            return path.join(dirpath, f"{name}.{version}.npy")
+        return path.join(dirpath, f"{name}.npy")
+
+    @classmethod
+    def _read_meta(cls, dirpath):
+        with open(path.join(dirpath, cls.meta_filename)) as f:
+            return json.load(f)
+
+    @classmethod
+    def _write_meta(cls, dirpath, meta):
+        # Replaced at once, a reader never sees a partially written file
+        tmp_filepath = path.join(dirpath, f"{cls.meta_filename}.tmp")
+        with open(tmp_filepath, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_filepath, path.join(dirpath, cls.meta_filename))
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_target)
+
+    @property
+    def edge_source(self):
+        """Index of the source node of each edge"""
+        if self._edge_source is None:
+            self._edge_source = np.repeat(
+                np.arange(self.n_nodes, dtype=np.int32), np.diff(self.indptr)
+            )
+        return self._edge_source
+
+    def node_index(self, node_id):
+        """
+        Return the index of an OSM node id in the snapshot.
+
+        Raises
+        ------
+        KeyError
+            If the node is not in the snapshot.
+        """
+        idx = int(np.searchsorted(self.node_ids, node_id))
+        if idx >= self.n_nodes or self.node_ids[idx] != node_id:
+            raise KeyError(node_id)
+        return idx
+
+    def edge_coords(self, edge):
+        """Return the (x, y) arrays of the geometry of an edge"""
+        start, end = self.geom_offsets[edge], self.geom_offsets[edge + 1]
+        return self.geom_x[start:end], self.geom_y[start:end]
+
+    @classmethod
+    def from_graph(cls, G, source=None):
+        """
+        Build a snapshot from a graph.
+
+        Parameters
+        ----------
+        G : networkx.MultiDiGraph
+            input graph, the nodes must have `x` and `y` attributes
+        source : string
+            path of the file the graph has been loaded from (saved in meta)
+
+        Returns
+        -------
+        GraphSnapshot
+        """
+        node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+        index = {node: i for i, node in enumerate(node_ids.tolist())}
+        node_x = np.array([G.nodes[n]["x"] for n in node_ids.tolist()], dtype=float)
+        node_y = np.array([G.nodes[n]["y"] for n in node_ids.tolist()], dtype=float)
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        target, key = [], []
+        length, risk, global_risk = [], [], []
+        geom_offsets, geom_x, geom_y = [0], [], []
+        for i, u in enumerate(node_ids.tolist()):
+            for v, keydict in G.adj[u].items():
+                for k, data in keydict.items():
+                    target.append(index[v])
+                    key.append(k)
+                    length.append(data.get("length", np.nan))
+                    risk.append(data.get("risk", np.nan))
+                    global_risk.append(data.get("global_risk", np.nan))
+                    if "geometry" in data:
+                        xs, ys = data["geometry"].xy
+                    else:
+                        xs = (node_x[i], node_x[index[v]])
+                        ys = (node_y[i], node_y[index[v]])
+                    geom_x.extend(xs)
+                    geom_y.extend(ys)
+                    geom_offsets.append(len(geom_x))
+            indptr[i + 1] = len(target)
+
+        arrays = {
+            "node_ids": node_ids,
+            "node_x": node_x,
+            "node_y": node_y,
+            "indptr": indptr,
+            "edge_target": np.array(target, dtype=np.int32),
+            "edge_key": np.array(key, dtype=np.int32),
+            "edge_length": np.array(length, dtype=float),
+            "edge_risk": np.array(risk, dtype=float),
+            "edge_global_risk": np.array(global_risk, dtype=float),
+            "geom_offsets": np.array(geom_offsets, dtype=np.int64),
+            "geom_x": np.array(geom_x, dtype=float),
+            "geom_y": np.array(geom_y, dtype=float),
+        }
+        meta = {}
+        if source is not None and path.isfile(source):
+            meta["source"] = path.abspath(source)
+            meta["source_mtime"] = path.getmtime(source)
+        return cls(arrays, meta)
+
+    def subset(self, nodes):
+        """
+        Returns the snapshot of the subgraph induced by some nodes : the
+        nodes and the edges between them, in the same order.
+
+        The subset has no edge geometries (straight edges), its routes are
+        drawn with the geometries of the whole snapshot.
+
+        Parameters
+        ----------
+        nodes : numpy.ndarray
+            sorted indices of the nodes to keep
+
+        Returns
+        -------
+        tuple of (GraphSnapshot, numpy.ndarray)
+            the subset and the index in this snapshot of each of its edges
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        indptr = np.asarray(self.indptr)
+        starts, ends = indptr[nodes], indptr[nodes + 1]
+        counts = ends - starts
+        edges = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        target = np.asarray(self.edge_target)[edges]
+        local = np.searchsorted(nodes, target)
+        kept = (local < len(nodes)) & (
+            nodes[np.minimum(local, len(nodes) - 1)] == target
+        )
+        edges, local = edges[kept], local[kept]
+
+        sub_indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(
+                np.repeat(np.arange(len(nodes)), counts)[kept], minlength=len(nodes)
+            ),
+            out=sub_indptr[1:],
+        )
+        arrays = {
+            "node_ids": np.asarray(self.node_ids)[nodes],
+            "node_x": np.asarray(self.node_x)[nodes],
+            "node_y": np.asarray(self.node_y)[nodes],
+            "indptr": sub_indptr,
+            "edge_target": local.astype(np.int32),
+            "edge_key": np.asarray(self.edge_key)[edges],
+            "edge_length": np.asarray(self.edge_length)[edges],
+            "edge_risk": np.asarray(self.edge_risk)[edges],
+            "edge_global_risk": np.asarray(self.edge_global_risk)[edges],
+            "geom_offsets": np.zeros(len(edges) + 1, dtype=np.int64),
+            "geom_x": np.zeros(0),
+            "geom_y": np.zeros(0),
+        }
+        return GraphSnapshot(arrays, {"subset_of": self.snapshot_id}), edges
+
+    @classmethod
+    def union_nodes(cls, snapshots):
+        """
+        Returns the node table of several snapshots : a snapshot without
+        edges with the nodes of all of them (the coordinates of a node in
+        several snapshots are the ones of the first of them).
+
+        Parameters
+        ----------
+        snapshots : list of GraphSnapshot
+
+        Returns
+        -------
+        GraphSnapshot
+        """
+        node_ids, first = np.unique(
+            np.concatenate([s.node_ids for s in snapshots]), return_index=True
+        )
+        arrays = {
+            "node_ids": node_ids,
+            "node_x": np.concatenate([s.node_x for s in snapshots])[first],
+            "node_y": np.concatenate([s.node_y for s in snapshots])[first],
+            "indptr": np.zeros(len(node_ids) + 1, dtype=np.int64),
+            "edge_target": np.zeros(0, dtype=np.int32),
+            "edge_key": np.zeros(0, dtype=np.int32),
+            "edge_length": np.zeros(0),
+            "edge_risk": np.zeros(0),
+            "edge_global_risk": np.zeros(0),
+            "geom_offsets": np.zeros(1, dtype=np.int64),
+            "geom_x": np.zeros(0),
+            "geom_y": np.zeros(0),
+        }
+        return cls(arrays)
+
+    def reindex(self, nodes):
+        """
+        Returns this snapshot on the nodes of a node table (see
+        union_nodes) : its node arrays are the ones of the table, the
+        nodes of the table which are not in this graph have no edges. The
+        edges keep their order.
+
+        Parameters
+        ----------
+        nodes : GraphSnapshot
+            saved node table, with all the nodes of this snapshot
+
+        Returns
+        -------
+        GraphSnapshot
+
+        Raises
+        ------
+        KeyError
+            If a node of this snapshot is not in the table.
+        """
+        position = np.searchsorted(nodes.node_ids, self.node_ids)
+        if len(position) and (
+            position.max() >= nodes.n_nodes
+            or not np.array_equal(np.asarray(nodes.node_ids)[position], self.node_ids)
+        ):
+            raise KeyError("Nodes of the snapshot are missing in the node table")
+        degree = np.zeros(nodes.n_nodes, dtype=np.int64)
+        degree[position] = np.diff(self.indptr)
+        indptr = np.zeros(nodes.n_nodes + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        arrays = {name: getattr(self, name) for name in self.array_names}
+        arrays.update(
+            node_ids=nodes.node_ids,
+            node_x=nodes.node_x,
+            node_y=nodes.node_y,
+            indptr=indptr,
+            edge_target=position[np.asarray(self.edge_target)].astype(np.int32),
+        )
+        return GraphSnapshot(arrays, dict(self.meta, nodes_id=nodes.snapshot_id))
+
+    def save(self, dirpath, keep=()):
+        """
+        Save the snapshot to a directory of `.npy` files.
+
+        The files are written in a temporary directory (of this process)
+        which replaces the previous snapshot once complete, so a reader
+        never maps a partially written snapshot.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        keep : list
+            names of the files of the previous snapshot copied in the new
+            one : the data computed on the edges of a snapshot saved again
+            with the same edges (see reindex)
+        """
+        dirpath = str(dirpath).rstrip(os.sep)
+        tmp_dirpath = f"{dirpath}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dirpath, exist_ok=True)
+        for filename in keep:
+            if path.isfile(path.join(dirpath, filename)):
+                shutil.copyfile(
+                    path.join(dirpath, filename), path.join(tmp_dirpath, filename)
+                )
+        for name in self.array_names:
+            np.save(path.join(tmp_dirpath, f"{name}.npy"), getattr(self, name))
+        meta = dict(self.meta)
+        meta.update(
+            format=self.format_version,
+            n_nodes=self.n_nodes,
+            n_edges=self.n_edges,
+            snapshot_id=uuid.uuid4().hex,
+        )
+        meta.pop("risk_version", None)
+        with open(path.join(tmp_dirpath, self.meta_filename), "w") as f:
+            json.dump(meta, f)
+
+        if path.isdir(dirpath):
+            old_dirpath = f"{dirpath}.{os.getpid()}.old"
+            os.rename(dirpath, old_dirpath)
+            os.rename(tmp_dirpath, dirpath)
+            for filename in os.listdir(old_dirpath):
+                os.remove(path.join(old_dirpath, filename))
+            os.rmdir(old_dirpath)
+        else:
+            os.rename(tmp_dirpath, dirpath)
+        self.meta = meta
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode="r", nodes=None):
+        """
+        Load a snapshot saved with `save`.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        mmap_mode : string or None
+            passed to numpy.load, None reads the arrays in memory
+        nodes : GraphSnapshot
+            node table shared with other snapshots : its node arrays are
+            used if the snapshot has been built on it (see reindex)
+
+        Returns
+        -------
+        GraphSnapshot
+        """
+        meta = cls._read_meta(dirpath)
+        if meta.get("format") != cls.format_version:
+            raise ValueError(f"Unsupported snapshot format : {meta.get('format')}")
+        shared = {}
+        if nodes is not None and meta.get("nodes_id") == nodes.snapshot_id:
+            shared = {name: getattr(nodes, name) for name in cls.node_names}
+        arrays = {
+            name: (
+                shared[name]
+                if name in shared
+                else np.load(
+                    cls._array_filepath(dirpath, name, meta), mmap_mode=mmap_mode
+                )
+            )
+            for name in cls.array_names
+        }
+        return cls(arrays, meta)
+
+    def write_risk(self, dirpath, risk, global_risk):
+        """
+        Save new risk arrays of the snapshot saved in dirpath and map them.
+
+        The arrays are written in new files, then meta.json is replaced to
+        point to them : the processes using the previous version keep
+        their mapping until they call reload_risk. The files of the
+        previous version are only removed by the next write : a process
+        which has just read the previous meta.json can still load them.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        risk : numpy.ndarray
+            risk of each edge
+        global_risk : numpy.ndarray
+            global_risk of each edge
+        """
+        meta = self._read_meta(dirpath)
+        meta["risk_version"] = meta.get("risk_version", 0) + 1
+        # The version before the previous one (the files of version 0 are
+        # the ones of save)
+        older = {"risk_version": meta["risk_version"] - 2}
+        for name, values in zip(self.risk_names, (risk, global_risk)):
+            values = np.asarray(values, dtype=float)
+            if len(values) != self.n_edges:
+                raise ValueError(f"Expected {self.n_edges} values, got {len(values)}")
+            np.save(self._array_filepath(dirpath, name, meta), values)
+        self._write_meta(dirpath, meta)
+        # The mapped pages of the older files stay valid after the removal
+        if older["risk_version"] > 0:
+            for name in self.risk_names:
+                filepath = self._array_filepath(dirpath, name, older)
+                if path.isfile(filepath):
+                    os.remove(filepath)
+        self.reload_risk(dirpath)
+
+    def with_risk(self, risk, global_risk):
+        """
+        Returns a copy of this snapshot (sharing its arrays) with other
+        risk arrays, as the next version of its risk : the data computed
+        from the risk can be saved before the risk itself (see write_risk).
+        """
+        arrays = {name: getattr(self, name) for name in self.array_names}
+        arrays.update(edge_risk=risk, edge_global_risk=global_risk)
+        return GraphSnapshot(
+            arrays, dict(self.meta, risk_version=self.risk_version + 1)
+        )
+
+    def reload_risk(self, dirpath):
+        """
+        Map the risk arrays saved by write_risk if they have changed.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+
+        Returns
+        -------
+        bool
+            True if new risk arrays have been mapped
+        """
+        meta = self._read_meta(dirpath)
+        if meta.get("risk_version", 0) == self.risk_version:
+            return False
+        try:
+            arrays = {
+                name: np.load(self._array_filepath(dirpath, name, meta), mmap_mode="r")
+                for name in self.risk_names
+            }
+        except FileNotFoundError:
+            # Replaced by two writes meanwhile : mapped on the next call
+            return False
+        # All the arrays are loaded before any is replaced
+        for name, values in arrays.items():
+            setattr(self, name, values)
+        self.meta = meta
+        return True
+
+    def is_current(self, dirpath):
+        """
+        Check that the snapshot saved in dirpath is still this one, i.e. it
+        has not been saved again since it was mapped (whatever the version
+        of its risk).
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+
+        Returns
+        -------
+        bool
+        """
+        try:
+            meta = self._read_meta(dirpath)
+        except FileNotFoundError:
+            # Being replaced by save : this one is used until the new one is there
+            return True
+        return meta.get("snapshot_id") == self.snapshot_id
+
+    @classmethod
+    def is_fresh(cls, dirpath, source):
+        """
+        Check that a saved snapshot exists and is newer than its source.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        source : string or pathlib.Path
+            path to the GraphML file the snapshot is built from
+
+        Returns
+        -------
+        bool
+        """
+        meta_path = path.join(dirpath, cls.meta_filename)
+        if not path.isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("format") != cls.format_version:
+            return False
+        if path.isfile(source):
+            return meta.get("source_mtime", 0) >= path.getmtime(source)
+        return True
@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+
+from shapely import affinity
+from shapely.geometry import MultiLineString, Point, Polygon, mapping
+from shapely.ops import linemerge
+
+from utils.route_engine import EARTH_RADIUS_M
+
+# Distance (in meters) around the reached streets covered by the polygons
+ISOCHRONE_BUFFER = 60
+
+
+class Isochrone:
+    """
+    Nodes reachable from a starting point within a maximum weight (the
+    length of the path for the shortest profile, its risk for the safest
+    profile, ...), with the length and the global_risk summed along the
+    path to each node.
+
+    The polygons of the reached area are the streets reached within a
+    cutoff (the last one partly) widened by `buffer` meters.
+    """
+
+    def __init__(self, snapshot, engine, weight, nodes, cost, length, global_risk):
+        """
+        Initialize the Isochrone
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        engine : RouteEngine
+            route engine of the snapshot
+        weight : string
+            engine profile the paths are weighted with
+        nodes : numpy.ndarray
+            indices of the reached nodes, by increasing cost
+        cost : numpy.ndarray
+            weight of the path to each node
+        length : numpy.ndarray
+            length (in meters) of the path to each node
+        global_risk : numpy.ndarray
+            global_risk summed along the path to each node
+        """
+        self.snapshot = snapshot
+        self.engine = engine
+        self.weight = weight
+        self.nodes = nodes
+        self.cost = cost
+        self.length = length
+        self.global_risk = global_risk
+
+    @classmethod
+    def search(cls, snapshot, engine, sources, cutoff, weight="shortest"):
+        """
+        Search the nodes reachable from the sources within a cutoff.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        engine : RouteEngine
+            route engine of the snapshot
+        sources : dict
+            index of a starting node:offset
+        cutoff : float
+            maximum weight of the paths
+        weight : string
+            name of the engine profile
+
+        Returns
+        -------
+        Isochrone
+        """
+        tree = engine.shortest_path_tree(sources, weight=weight, cutoff=cutoff)
+        nodes = np.fromiter(tree.dist, dtype=np.int64, count=len(tree.dist))
+        cost = np.fromiter(tree.dist.values(), dtype=float, count=len(tree.dist))
+        pairs = np.array([tree.pred_pair[v] for v in nodes.tolist()], dtype=np.int64)
+        edges = engine.pair_edge[np.maximum(pairs, 0)]
+        edge_length = np.nan_to_num(np.asarray(snapshot.edge_length)[edges])
+        edge_risk = np.nan_to_num(np.asarray(snapshot.edge_global_risk)[edges])
+
+        # The nodes are settled after their predecessor : summed in order
+        position = dict(zip(nodes.tolist(), range(len(nodes))))
+        length, global_risk = [0.0] * len(nodes), [0.0] * len(nodes)
+        for i, (v, pair) in enumerate(zip(nodes.tolist(), pairs.tolist())):
+            if pair >= 0:
+                previous = position[tree.pred[v]]
+                length[i] = length[previous] + edge_length[i]
+                global_risk[i] = global_risk[previous] + edge_risk[i]
+        return cls(
+            snapshot,
+            engine,
+            weight,
+            nodes,
+            cost,
+            np.array(length),
+            np.array(global_risk),
+        )
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def to_frame(self):
+        """
+        Returns the reached nodes as a DataFrame : node (OSM ID), lat, lng,
+        cost, length and global_risk.
+        """
+        return pd.DataFrame(
+            {
+                "node": np.asarray(self.snapshot.node_ids)[self.nodes],
+                "lat": np.asarray(self.snapshot.node_y)[self.nodes],
+                "lng": np.asarray(self.snapshot.node_x)[self.nodes],
+                "cost": self.cost,
+                "length": self.length,
+                "global_risk": self.global_risk,
+            }
+        )
+
+    def _reached_lines(self, cutoff):
+        """
+        Returns the (lng, lat) segments of the pairs of edges leaving the
+        nodes reached within cutoff : whole if their end is reached within
+        cutoff too, else up to where the cutoff is reached.
+        """
+        engine, snapshot = self.engine, self.snapshot
+        within = self.cost <= cutoff
+        nodes, cost = self.nodes[within], self.cost[within]
+        if not len(nodes):
+            return np.zeros((0, 2, 2))
+        node_cost = np.full(snapshot.n_nodes, np.inf)
+        node_cost[nodes] = cost
+
+        starts = engine.pair_indptr[nodes]
+        counts = engine.pair_indptr[nodes + 1] - starts
+        sources = np.repeat(nodes, counts)
+        pairs = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        targets = engine.pair_target[pairs]
+        weights = engine.pair_weights[self.weight][pairs]
+        # Part of each edge covered within the cutoff
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(
+                node_cost[targets] <= cutoff,
+                1.0,
+                (cutoff - node_cost[sources]) / weights,
+            )
+        fraction = np.clip(np.nan_to_num(fraction, nan=1.0), 0, 1)
+
+        x, y = np.asarray(snapshot.node_x), np.asarray(snapshot.node_y)
+        x0, y0 = x[sources], y[sources]
+        x1 = x0 + (x[targets] - x0) * fraction
+        y1 = y0 + (y[targets] - y0) * fraction
+        return np.stack((np.column_stack((x0, y0)), np.column_stack((x1, y1))), 1)
+
+    def polygon(self, cutoff=None, buffer=ISOCHRONE_BUFFER):
+        """
+        Returns the area reached within a cutoff as a shapely (Multi)Polygon
+        in (lng, lat) coordinates.
+
+        Parameters
+        ----------
+        cutoff : float
+            maximum weight of the paths, default : the whole search
+        buffer : float
+            distance (in meters) around the reached streets
+
+        Returns
+        -------
+        shapely.geometry.base.BaseGeometry
+            empty if no node is reached
+        """
+        if cutoff is None:
+            cutoff = np.inf
+        if not len(self) or self.cost[0] > cutoff:
+            return Polygon()
+        # Buffered in meters on a local equirectangular projection
+        lng0 = float(self.snapshot.node_x[self.nodes[0]])
+        lat0 = float(self.snapshot.node_y[self.nodes[0]])
+        scale_y = np.pi / 180 * EARTH_RADIUS_M
+        scale_x = scale_y * np.cos(np.radians(lat0))
+        lines = self._reached_lines(cutoff)
+        if len(lines):
+            meters = (lines - (lng0, lat0)) * (scale_x, scale_y)
+            # The two ways of a street are buffered once, in long lines :
+            # the buffer is much longer than the search
+            forward = (meters[:, 0, 0] < meters[:, 1, 0]) | (
+                (meters[:, 0, 0] == meters[:, 1, 0])
+                & (meters[:, 0, 1] <= meters[:, 1, 1])
+            )
+            meters = np.where(forward[:, None, None], meters, meters[:, ::-1])
+            meters = np.unique(meters.reshape(-1, 4), axis=0).reshape(-1, 2, 2)
+            lines = linemerge(MultiLineString(meters.tolist()))
+            area = lines.buffer(buffer, resolution=2)
+        else:
+            # No street leaving the reached nodes
+            area = Point(0, 0).buffer(buffer, resolution=2)
+        return affinity.affine_transform(
+            area, [1 / scale_x, 0, 0, 1 / scale_y, lng0, lat0]
+        )
+
+    def to_geojson(self, cutoffs=None, buffer=ISOCHRONE_BUFFER):
+        """
+        Returns the areas reached within several cutoffs as a GeoJSON
+        FeatureCollection, from the largest to the smallest area.
+
+        Parameters
+        ----------
+        cutoffs : list
+            cutoffs of the areas, default : the one of the search
+        buffer : float
+            distance (in meters) around the reached streets
+
+        Returns
+        -------
+        dict
+        """
+        if cutoffs is None:
+            cutoffs = [float(self.cost.max()) if len(self) else 0.0]
+        features = []
+        for cutoff in sorted(cutoffs, reverse=True):
+            area = self.polygon(cutoff, buffer)
+            within = self.cost <= cutoff
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": mapping(area),
+                    "properties": {
+                        "weight": self.weight,
+                        "cutoff": cutoff,
+                        "nodes": int(within.sum()),
+                        "max_length": float(self.length[within].max(initial=0)),
+                        "max_global_risk": float(
+                            self.global_risk[within].max(initial=0)
+                        ),
+                    },
+                }
+            )
+        return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,131 @@
+import multiprocessing
+
+import numpy as np
+
+from utils.route_engine import NoPathException
+
+# Fields of /proc/<pid>/smaps_rollup (in kB) and the matching keys
+SMAPS_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared_clean",
+    "Shared_Dirty": "shared_dirty",
+    "Private_Clean": "private_clean",
+    "Private_Dirty": "private_dirty",
+}
+
+
+def process_memory(pid="self"):
+    """
+    Memory used by a process, read from /proc/<pid>/smaps_rollup (Linux).
+
+    The pages of the snapshot files (and the ones of a forked process not
+    written since the fork) are counted in `shared`, the pages copied or
+    allocated by the process in `private`. `pss` shares out the shared
+    pages between the processes mapping them : the sum of the pss of the
+    server processes is the memory they really use.
+
+    Parameters
+    ----------
+    pid : int or string
+        process ID, default : the current process
+
+    Returns
+    -------
+    dict or None if /proc is not available
+        rss, pss, shared, private and the fields of SMAPS_FIELDS in bytes
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    memory = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 3 and parts[0].rstrip(":") in SMAPS_FIELDS:
+            memory[SMAPS_FIELDS[parts[0].rstrip(":")]] = int(parts[1]) * 1024
+    memory["shared"] = memory.get("shared_clean", 0) + memory.get("shared_dirty", 0)
+    memory["private"] = memory.get("private_clean", 0) + memory.get("private_dirty", 0)
+    return memory
+
+
+def _route_worker(route_manager, n_routes, seed, results):
+    """Compute random routes of all the types, then report the memory"""
+    rng = np.random.default_rng(seed)
+    node_ids = route_manager.snapshot.node_ids
+    for _ in range(n_routes):
+        node_from, node_to = rng.choice(node_ids, 2)
+        for route_type in route_manager.route_types:
+            try:
+                route_manager.compute_route(
+                    int(node_from), int(node_to), weight=route_type
+                )
+            except NoPathException:
+                pass
+    results.put(process_memory())
+
+
+def measure_workers(route_manager, n_workers=4, n_routes=50):
+    """
+    Fork server-like workers from a loaded manager (as gunicorn does with
+    preload_app, see gunicorn.conf.py) and measure their memory once they
+    have computed some routes.
+
+    Parameters
+    ----------
+    route_manager : NYCRouteManager
+        manager loaded in this process
+    n_workers : int
+        number of forked workers
+    n_routes : int
+        number of random routes (of each type) computed by each worker
+
+    Returns
+    -------
+    list of dict
+        memory of each worker, see process_memory
+    """
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=_route_worker, args=(route_manager, n_routes, seed, results)
+        )
+        for seed in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    memories = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return memories
+
+
+if __name__ == "__main__":
+    # Memory per worker :
+    #   PYTHONPATH=website python -m utils.memory [workers] [--partitioned]
+    import gc
+    import sys
+
+    from utils.NYCRouteManager import NYCRouteManager
+
+    args = [arg for arg in sys.argv[1:] if arg != "--partitioned"]
+    n_workers = int(args[0]) if args else 4
+    route_manager = NYCRouteManager(partitioned="--partitioned" in sys.argv)
+    # No route pool : each worker computes its routes itself
+    route_manager.route_workers = 0
+    gc.freeze()
+    master = process_memory()
+    if master is None:
+        sys.exit("[!] /proc/<pid>/smaps_rollup is needed (Linux)")
+    print(f"[!] Master : {master['rss'] / 2**20:.0f} MB")
+    memories = measure_workers(route_manager, n_workers)
+    for i, memory in enumerate(memories):
+        print(
+            f"[!] Worker {i} : rss {memory['rss'] / 2**20:.0f} MB, "
+            f"pss {memory['pss'] / 2**20:.0f} MB, "
+            f"private {memory['private'] / 2**20:.0f} MB"
+        )
+    private = np.mean([memory["private"] for memory in memories])
+    print(f"[!] Memory per additional worker : {private / 2**20:.0f} MB")
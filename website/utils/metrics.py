@@ -0,0 +1,310 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from os import path
+
+# Upper bounds (in seconds) of the buckets of the duration histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+# Upper bounds of the buckets of the route size histograms
+LENGTH_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+NODES_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Upper bound (in meters) and name of the route length bands used as label
+LENGTH_BANDS = ((2000, "short"), (8000, "medium"), (float("inf"), "long"))
+# Labels of all the series of navigation_stage_seconds besides the stage,
+# "none" for the stages without them (geocode, snap, render)
+STAGE_LABELS = ("profile", "length")
+
+
+def length_band(length):
+    """Returns the name of the band of a route length in meters"""
+    for upper, band in LENGTH_BANDS:
+        if length < upper:
+            return band
+    return LENGTH_BANDS[-1][1]
+
+
+class Histogram:
+    """
+    Distribution of observed values by label values, as the histograms of
+    Prometheus : cumulative counts of the values below each bucket bound,
+    sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        """
+        Initialize the Histogram
+
+        Parameters
+        ----------
+        name : string
+            metric name
+        documentation : string
+            HELP line of the metric
+        buckets : tuple
+            increasing upper bounds of the buckets (+Inf is added)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # label items:[count of each bucket, sum, count]
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def merge(self, series):
+        """Add series (label items:[buckets, sum, count]) to this one"""
+        with self._lock:
+            for key, (counts, total, count) in series.items():
+                own = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                own[0] = [a + b for a, b in zip(own[0], counts)]
+                own[1] += total
+                own[2] += count
+
+    def samples(self):
+        """Returns the lines of the samples (text exposition format)"""
+        lines = []
+        with self._lock:
+            series = sorted(self.series.items())
+        for key, (counts, total, count) in series:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(key + (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(key + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Counter:
+    """Number of events by label values, as the counters of Prometheus"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        # label items:count
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def merge(self, series):
+        """Add series (label items:count) to this one"""
+        with self._lock:
+            for key, value in series.items():
+                self.series[key] = self.series.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            series = sorted(self.series.items())
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in series]
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    items = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in key
+    )
+    return "{" + items + "}"
+
+
+class MetricsRegistry:
+    """
+    Metrics of a process, rendered in the Prometheus text format.
+
+    Each process (e.g. each gunicorn worker) has its own metrics. Once
+    shared (see share), each process saves its metrics in a file of a
+    directory and render adds up the metrics of all the files : a scrape
+    answered by any worker returns the metrics of all the workers.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        # Directory shared by the processes, None : metrics of this process
+        self.dirpath = None
+        self._save_lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            return metric
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        """Returns the histogram of this name, created on the first call"""
+        return self._get(Histogram, name, documentation, buckets)
+
+    def counter(self, name, documentation):
+        """Returns the counter of this name, created on the first call"""
+        return self._get(Counter, name, documentation)
+
+    def _state(self):
+        """Returns the metrics as JSON-serializable lists"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        state = []
+        for metric in metrics:
+            with metric._lock:
+                series = [[list(key), value] for key, value in metric.series.items()]
+            state.append(
+                {
+                    "name": metric.name,
+                    "kind": metric.kind,
+                    "documentation": metric.documentation,
+                    "buckets": list(getattr(metric, "buckets", ())),
+                    "series": series,
+                }
+            )
+        return state
+
+    def share(self, dirpath, interval=1.0):
+        """
+        Save the metrics of this process in a directory every `interval`
+        seconds (from a daemon thread) : render then adds up the metrics of
+        all the processes sharing this directory.
+
+        Parameters
+        ----------
+        dirpath : string
+            directory of the metrics files, one per process
+        interval : float
+            time (in seconds) between two saves
+        """
+        self.dirpath = dirpath
+
+        def save_periodically():
+            while True:
+                time.sleep(interval)
+                self.save()
+
+        threading.Thread(target=save_periodically, daemon=True).start()
+
+    def save(self):
+        """Save the metrics of this process in dirpath (<pid>.json)"""
+        if self.dirpath is None:
+            return
+        with self._save_lock:
+            os.makedirs(self.dirpath, exist_ok=True)
+            filepath = path.join(self.dirpath, f"{os.getpid()}.json")
+            with open(f"{filepath}.tmp", "w") as f:
+                json.dump(self._state(), f)
+            os.replace(f"{filepath}.tmp", filepath)
+
+    def _merged(self):
+        """Returns the metrics of all the processes saved in dirpath"""
+        self.save()
+        merged = MetricsRegistry()
+        for filename in sorted(os.listdir(self.dirpath)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(path.join(self.dirpath, filename)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric in state:
+                if metric["kind"] == "histogram":
+                    own = merged.histogram(
+                        metric["name"], metric["documentation"], metric["buckets"]
+                    )
+                else:
+                    own = merged.counter(metric["name"], metric["documentation"])
+                own.merge(
+                    {tuple(map(tuple, key)): value for key, value in metric["series"]}
+                )
+        return merged
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format, the
+        ones of all the processes if dirpath is set.
+        """
+        registry = self._merged() if self.dirpath is not None else self
+        with registry._lock:
+            metrics = sorted(registry._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this process
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "navigation_stage_seconds",
+    "Duration of the stages of the navigation requests",
+)
+route_length_meters = metrics.histogram(
+    "navigation_route_length_meters", "Length of the computed routes", LENGTH_BUCKETS
+)
+route_nodes = metrics.histogram(
+    "navigation_route_nodes", "Number of nodes of the computed routes", NODES_BUCKETS
+)
+
+
+def stage_labels(stage, **labels):
+    """
+    Returns the labels of a duration of stage_seconds : the stage and all
+    the STAGE_LABELS, "none" if not given.
+    """
+    return dict({name: "none" for name in STAGE_LABELS}, **labels, stage=stage)
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Time a stage and observe its duration in stage_seconds.
+
+    The labels are yielded as a dict : labels known at the end of the
+    stage (e.g. the length band of the route) can be added to it.
+
+    Parameters
+    ----------
+    stage : string
+        name of the stage (geocode, snap, search, geometry, render, ...)
+    labels : dict
+        other labels (see STAGE_LABELS)
+    """
+    labels = stage_labels(stage, **labels)
+    start = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, **labels)
+
+
+def observe_route(profile, geometry):
+    """Observe the length and the number of nodes of a RouteGeometry"""
+    route_length_meters.observe(geometry.length, profile=profile)
+    route_nodes.observe(len(geometry.nodes), profile=profile)
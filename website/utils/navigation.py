@@ -0,0 +1,192 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+
+from utils.coordinates import get_coordinates
+from utils.metrics import span
+
+
+class OverloadedException(Exception):
+    pass
+
+
+class DeadlineExceededException(Exception):
+    pass
+
+
+class NavigationService:
+    """
+    Runs the stages of a navigation request (geocoding, routing) with a
+    bounded number of requests in progress and a deadline per request.
+
+    The two addresses are geocoded concurrently in a thread pool (the
+    remote geocoders wait on the network). The routes are computed by the
+    route pool of the NYCRouteManager : forked processes sharing the pages
+    of the snapshot, so a long search doesn't hold the GIL of the server.
+
+    A request arriving when `max_pending` requests are in progress is
+    rejected at once (see admit) instead of waiting in the server queue.
+    """
+
+    def __init__(
+        self,
+        route_manager,
+        max_pending=16,
+        geocode_workers=8,
+        geocode_timeout=5.0,
+        route_timeout=10.0,
+        request_timeout=20.0,
+    ):
+        """
+        Initialize the NavigationService
+
+        Parameters
+        ----------
+        route_manager : NYCRouteManager or NetworkRouteManagers
+            manager computing the routes
+        max_pending : int
+            maximum number of requests in progress
+        geocode_workers : int
+            number of threads geocoding the addresses
+        geocode_timeout : float
+            deadline (in seconds) of the geocoding of the two addresses
+        route_timeout : float
+            deadline (in seconds) of the route computation
+        request_timeout : float
+            deadline (in seconds) of the whole request
+        """
+        self.route_manager = route_manager
+        self.geocode_timeout = geocode_timeout
+        self.route_timeout = route_timeout
+        self.request_timeout = request_timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._geocode_pool = ThreadPoolExecutor(
+            max_workers=geocode_workers, thread_name_prefix="geocode"
+        )
+
+    @contextmanager
+    def admit(self):
+        """
+        Context of a request : yields its deadline (time.monotonic() value).
+
+        Raises
+        ------
+        OverloadedException
+            If max_pending requests are already in progress.
+        """
+        if not self._pending.acquire(blocking=False):
+            raise OverloadedException("Too many requests in progress")
+        try:
+            yield time.monotonic() + self.request_timeout
+        finally:
+            self._pending.release()
+
+    @staticmethod
+    def remaining(deadline, stage_timeout):
+        """
+        Returns the time (in seconds) left for a stage : its own timeout
+        bounded by the deadline of the request.
+
+        Raises
+        ------
+        DeadlineExceededException
+            If the deadline of the request has passed.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededException("The request took too long")
+        return min(remaining, stage_timeout)
+
+    def geocode(self, from_address, to_address, deadline):
+        """
+        Geocode the two addresses concurrently.
+
+        Returns
+        -------
+        tuple of ((lat, lng), (lat, lng))
+
+        Raises
+        ------
+        LocationUnknownException, LocationNotInNyException
+            See coordinates.get_coordinates.
+        DeadlineExceededException
+            If the geocoding doesn't end before its deadline.
+        """
+        timeout = self.remaining(deadline, self.geocode_timeout)
+        end = time.monotonic() + timeout
+        futures = [
+            self._geocode_pool.submit(self._geocode, address)
+            for address in (from_address, to_address)
+        ]
+        try:
+            return tuple(
+                future.result(timeout=max(end - time.monotonic(), 0))
+                for future in futures
+            )
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise DeadlineExceededException("The geocoding took too long")
+
+    @staticmethod
+    def _geocode(address):
+        """Geocode an address in the geocoding pool, see geocode"""
+        with span("geocode"):
+            return get_coordinates(address)
+
+    def get_routes(self, point_from, point_to, route_types, deadline, **kwargs):
+        """
+        Compute the routes between two points, see NYCRouteManager.get_routes.
+
+        Raises
+        ------
+        DeadlineExceededException
+            If the routes are not computed before their deadline.
+        """
+        timeout = self.remaining(deadline, self.route_timeout)
+        try:
+            return self.route_manager.get_routes(
+                point_from, point_to, route_types, timeout=timeout, **kwargs
+            )
+        except TimeoutError:
+            raise DeadlineExceededException("The route search took too long")
+
+    def get_alternative_routes(
+        self, point_from, point_to, route_type, deadline, **kwargs
+    ):
+        """
+        Compute alternative routes of a type between two points in the route
+        pool, see NYCRouteManager.get_alternative_routes.
+
+        Raises
+        ------
+        DeadlineExceededException
+            If the routes are not computed before their deadline.
+        """
+        timeout = self.remaining(deadline, self.route_timeout)
+        try:
+            return self.route_manager.get_alternative_routes(
+                point_from, point_to, route_type, timeout=timeout, **kwargs
+            )
+        except TimeoutError:
+            raise DeadlineExceededException("The alternative routes took too long")
+
+    def get_isochrone(self, point, cutoffs, deadline, **kwargs):
+        """
+        Compute the GeoJSON areas reachable from a point in the route pool,
+        see NYCRouteManager.get_isochrone_geojson.
+
+        Raises
+        ------
+        DeadlineExceededException
+            If the areas are not computed before their deadline.
+        """
+        timeout = self.remaining(deadline, self.route_timeout)
+        try:
+            return self.route_manager.get_isochrone_geojson(
+                point, cutoffs, timeout=timeout, **kwargs
+            )
+        except TimeoutError:
+            raise DeadlineExceededException("The isochrone took too long")
@@ -0,0 +1,274 @@
+import os
+
+import numpy as np
+
+from collections import OrderedDict
+from os import path
+
+from utils.file_lock import file_lock
+from utils.graph_snapshot import GraphSnapshot
+from utils.spatial_index import SpatialIndex
+from utils.NYCRouteManager import NYCRouteManager
+
+# Networks of OSM hosted by default, each with the risk of its users
+NETWORK_TYPES = ("drive", "bike", "walk")
+
+
+class SharedNodes:
+    """
+    Node table (OSM ids and coordinates) of several networks and its
+    spatial index, saved in a snapshot directory without edges.
+
+    The snapshots of the networks are built on the table (see
+    GraphSnapshot.reindex) : each process maps the node arrays once, and
+    projects and indexes the nodes once for all the networks. A network
+    only adds its edges, its geometries and the segments of its index.
+    """
+
+    def __init__(self, snapshot, index):
+        """
+        Initialize the SharedNodes
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the node table, without edges (see GraphSnapshot.union_nodes)
+        index : SpatialIndex
+            index of the node table
+        """
+        self.snapshot = snapshot
+        self.index = index
+
+    @property
+    def n_nodes(self):
+        return self.snapshot.n_nodes
+
+    @classmethod
+    def build(cls, snapshots):
+        """Build the node table of the nodes of some snapshots"""
+        snapshot = GraphSnapshot.union_nodes(snapshots)
+        return cls(snapshot, SpatialIndex.build(snapshot))
+
+    def save(self, dirpath):
+        """
+        Save the node table and its index in a snapshot directory, the
+        snapshots built on the previous table are built again on this one
+        when they are loaded (see NYCRouteManager.share_nodes).
+        """
+        self.snapshot.save(dirpath)
+        self.index.save(dirpath)
+
+    @classmethod
+    def load(cls, dirpath):
+        """
+        Load a node table saved with `save`.
+
+        Returns
+        -------
+        SharedNodes or None if the table has not been saved
+        """
+        if not path.isdir(dirpath):
+            return None
+        snapshot = GraphSnapshot.load(dirpath)
+        index = SpatialIndex.load(snapshot, dirpath)
+        if index is None:
+            index = SpatialIndex.build(snapshot)
+            index.save(dirpath)
+        return cls(snapshot, index)
+
+    @classmethod
+    def prepare(cls, dirpath, snapshot_dirpaths):
+        """
+        Load the node table saved in dirpath, or build and save it if the
+        saved snapshots of the networks have nodes which are not in it.
+        Only one process builds it (under a file lock), the other ones load
+        the saved one.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the directory of the node table
+        snapshot_dirpaths : list
+            paths to the snapshot directories of the networks
+
+        Returns
+        -------
+        SharedNodes
+        """
+        dirpath = str(dirpath).rstrip(os.sep)
+        with file_lock(f"{dirpath}.lock"):
+            nodes = cls.load(dirpath)
+            snapshots = [GraphSnapshot.load(d) for d in snapshot_dirpaths]
+            if nodes is not None:
+                nodes_id = nodes.snapshot.snapshot_id
+                if all(s.meta.get("nodes_id") == nodes_id for s in snapshots):
+                    return nodes
+                # Snapshots built again with the same nodes : shared as they are
+                node_ids = np.unique(np.concatenate([s.node_ids for s in snapshots]))
+                if np.isin(node_ids, nodes.snapshot.node_ids).all():
+                    return nodes
+            cls.build(snapshots).save(dirpath)
+            return cls.load(dirpath)
+
+
+class NetworkRouteManagers:
+    """
+    Route managers of several networks of OSM (drive, bike, walk, ...), by
+    network type.
+
+    Each network has its own files and its own risk, computed by the same
+    pipeline from the victims of its users (see
+    risk_builder.NETWORK_SEVERITY) : pedestrians for walk, cyclists for
+    bike. With several networks, their snapshots share the node table
+    (see SharedNodes).
+    """
+
+    def __init__(
+        self,
+        network_types=NETWORK_TYPES,
+        reload_data=False,
+        partitioned=False,
+        manager_class=NYCRouteManager,
+    ):
+        """
+        Initialize the NetworkRouteManagers
+
+        Parameters
+        ----------
+        network_types : list
+            types of the networks, the first one is the default network
+        reload_data : boolean
+            If True, the OSM information and the risk of the networks are
+            reloaded, see NYCRouteManager
+        partitioned : boolean
+            If True, route in the borough cells, see NYCRouteManager
+        manager_class : type
+            class of the managers
+        """
+        self.network_types = tuple(dict.fromkeys(network_types))
+        if not self.network_types:
+            raise ValueError("At least one network type is needed")
+        self.managers = OrderedDict(
+            (
+                network_type,
+                manager_class(
+                    partitioned=partitioned, network_type=network_type, load=False
+                ),
+            )
+            for network_type in self.network_types
+        )
+        for manager in self.managers.values():
+            manager.prepare_snapshot(reload_data)
+        # Directory of the node table shared by the networks
+        self.nodes_dirpath = path.join(manager_class.data_dirpath, "NYC_nodes.snapshot")
+        self.nodes = None
+        if len(self.managers) > 1:
+            self.nodes = SharedNodes.prepare(
+                self.nodes_dirpath,
+                [manager.snapshot_dirpath for manager in self.managers.values()],
+            )
+        for manager in self.managers.values():
+            manager.nodes = self.nodes
+            manager.load_snapshot()
+
+    def __getitem__(self, network_type):
+        """
+        Returns the manager of a network, the default one for None.
+
+        Raises
+        ------
+        KeyError
+            If the network is not hosted.
+        """
+        if network_type is None:
+            return self.default
+        return self.managers[network_type]
+
+    def __contains__(self, network_type):
+        return network_type in self.managers
+
+    @property
+    def default(self):
+        """Manager of the first network type"""
+        return self.managers[self.network_types[0]]
+
+    @property
+    def load_seconds(self):
+        """network_type.stage:duration in seconds of the loading"""
+        return OrderedDict(
+            (f"{network_type}.{stage}", seconds)
+            for network_type, manager in self.managers.items()
+            for stage, seconds in manager.load_seconds.items()
+        )
+
+    def get_routes(self, point_from, point_to, route_types, mode=None, **kwargs):
+        """
+        Returns the routes between two points on the network of a mode, see
+        NYCRouteManager.get_routes.
+
+        Parameters
+        ----------
+        mode : string
+            network type, default : the default network
+
+        Raises
+        ------
+        KeyError
+            If the network is not hosted.
+        """
+        return self[mode].get_routes(point_from, point_to, route_types, **kwargs)
+
+    def get_alternative_routes(
+        self, point_from, point_to, route_type, mode=None, **kwargs
+    ):
+        """
+        Returns alternative routes between two points on the network of a
+        mode, see NYCRouteManager.get_alternative_routes.
+        """
+        return self[mode].get_alternative_routes(
+            point_from, point_to, route_type, **kwargs
+        )
+
+    def get_isochrone_geojson(self, point, cutoffs, mode=None, **kwargs):
+        """
+        Returns the areas reachable from a point on the network of a mode,
+        see NYCRouteManager.get_isochrone_geojson.
+        """
+        return self[mode].get_isochrone_geojson(point, cutoffs, **kwargs)
+
+    def start_route_pools(self):
+        """
+        Fork the route pool of each network (see
+        NYCRouteManager.get_route_pool), to call before the server threads
+        start.
+        """
+        for manager in self.managers.values():
+            manager.get_route_pool()
+
+    def save_route_cache(self):
+        """Save the route cache of each network"""
+        for manager in self.managers.values():
+            manager.save_route_cache()
+
+
+if __name__ == "__main__":
+    # Offline preprocessing and memory of the networks :
+    #   PYTHONPATH=website python -m utils.networks [drive bike walk]
+    import sys
+
+    from datetime import datetime
+    from utils.memory import process_memory
+
+    network_types = sys.argv[1:] or NETWORK_TYPES
+    print(f"[!] Start Networks: {datetime.now()}")
+    route_managers = NetworkRouteManagers(network_types)
+    print(f"[!] End Networks: {datetime.now()}")
+    if route_managers.nodes is not None:
+        print(f"[!] Shared nodes : {route_managers.nodes.n_nodes}")
+    for network_type, manager in route_managers.managers.items():
+        mask = manager.spatial_index.node_mask
+        n_nodes = int(mask.sum()) if mask is not None else manager.snapshot.n_nodes
+        print(f"[!] {network_type} : {n_nodes} nodes, {manager.snapshot.n_edges} edges")
+    memory = process_memory()
+    if memory is not None:
+        print(f"[!] Memory : rss {memory['rss'] / 2**20:.0f} MB")
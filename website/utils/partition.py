@@ -0,0 +1,637 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+from os import path
+
+from utils.graph_snapshot import GraphSnapshot
+from utils.profiles import compile_profiles, profile_weights
+from utils.route_engine import (
+    NoPathException,
+    RouteEngine,
+    haversine_to,
+    parallel_edges,
+)
+
+# Boroughs of the crash data, the cells of the partition
+BOROUGHS = ("Bronx", "Brooklyn", "Manhattan", "Queens", "Staten Island")
+# Maximum distance (in meters) between a crash and the node it labels
+CRASH_MAX_DIST = 200
+# Number of passes of the majority filter smoothing the borders of the cells
+SMOOTHING_PASSES = 3
+# Columns of the crash files giving the borough of the crashes
+BOROUGH_COLUMNS = ["latitude", "longitude", "borough"] + list(BOROUGHS)
+
+
+def crash_boroughs(chunk, names=BOROUGHS):
+    """
+    Returns the index in names of the borough of each crash of a chunk
+    (-1 if unknown), read in the `borough` column (raw export, crash
+    dataset) or in the one-hot borough columns (preprocessed files).
+    """
+    if "borough" in chunk:
+        lookup = {name.lower(): i for i, name in enumerate(names)}
+        return np.array(
+            [
+                lookup.get(b.strip().lower(), -1) if isinstance(b, str) else -1
+                for b in chunk["borough"]
+            ],
+            dtype=np.int64,
+        )
+    onehot = np.column_stack(
+        [
+            (
+                chunk[name].fillna(0).to_numpy(dtype=float)
+                if name in chunk
+                else np.zeros(len(chunk))
+            )
+            for name in names
+        ]
+    )
+    return np.where(onehot.any(axis=1), onehot.argmax(axis=1), -1)
+
+
+def _neighbour_votes(snapshot, cells, n_cells):
+    """Number of labelled neighbours (in both directions) of each node by cell"""
+    source = snapshot.edge_source
+    target = np.asarray(snapshot.edge_target)
+    votes = np.zeros((snapshot.n_nodes, n_cells))
+    for u, v in ((source, target), (target, source)):
+        labelled = cells[v] >= 0
+        np.add.at(votes, (u[labelled], cells[v][labelled]), 1)
+    return votes
+
+
+def node_cells(
+    snapshot,
+    spatial_index,
+    chunks,
+    names=BOROUGHS,
+    max_dist=CRASH_MAX_DIST,
+    passes=SMOOTHING_PASSES,
+):
+    """
+    Assign each node of the snapshot to a borough from the crashes.
+
+    Each crash votes for the borough of its nearest node (within max_dist
+    meters), a node takes the borough of most of its votes. The nodes
+    without crash take the borough of most of their neighbours, the parts
+    of the graph without any crash the one of the nearest labelled node.
+    A majority filter then smooths the borders, which shrinks the overlay.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    spatial_index : SpatialIndex
+        index of the nodes of the snapshot
+    chunks : iterable of pandas.DataFrame
+        crashes (see read_crashes with columns=BOROUGH_COLUMNS)
+    names : tuple
+        names of the boroughs
+    max_dist : float
+        maximum distance (in meters) between a crash and its node
+    passes : int
+        number of passes of the majority filter
+
+    Returns
+    -------
+    numpy.ndarray
+        index in names of the borough of each node
+    """
+    n_cells = len(names)
+    votes = np.zeros((snapshot.n_nodes, n_cells))
+    for chunk in chunks:
+        boroughs = crash_boroughs(chunk, names)
+        nodes, dists = spatial_index.nearest_nodes(
+            chunk["latitude"].to_numpy(dtype=float),
+            chunk["longitude"].to_numpy(dtype=float),
+            return_dist=True,
+        )
+        valid = (boroughs >= 0) & (dists <= max_dist)
+        np.add.at(votes, (nodes[valid], boroughs[valid]), 1)
+    cells = np.where(votes.any(axis=1), votes.argmax(axis=1), -1)
+    if not (cells >= 0).any():
+        return np.zeros(snapshot.n_nodes, dtype=np.int8)
+
+    # The nodes without crash take the cell of most of their neighbours
+    while True:
+        unknown = cells < 0
+        neighbours = _neighbour_votes(snapshot, cells, n_cells)
+        reached = unknown & neighbours.any(axis=1)
+        if not reached.any():
+            break
+        cells[reached] = neighbours[reached].argmax(axis=1)
+    # Parts of the graph without any crash : the cell of the nearest node
+    labelled = np.flatnonzero(cells >= 0)
+    for node in np.flatnonzero(cells < 0):
+        nearest = labelled[haversine_to(snapshot, node)[labelled].argmin()]
+        cells[node] = cells[nearest]
+
+    # Majority filter, a node keeps its cell on ties
+    own = np.arange(snapshot.n_nodes)
+    for _ in range(passes):
+        neighbours = _neighbour_votes(snapshot, cells, n_cells)
+        neighbours[own, cells] += 0.5
+        cells = neighbours.argmax(axis=1)
+    return cells.astype(np.int8)
+
+
+class PartitionedGraph:
+    """
+    The streets network split in cells (the boroughs) and an overlay graph
+    linking them, to route without the engine of the whole graph.
+
+    A cell is the subgraph of the nodes of a borough, with its own
+    RouteEngine. Its engine is built when a route needs it and only
+    `max_cells` are kept (the least recently used is dropped) : a worker
+    serving the routes within one borough holds the search arrays of
+    that borough only.
+
+    The overlay links the boundary nodes : the edges between two cells
+    (cut edges) and, for each cell, the shortest paths from each of its
+    entries (target of a cut edge) to each of its exits (source of a cut
+    edge), with the weights of each profile. A route between two cells
+    searches from the source to the exits of its cell, from the entries
+    of the cell of the target to the target, and between them on the
+    overlay. Its overlay edges are then expanded with searches in their
+    cells. The routes have the same weight as the routes of the whole
+    graph.
+
+    The overlay is computed with the weights of a risk version of a
+    snapshot (see build), it is saved in a directory (overlay arrays and
+    cell of each node) and loaded again while both are current.
+    """
+
+    format_version = 2
+    meta_filename = "meta.json"
+    array_names = ("node_cell", "overlay_source", "overlay_target", "overlay_cell")
+
+    def __init__(self, snapshot, arrays, meta, max_cells=2):
+        """
+        Initialize the PartitionedGraph
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the whole graph arrays
+        arrays : dict
+            node_cell, overlay_source, overlay_target, overlay_cell (-1 for
+            the cut edges) and the overlay weights of each profile
+        meta : dict
+            cell names, profiles (name:definition), snapshot_id and
+            risk_version
+        max_cells : int
+            maximum number of cell engines kept
+        """
+        self.snapshot = snapshot
+        self.arrays = arrays
+        self.meta = meta
+        self.cell_names = meta["cells"]
+        self.profiles = tuple(meta["profiles"])
+        # name:Profile of the cell engines
+        self.route_profiles = compile_profiles(meta["profiles"])
+        self.max_cells = max_cells
+        self.node_cell = np.asarray(arrays["node_cell"])
+        # cell:(indices of its nodes, RouteEngine), by last use
+        self._cells = OrderedDict()
+        self._cells_lock = threading.Lock()
+
+        source = np.asarray(arrays["overlay_source"])
+        target = np.asarray(arrays["overlay_target"])
+        cut = np.asarray(arrays["overlay_cell"]) < 0
+        self.n_cut_edges = int(cut.sum())
+        # Boundary nodes of each cell, as indices of the whole graph
+        self.exits = {}
+        self.entries = {}
+        for cell in range(len(self.cell_names)):
+            self.exits[cell] = np.unique(
+                source[cut][self.node_cell[source[cut]] == cell]
+            )
+            self.entries[cell] = np.unique(
+                target[cut][self.node_cell[target[cut]] == cell]
+            )
+
+        # Overlay graph on the boundary nodes (sorted indices of the graph)
+        self.overlay_nodes = np.union1d(source, target)
+        self._overlay_index = {
+            node: i for i, node in enumerate(self.overlay_nodes.tolist())
+        }
+        local_source = np.searchsorted(self.overlay_nodes, source)
+        local_target = np.searchsorted(self.overlay_nodes, target)
+        order = np.lexsort((local_target, local_source))
+        n_nodes, n_edges = len(self.overlay_nodes), len(order)
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(local_source, minlength=n_nodes), out=indptr[1:])
+        overlay = GraphSnapshot(
+            {
+                "node_ids": np.asarray(snapshot.node_ids)[self.overlay_nodes],
+                "node_x": np.asarray(snapshot.node_x)[self.overlay_nodes],
+                "node_y": np.asarray(snapshot.node_y)[self.overlay_nodes],
+                "indptr": indptr,
+                "edge_target": local_target[order].astype(np.int32),
+                "edge_key": np.zeros(n_edges, dtype=np.int64),
+                "edge_length": np.zeros(n_edges),
+                "edge_risk": np.zeros(n_edges),
+                "edge_global_risk": np.zeros(n_edges),
+                "geom_offsets": np.zeros(n_edges + 1, dtype=np.int64),
+                "geom_x": np.zeros(0),
+                "geom_y": np.zeros(0),
+            },
+            {"overlay_of": snapshot.snapshot_id},
+        )
+        self.overlay_engine = RouteEngine(overlay)
+        for profile in self.profiles:
+            weights = np.asarray(arrays[f"overlay_{profile}"])[order]
+            self.overlay_engine.set_weights(profile, weights)
+
+    @property
+    def n_cells(self):
+        return len(self.cell_names)
+
+    @staticmethod
+    def _cell_engine(snapshot, nodes, profiles):
+        """Returns the RouteEngine of the subgraph of some nodes"""
+        return RouteEngine.from_snapshot(snapshot.subset(nodes)[0], profiles)
+
+    def cell(self, cell):
+        """
+        Returns the nodes (indices of the whole graph) and the RouteEngine
+        of a cell, built on the first use, then kept until max_cells more
+        recently used cells are loaded.
+        """
+        with self._cells_lock:
+            loaded = self._cells.get(cell)
+            if loaded is not None:
+                self._cells.move_to_end(cell)
+                return loaded
+        nodes = np.flatnonzero(self.node_cell == cell)
+        loaded = (nodes, self._cell_engine(self.snapshot, nodes, self.route_profiles))
+        with self._cells_lock:
+            self._cells[cell] = loaded
+            while len(self._cells) > self.max_cells:
+                self._cells.popitem(last=False)
+        return loaded
+
+    def loaded_cells(self):
+        """Returns the names of the loaded cells, the most recently used last"""
+        with self._cells_lock:
+            return [self.cell_names[cell] for cell in self._cells]
+
+    @classmethod
+    def build(
+        cls, snapshot, node_cell, cell_names=BOROUGHS, max_cells=2, profiles=None
+    ):
+        """
+        Compute the overlay of a partition of the snapshot with the weights
+        of its current risk.
+
+        The cell engines are built one at a time then dropped, the engine
+        of the whole graph is not built.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the whole graph arrays
+        node_cell : numpy.ndarray
+            index of the cell of each node (see node_cells)
+        cell_names : tuple
+            names of the cells
+        max_cells : int
+            maximum number of cell engines kept
+        profiles : dict
+            name:Profile of the routes, default : profiles.PROFILES
+
+        Returns
+        -------
+        PartitionedGraph
+        """
+        profiles = profiles or compile_profiles()
+        node_cell = np.asarray(node_cell, dtype=np.int8)
+        source = snapshot.edge_source
+        target = np.asarray(snapshot.edge_target)
+
+        # Cut edges : the pairs of parallel edges between two cells, with
+        # the minimum weight of their edges as in RouteEngine
+        pair_start, _ = parallel_edges(snapshot)
+        edge_weights = profile_weights(snapshot, profiles)
+        cut = np.flatnonzero(
+            node_cell[source[pair_start]] != node_cell[target[pair_start]]
+        )
+        overlay_source = [source[pair_start[cut]]]
+        overlay_target = [target[pair_start[cut]]]
+        overlay_cell = [np.full(len(cut), -1)]
+        overlay_weights = {
+            profile: [np.minimum.reduceat(weights, pair_start)[cut]]
+            for profile, weights in edge_weights.items()
+        }
+        del edge_weights
+
+        # Cliques : the shortest paths from each entry of a cell to each of
+        # its exits, searched in the cell
+        exits = np.unique(overlay_source[0])
+        entries = np.unique(overlay_target[0])
+        for cell in range(len(cell_names)):
+            nodes = np.flatnonzero(node_cell == cell)
+            cell_exits = np.searchsorted(nodes, exits[node_cell[exits] == cell])
+            cell_entries = np.searchsorted(nodes, entries[node_cell[entries] == cell])
+            if not len(cell_exits) or not len(cell_entries):
+                continue
+            engine = cls._cell_engine(snapshot, nodes, profiles)
+            targets = set(cell_exits.tolist())
+            clique = {}
+            for profile in profiles:
+                for entry in cell_entries.tolist():
+                    tree = engine.shortest_path_tree(
+                        {entry: 0}, profile, targets=targets
+                    )
+                    for exit in targets:
+                        if exit != entry and exit in tree.dist:
+                            weights = clique.setdefault((entry, exit), {})
+                            weights[profile] = tree.dist[exit]
+            ends = np.array(list(clique), dtype=np.int64).reshape(-1, 2)
+            overlay_source.append(nodes[ends[:, 0]])
+            overlay_target.append(nodes[ends[:, 1]])
+            overlay_cell.append(np.full(len(ends), cell))
+            for profile in profiles:
+                overlay_weights[profile].append(
+                    np.array(
+                        [w.get(profile, np.inf) for w in clique.values()], dtype=float
+                    )
+                )
+
+        arrays = {
+            "node_cell": node_cell,
+            "overlay_source": np.concatenate(overlay_source).astype(np.int64),
+            "overlay_target": np.concatenate(overlay_target).astype(np.int64),
+            "overlay_cell": np.concatenate(overlay_cell).astype(np.int8),
+        }
+        for profile in profiles:
+            arrays[f"overlay_{profile}"] = np.concatenate(overlay_weights[profile])
+        meta = {
+            "format": cls.format_version,
+            "cells": list(cell_names),
+            "profiles": {
+                name: profile.definition for name, profile in profiles.items()
+            },
+            "snapshot_id": snapshot.snapshot_id,
+            "risk_version": snapshot.risk_version,
+        }
+        return cls(snapshot, arrays, meta, max_cells)
+
+    def save(self, dirpath):
+        """
+        Save the partition (cell of each node, overlay arrays and weights)
+        in a directory of `.npy` files, replaced at once.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the partition directory
+        """
+        dirpath = str(dirpath).rstrip(os.sep)
+        tmp_dirpath = f"{dirpath}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dirpath, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(path.join(tmp_dirpath, f"{name}.npy"), array)
+        with open(path.join(tmp_dirpath, self.meta_filename), "w") as f:
+            json.dump(self.meta, f)
+        old_dirpath = f"{dirpath}.{os.getpid()}.old"
+        if path.isdir(dirpath):
+            os.rename(dirpath, old_dirpath)
+        os.rename(tmp_dirpath, dirpath)
+        shutil.rmtree(old_dirpath, ignore_errors=True)
+
+    @classmethod
+    def read_meta(cls, dirpath):
+        """Returns the meta.json of a saved partition, None if missing"""
+        try:
+            with open(path.join(dirpath, cls.meta_filename)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, snapshot, dirpath, max_cells=2, profiles=None):
+        """
+        Load a partition saved with `save`.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the whole graph arrays
+        dirpath : string or pathlib.Path
+            path to the partition directory
+        max_cells : int
+            maximum number of cell engines kept
+        profiles : dict
+            name:Profile of the routes, default : profiles.PROFILES
+
+        Returns
+        -------
+        PartitionedGraph or None if the partition is missing or has been
+        computed for another snapshot, another risk version or other
+        profiles
+        """
+        profiles = profiles or compile_profiles()
+        meta = cls.read_meta(dirpath)
+        if (
+            meta is None
+            or meta.get("format") != cls.format_version
+            or meta.get("snapshot_id") != snapshot.snapshot_id
+            or meta.get("risk_version") != snapshot.risk_version
+            or meta.get("profiles")
+            != {name: profile.definition for name, profile in profiles.items()}
+        ):
+            return None
+        names = cls.array_names + tuple(f"overlay_{p}" for p in meta["profiles"])
+        try:
+            arrays = {
+                name: np.load(path.join(dirpath, f"{name}.npy"), mmap_mode="r")
+                for name in names
+            }
+        except OSError:
+            return None
+        return cls(snapshot, arrays, meta, max_cells)
+
+    @classmethod
+    def load_node_cell(cls, snapshot, dirpath):
+        """
+        Returns the cell of each node saved with a partition of this
+        snapshot (whatever its risk version), None if there is none.
+        """
+        meta = cls.read_meta(dirpath)
+        if meta is None or meta.get("snapshot_id") != snapshot.snapshot_id:
+            return None
+        try:
+            return np.load(path.join(dirpath, "node_cell.npy"))
+        except OSError:
+            return None
+
+    def shortest_path(self, source, target, weight="shortest"):
+        """
+        Returns the shortest weighted path from source to target, searched
+        in their cells and on the overlay (see the class docstring).
+
+        Parameters
+        ----------
+        source : int
+            index (in the whole graph) of the starting node
+        target : int
+            index (in the whole graph) of the destination node
+        weight : string
+            name of the profile
+
+        Returns
+        -------
+        list
+            indices (in the whole graph) of the nodes of the path
+
+        Raises
+        ------
+        NoPathException
+            If no path exists between source and target.
+        """
+        if source == target:
+            return [source]
+        source_cell = int(self.node_cell[source])
+        target_cell = int(self.node_cell[target])
+        nodes, engine = self.cell(source_cell)
+        local_source = int(np.searchsorted(nodes, source))
+        exits = np.searchsorted(nodes, self.exits[source_cell]).tolist()
+        targets = set(exits)
+        local_target = None
+        if source_cell == target_cell:
+            # The exits settled after the target can't give a shorter route
+            local_target = int(np.searchsorted(nodes, target))
+            targets = {local_target}
+        forward = engine.shortest_path_tree({local_source: 0}, weight, targets=targets)
+
+        best, best_path = float("inf"), None
+        if local_target is not None and local_target in forward.dist:
+            best = forward.dist[local_target]
+            best_path = nodes[engine.tree_path(forward, local_target)].tolist()
+
+        starts = {
+            self._overlay_index[nodes[x]]: forward.dist[x]
+            for x in exits
+            if x in forward.dist and forward.dist[x] < best
+        }
+        if starts and len(self.entries[target_cell]):
+            target_nodes, target_engine = self.cell(target_cell)
+            local_target = int(np.searchsorted(target_nodes, target))
+            entries = np.searchsorted(target_nodes, self.entries[target_cell]).tolist()
+            backward = target_engine.shortest_path_tree(
+                {local_target: 0},
+                weight,
+                targets=set(entries),
+                cutoff=best,
+                reverse=True,
+            )
+            ends = {
+                self._overlay_index[target_nodes[e]]: backward.dist[e]
+                for e in entries
+                if e in backward.dist
+            }
+            try:
+                overlay_path = (
+                    self.overlay_engine.shortest_path_between(starts, ends, weight)
+                    if ends
+                    else None
+                )
+            except NoPathException:
+                overlay_path = None
+            if overlay_path is not None:
+                cost = starts[overlay_path[0]] + ends[overlay_path[-1]]
+                pair_weights = self.overlay_engine.pair_weights[weight]
+                for u, v in zip(overlay_path[:-1], overlay_path[1:]):
+                    cost += pair_weights[self.overlay_engine.pair_index(u, v)]
+                if cost < best:
+                    best = cost
+                    first = self.overlay_nodes[overlay_path[0]]
+                    last = self.overlay_nodes[overlay_path[-1]]
+                    head = nodes[
+                        engine.tree_path(forward, int(np.searchsorted(nodes, first)))
+                    ]
+                    tail = target_nodes[
+                        target_engine.tree_path(
+                            backward, int(np.searchsorted(target_nodes, last))
+                        )
+                    ]
+                    best_path = (
+                        head[:-1].tolist()
+                        + self._expand(overlay_path, weight)
+                        + tail[1:].tolist()
+                    )
+
+        if best_path is None or best == float("inf"):
+            raise NoPathException(f"No path between {source} and {target}")
+        return best_path
+
+    def _expand(self, overlay_path, weight):
+        """
+        Returns the nodes (indices of the whole graph) of a path of the
+        overlay : the cut edges are kept, the clique edges are searched
+        again in their cell.
+        """
+        path = [int(self.overlay_nodes[overlay_path[0]])]
+        for u, v in zip(overlay_path[:-1], overlay_path[1:]):
+            u, v = int(self.overlay_nodes[u]), int(self.overlay_nodes[v])
+            cell = int(self.node_cell[u])
+            if cell != self.node_cell[v]:
+                path.append(v)
+                continue
+            nodes, engine = self.cell(cell)
+            sub_path = engine.shortest_path(
+                int(np.searchsorted(nodes, u)), int(np.searchsorted(nodes, v)), weight
+            )
+            path.extend(nodes[sub_path[1:]].tolist())
+        return path
+
+    def route_edges(self, path):
+        """
+        Returns the snapshot edges followed by a path, as
+        RouteEngine.route_edges does : the shortest of the parallel edges
+        between each two nodes (the first one on ties).
+
+        Raises
+        ------
+        KeyError
+            If two consecutive nodes of the path are not linked.
+        """
+        indptr = self.snapshot.indptr
+        edges = []
+        for u, v in zip(path[:-1], path[1:]):
+            start = int(indptr[u])
+            targets = np.asarray(self.snapshot.edge_target[start : indptr[u + 1]])
+            parallel = start + np.flatnonzero(targets == v)
+            if not len(parallel):
+                raise KeyError(f"No edge between consecutive nodes of {path}")
+            length = np.asarray(self.snapshot.edge_length[parallel])
+            # NaN lengths last, as the lexsort of RouteEngine
+            edges.append(parallel[np.lexsort((length,))[0]])
+        return np.array(edges, dtype=np.int64)
+
+
+if __name__ == "__main__":
+    # Offline preprocessing :
+    #   PYTHONPATH=website python -m utils.partition [crash file]
+    import sys
+
+    from datetime import datetime
+    from utils.NYCRouteManager import NYCRouteManager
+
+    nyc_manager = NYCRouteManager()
+    print(f"[!] Start Partition: {datetime.now()}")
+    partition = nyc_manager.build_partition(sys.argv[1] if len(sys.argv) > 1 else None)
+    counts = np.bincount(partition.node_cell, minlength=partition.n_cells)
+    for name, count in zip(partition.cell_names, counts):
+        print(f"[!] {name} : {count} nodes")
+    print(
+        f"[!] End Partition: {datetime.now()} ({len(partition.overlay_nodes)} "
+        f"boundary nodes, {partition.n_cut_edges} edges between the cells)"
+    )
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def encode_polyline(coords, precision=5):
+    """
+    Encode coordinates with the Encoded Polyline Algorithm Format (the
+    format of the Google Maps API, decoded by most map libraries).
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        (lng, lat) coordinates of the points, as in RouteGeometry
+    precision : int
+        number of decimals kept (5 is about 1 meter)
+
+    Returns
+    -------
+    string
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    # The format encodes (lat, lng) deltas between consecutive points
+    values = np.round(coords[:, ::-1] * 10**precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=[[0, 0]]).ravel()
+    deltas = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    chunks = []
+    for value in deltas.tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def decode_polyline(text, precision=5):
+    """
+    Decode a polyline encoded by `encode_polyline`.
+
+    Parameters
+    ----------
+    text : string
+        the encoded polyline
+    precision : int
+        number of decimals of the encoded coordinates
+
+    Returns
+    -------
+    numpy.ndarray
+        (lng, lat) coordinates of the points
+    """
+    values, value, shift = [], 0, 0
+    for char in text:
+        byte = ord(char) - 63
+        value |= (byte & 0x1F) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    latlng = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    return latlng[:, ::-1] / 10**precision
@@ -0,0 +1,134 @@
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from os import path
+
+# Directory of the profiles of the slow requests
+PROFILES_DIRPATH = "data/profiles"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of one thread : a daemon thread reads the stack of
+    the profiled thread every `interval` seconds (sys._current_frames).
+
+    The stacks are counted in the "folded" format (one line per stack,
+    frames from the root separated by ";", then the number of samples),
+    which flamegraph.pl, speedscope or inferno turn into a flamegraph.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        """
+        Initialize the SamplingProfiler
+
+        Parameters
+        ----------
+        thread_id : int
+            ident of the profiled thread, default : the current thread
+        interval : float
+            time (in seconds) between two samples
+        """
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return (
+            f"{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})"
+        )
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            names = []
+            while frame is not None:
+                names.append(self._frame_name(frame).replace(";", ":"))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self):
+        """Returns the sampled stacks in the folded format"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+class SlowRequestProfiler:
+    """
+    Profiles each request (see SamplingProfiler) and keeps the profiles of
+    the requests slower than a threshold, as folded stacks files.
+
+    Only the thread of the request is sampled : the searches of the route
+    pool and the geocoding threads are seen as waits (set route_workers
+    of the NYCRouteManager to 0 to profile the searches).
+    """
+
+    def __init__(self, threshold, dirpath=PROFILES_DIRPATH, interval=0.005):
+        """
+        Initialize the SlowRequestProfiler
+
+        Parameters
+        ----------
+        threshold : float
+            minimum duration (in seconds) of the profiled requests
+        dirpath : string
+            directory of the profiles
+        interval : float
+            time (in seconds) between two samples
+        """
+        self.threshold = threshold
+        self.dirpath = dirpath
+        self.interval = interval
+
+    def start(self):
+        """Start profiling the current thread, returns (profiler, start time)"""
+        return SamplingProfiler(interval=self.interval).start(), time.perf_counter()
+
+    def finish(self, started, name):
+        """
+        Stop a profile started by start, save it if the request was slower
+        than the threshold.
+
+        Parameters
+        ----------
+        started : tuple
+            value returned by start
+        name : string
+            name of the request, used in the file name
+
+        Returns
+        -------
+        string or None
+            path to the saved profile
+        """
+        profiler, start = started
+        duration = time.perf_counter() - start
+        profiler.stop()
+        if duration < self.threshold or not profiler.stacks:
+            return None
+        os.makedirs(self.dirpath, exist_ok=True)
+        filepath = path.join(
+            self.dirpath,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{duration * 1000:.0f}ms"
+            f"-{os.getpid()}.folded",
+        )
+        with open(filepath, "w") as f:
+            f.write(profiler.folded())
+        return filepath
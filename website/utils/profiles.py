@@ -0,0 +1,322 @@
+import ast
+import hashlib
+import json
+
+import numpy as np
+
+# Edge attributes of the expressions, arrays of the snapshot :
+#   length : length of the edge in meters
+#   risk : risk of the street of the edge
+#   global_risk : risk of the edge, of the time bucket with a departure time
+#   time_factor : factor of the risk of the time bucket (1 without departure
+#       time or without time risk)
+EDGE_VARIABLES = ("length", "risk", "global_risk", "time_factor")
+# Scalars of the expressions : the time bucket of the departure time, -1
+# without departure time
+TIME_VARIABLES = ("hour", "day_of_week")
+# Variables making the weights depend on the departure time
+TIME_DEPENDENT = ("global_risk", "time_factor") + TIME_VARIABLES
+
+
+class ProfileException(Exception):
+    pass
+
+
+def band(values, bounds, weights):
+    """
+    Banding of the values : weights[i] where i is the number of bounds
+    lower or equal to the value, e.g. band(x, [3, 7], [500, 250, 1]) is
+    500 below 3, 250 from 3 to 7 and 1 from 7.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    if len(weights) != len(bounds) + 1:
+        raise ProfileException(
+            f"band needs one weight more than its bounds, got {len(bounds)} "
+            f"bounds and {len(weights)} weights"
+        )
+    if np.any(np.diff(bounds) <= 0):
+        raise ProfileException(f"The bounds of band must increase : {bounds}")
+    return weights[np.digitize(values, bounds)]
+
+
+# Functions of the expressions, applied on whole arrays
+FUNCTIONS = {
+    "band": band,
+    "where": np.where,
+    "minimum": np.minimum,
+    "maximum": np.maximum,
+    "clip": np.clip,
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "log1p": np.log1p,
+    "exp": np.exp,
+}
+# Syntax of the expressions : arithmetic, comparisons, & | ~ on the
+# comparisons, calls of FUNCTIONS and lists of numbers
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.List,
+    ast.Tuple,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+    ast.Invert,
+    ast.BitAnd,
+    ast.BitOr,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+)
+
+# Route profiles of the engine : the weight expression of an edge and the
+# value of its attributes when they are missing (NaN)
+PROFILES = {
+    "shortest": {"weight": "length", "fill": {"length": 1.0}},
+    "safest": {"weight": "global_risk", "fill": {"global_risk": 1.0}},
+    "safest_streets": {
+        "weight": "length * (global_risk + 1)",
+        "fill": {"length": 0.0, "global_risk": 0.0},
+    },
+    # The more dangerous the edge is, the lower its weight is
+    "dangerous": {
+        "weight": (
+            "length * where(global_risk == 0, 1000,"
+            " band(global_risk, [3, 7, 10], [500, 250, 100, 1]))"
+        ),
+        "fill": {"length": 1.0, "global_risk": 0.0},
+    },
+}
+
+
+class Profile:
+    """
+    Route profile compiled from its definition : an expression over the
+    attributes of an edge (see EDGE_VARIABLES and TIME_VARIABLES) giving
+    its weight, e.g. "length * (global_risk + 1)".
+
+    The expression is parsed and checked once, then evaluated on the whole
+    arrays of a snapshot : each edge is weighted with its own attributes,
+    the route engine keeps the minimum weight of the parallel edges.
+    """
+
+    def __init__(self, name, weight, fill=None):
+        """
+        Initialize the Profile
+
+        Parameters
+        ----------
+        name : string
+            name of the profile
+        weight : string
+            expression of the weight of an edge
+        fill : dict
+            variable:value used where the attribute is missing (NaN)
+
+        Raises
+        ------
+        ProfileException
+            If the name (a Python identifier) or the expression is not
+            valid.
+        """
+        if not name.isidentifier():
+            raise ProfileException(f"Invalid profile name : {name!r}")
+        self.name = name
+        self.weight = weight
+        self.fill = {key: float(value) for key, value in (fill or {}).items()}
+        try:
+            tree = ast.parse(weight, mode="eval")
+        except SyntaxError as err:
+            raise ProfileException(f"Invalid weight of {name} : {err}")
+        names = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ProfileException(
+                    f"{type(node).__name__} is not allowed in the weight of {name}"
+                )
+            if isinstance(node, ast.Constant) and type(node.value) not in (
+                int,
+                float,
+            ):
+                raise ProfileException(f"Only numbers are allowed in {name}")
+            if isinstance(node, ast.Call) and (
+                not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS
+            ):
+                raise ProfileException(f"Unknown function in the weight of {name}")
+            if isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+                names.add(node.id)
+        unknown = names - set(EDGE_VARIABLES + TIME_VARIABLES)
+        unknown |= set(self.fill) - set(EDGE_VARIABLES)
+        if unknown:
+            raise ProfileException(f"Unknown variables in {name} : {sorted(unknown)}")
+        # Variables of the expression, only these arrays are read
+        self.variables = tuple(v for v in EDGE_VARIABLES + TIME_VARIABLES if v in names)
+        self._code = compile(tree, f"<profile {name}>", "eval")
+
+    @classmethod
+    def from_definition(cls, name, definition):
+        """
+        Compile a definition : the weight expression or a dict with the
+        `weight` expression and the `fill` values (see PROFILES).
+        """
+        if isinstance(definition, str):
+            definition = {"weight": definition}
+        if not isinstance(definition, dict) or "weight" not in definition:
+            raise ProfileException(f"The definition of {name} needs a weight")
+        return cls(name, definition["weight"], definition.get("fill"))
+
+    @property
+    def definition(self):
+        """The definition of the profile, JSON-serializable"""
+        return {"weight": self.weight, "fill": dict(self.fill)}
+
+    @property
+    def uses_time(self):
+        """True if the weights depend on the departure time"""
+        return any(name in TIME_DEPENDENT for name in self.variables)
+
+    def weights(self, snapshot, global_risk=None, time_factor=None, bucket=None):
+        """
+        Evaluate the weight of each edge of a snapshot.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        global_risk : numpy.ndarray
+            global risk of each edge, default : the one of the snapshot
+        time_factor : numpy.ndarray
+            risk factor of each edge during the time bucket, default : 1
+        bucket : int
+            time bucket of the departure time (see time_risk.time_bucket),
+            None without departure time
+
+        Returns
+        -------
+        numpy.ndarray
+            float weight of each edge
+
+        Raises
+        ------
+        ProfileException
+            If a weight is negative or NaN (Dijkstra needs positive
+            weights) or if the expression can't be evaluated.
+        """
+        arrays = {
+            "length": lambda: snapshot.edge_length,
+            "risk": lambda: snapshot.edge_risk,
+            "global_risk": lambda: (
+                snapshot.edge_global_risk if global_risk is None else global_risk
+            ),
+            "time_factor": lambda: 1.0 if time_factor is None else time_factor,
+        }
+        namespace = dict(FUNCTIONS)
+        for name in self.variables:
+            if name in arrays:
+                values = np.asarray(arrays[name](), dtype=float)
+                if name in self.fill:
+                    values = np.nan_to_num(values, nan=self.fill[name])
+                namespace[name] = values
+        namespace["hour"] = -1 if bucket is None else bucket % 24
+        namespace["day_of_week"] = -1 if bucket is None else bucket // 24
+        try:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                weights = eval(self._code, {"__builtins__": {}}, namespace)
+            weights = np.array(
+                np.broadcast_to(weights, (snapshot.n_edges,)), dtype=float
+            )
+        except (TypeError, ValueError, ZeroDivisionError) as err:
+            raise ProfileException(f"Can't evaluate the weight of {self.name} : {err}")
+        if np.isnan(weights).any() or (weights < 0).any():
+            raise ProfileException(
+                f"The weights of {self.name} must be positive numbers (use fill "
+                f"for the missing attributes)"
+            )
+        return weights
+
+
+def compile_profiles(definitions=PROFILES):
+    """
+    Compile profile definitions.
+
+    Parameters
+    ----------
+    definitions : dict
+        name:definition, see Profile.from_definition
+
+    Returns
+    -------
+    dict
+        name:Profile
+    """
+    return {
+        name: Profile.from_definition(name, definition)
+        for name, definition in definitions.items()
+    }
+
+
+def read_profiles(filepath):
+    """
+    Read the profile definitions of a JSON file (name:definition).
+
+    Raises
+    ------
+    ProfileException
+        If the file is not a JSON object.
+    """
+    try:
+        with open(filepath) as f:
+            definitions = json.load(f)
+    except ValueError as err:
+        raise ProfileException(f"Invalid profiles file {filepath} : {err}")
+    if not isinstance(definitions, dict):
+        raise ProfileException(f"{filepath} must map profile names to definitions")
+    return definitions
+
+
+def profiles_digest(profiles):
+    """Digest of the definitions of compiled profiles (name:Profile)"""
+    definitions = {name: profile.definition for name, profile in profiles.items()}
+    return hashlib.sha1(json.dumps(definitions, sort_keys=True).encode()).hexdigest()[
+        :16
+    ]
+
+
+def profile_weights(snapshot, profiles, names=None, **kwargs):
+    """
+    Evaluate the weights of compiled profiles on a snapshot.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    profiles : dict
+        name:Profile
+    names : list
+        names of the profiles to evaluate, default : all of them
+    kwargs : dict
+        global_risk, time_factor and bucket, see Profile.weights
+
+    Returns
+    -------
+    dict
+        profile:weight of each edge
+    """
+    names = list(profiles) if names is None else names
+    return {name: profiles[name].weights(snapshot, **kwargs) for name in names}
@@ -0,0 +1,528 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from functools import partial
+from os import path
+
+# Columns of the raw NYPD collisions export and their name in the
+# preprocessed crash files (data_10000_out_final.csv)
+RAW_COLUMNS = {
+    "number_of_persons_injured": "persons_injured",
+    "number_of_persons_killed": "persons_killed",
+    "number_of_pedestrians_injured": "pedestrians_injured",
+    "number_of_pedestrians_killed": "pedestrians_killed",
+    "number_of_cyclist_injured": "cyclist_injured",
+    "number_of_cyclist_killed": "cyclist_killed",
+    "number_of_motorist_injured": "motorist_injured",
+    "number_of_motorist_killed": "motorist_killed",
+}
+# Date of the crash : preprocessed columns or raw NYPD columns
+TIME_COLUMNS = [
+    "year",
+    "month",
+    "day",
+    "day_of_week",
+    "hour",
+    "crash_date",
+    "crash_time",
+]
+CRASH_COLUMNS = (
+    ["collision_id", "latitude", "longitude"]
+    + list(RAW_COLUMNS.values())
+    + TIME_COLUMNS
+)
+
+# Files of the incremental risk state, saved in the snapshot directory
+RISK_STATE_FILENAME = "risk_state.json"
+SEVERITY_FILENAME = "edge_severity.npy"
+
+# Severity of a crash : 1 + weight * number of victims
+SEVERITY_WEIGHTS = {"persons_injured": 3, "persons_killed": 20}
+# Severity of the crashes for the users of each network type (see
+# network_severity) : base severity of a crash and weight of its victims.
+# The walking and cycling risk only counts the pedestrian and cyclist victims.
+NETWORK_SEVERITY = {
+    "drive": (1, SEVERITY_WEIGHTS),
+    "bike": (0, {"cyclist_injured": 3, "cyclist_killed": 20}),
+    "walk": (0, {"pedestrians_injured": 3, "pedestrians_killed": 20}),
+}
+
+# Length (in meters) of street on which global_risk is expressed
+RISK_LENGTH = 100
+
+
+def read_crashes(filepath, chunksize=500000, columns=None):
+    """
+    Read a crash file by chunks.
+
+    Both the raw NYPD export (`number_of_persons_injured`, ...) and the
+    preprocessed files (`persons_injured`, ...) are accepted, the columns
+    are renamed to the preprocessed names. The rows without coordinates
+    are dropped. A crash dataset directory (see CrashDataset) is read from
+    its mapped columns.
+
+    Parameters
+    ----------
+    filepath : string or pathlib.Path
+        path to the CSV file or to the crash dataset directory
+    chunksize : int
+        number of rows read at once, bounds the memory used
+    columns : list
+        columns to read (preprocessed names), default : CRASH_COLUMNS
+
+    Yields
+    ------
+    pandas.DataFrame
+    """
+    columns = columns or CRASH_COLUMNS
+    if path.isdir(str(filepath)):
+        # Imported here : crash_dataset imports this module
+        from utils.crash_dataset import CrashDataset
+
+        yield from CrashDataset.load(filepath).chunks(columns, chunksize)
+        return
+    raw_names = {v: k for k, v in RAW_COLUMNS.items()}
+    wanted = set(columns) | {raw_names[c] for c in columns if c in raw_names}
+    for chunk in pd.read_csv(
+        filepath, chunksize=chunksize, usecols=lambda c: c in wanted
+    ):
+        chunk = chunk.rename(columns=RAW_COLUMNS)
+        chunk = chunk.dropna(subset=["latitude", "longitude"])
+        # The raw export uses 0 for the unknown coordinates
+        chunk = chunk[(chunk["latitude"] != 0) & (chunk["longitude"] != 0)]
+        yield chunk
+
+
+def crash_severity(crashes, weights=None, base=1):
+    """
+    Severity of each crash : base + weighted number of victims.
+
+    Parameters
+    ----------
+    crashes : pandas.DataFrame
+        crashes with the columns of `weights`
+    weights : dict
+        column:weight, default : SEVERITY_WEIGHTS
+    base : float
+        severity of a crash without victims
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    weights = weights or SEVERITY_WEIGHTS
+    severity = np.full(len(crashes), float(base))
+    for column, weight in weights.items():
+        if column in crashes:
+            severity += weight * crashes[column].fillna(0).to_numpy(dtype=float)
+    return severity
+
+
+def network_severity(network_type):
+    """
+    Returns the severity function of the crashes for the users of a network
+    type (see NETWORK_SEVERITY, the one of "drive" for the other types).
+    """
+    base, weights = NETWORK_SEVERITY.get(network_type, NETWORK_SEVERITY["drive"])
+    return partial(crash_severity, weights=weights, base=base)
+
+
+def crash_timestamps(crashes):
+    """
+    Hour of each crash as an integer YYYYMMDDHH, comparable with a
+    watermark.
+
+    Parameters
+    ----------
+    crashes : pandas.DataFrame
+        crashes with year/month/day/hour columns (preprocessed files) or
+        crash_date/crash_time columns (raw NYPD export)
+
+    Returns
+    -------
+    numpy.ndarray
+        -1 if the date or the hour of the crash is missing or invalid
+    """
+    if {"year", "month", "day", "hour"}.issubset(crashes.columns):
+        date = pd.to_datetime(crashes[["year", "month", "day"]], errors="coerce")
+        hour = pd.to_numeric(crashes["hour"], errors="coerce")
+    else:
+        date = pd.to_datetime(crashes["crash_date"], errors="coerce")
+        # "13:37" or "13:37:00"
+        hour = crashes["crash_time"].astype(str).str.split(":").str[0]
+        hour = pd.to_numeric(hour, errors="coerce")
+    year, month, day, hour = (
+        values.to_numpy(dtype=float)
+        for values in (date.dt.year, date.dt.month, date.dt.day, hour)
+    )
+    stamps = ((year * 100 + month) * 100 + day) * 100 + hour
+    with np.errstate(invalid="ignore"):
+        valid = (
+            np.isfinite(stamps) & (hour >= 0) & (hour < 24) & (hour == np.floor(hour))
+        )
+    timestamps = np.full(len(crashes), -1, dtype=np.int64)
+    timestamps[valid] = stamps[valid]
+    return timestamps
+
+
+def crash_keys(crashes):
+    """
+    Key of each crash, to recognize the crashes already ingested : its
+    collision_id (raw NYPD export), else a hash of its hour, its position
+    and its victims.
+
+    Parameters
+    ----------
+    crashes : pandas.DataFrame
+        crashes, see read_crashes
+
+    Returns
+    -------
+    numpy.ndarray
+        uint64 keys
+    """
+    if "collision_id" in crashes.columns:
+        ids = pd.to_numeric(crashes["collision_id"], errors="coerce")
+        if ids.notna().all():
+            return ids.to_numpy(dtype=np.uint64)
+    columns = ["latitude", "longitude"] + list(RAW_COLUMNS.values())
+    values = pd.DataFrame(
+        {
+            c: pd.to_numeric(crashes[c], errors="coerce").to_numpy(dtype=float)
+            for c in columns
+            if c in crashes.columns
+        }
+    )
+    values["hour"] = crash_timestamps(crashes)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+
+
+def crash_buckets(crashes):
+    """
+    Time bucket of each crash : day_of_week * 24 + hour, with Monday = 0.
+
+    The day of the week is derived from the date of the crash : the
+    day_of_week column of the preprocessed files is not reliable (it holds
+    the day of the month in data_10000_out_final.csv) and is only used
+    without a date.
+
+    Parameters
+    ----------
+    crashes : pandas.DataFrame
+        crashes with year/month/day/hour columns (preprocessed files) or
+        crash_date/crash_time columns (raw NYPD export)
+
+    Returns
+    -------
+    numpy.ndarray
+        buckets from 0 to 167, -1 if the date or the hour of the crash is
+        missing or invalid
+    """
+    if {"year", "month", "day"}.issubset(crashes.columns):
+        date = pd.to_datetime(crashes[["year", "month", "day"]], errors="coerce")
+        day = date.dt.dayofweek
+    elif "crash_date" in crashes.columns:
+        day = pd.to_datetime(crashes["crash_date"], errors="coerce").dt.dayofweek
+    else:
+        day = pd.to_numeric(crashes["day_of_week"], errors="coerce")
+    if "hour" in crashes.columns:
+        hour = pd.to_numeric(crashes["hour"], errors="coerce")
+    else:
+        # "13:37" or "13:37:00"
+        hour = crashes["crash_time"].astype(str).str.split(":").str[0]
+        hour = pd.to_numeric(hour, errors="coerce")
+    day = day.to_numpy(dtype=float)
+    hour = hour.to_numpy(dtype=float)
+    with np.errstate(invalid="ignore"):
+        valid = (
+            (day >= 0)
+            & (day < 7)
+            & (day == np.floor(day))
+            & (hour >= 0)
+            & (hour < 24)
+            & (hour == np.floor(hour))
+        )
+    buckets = np.full(len(crashes), -1, dtype=np.int64)
+    buckets[valid] = day[valid] * 24 + hour[valid]
+    return buckets
+
+
+def snap_crashes(spatial_index, crashes, max_dist=100):
+    """
+    Snap crashes on their nearest edge.
+
+    Parameters
+    ----------
+    spatial_index : SpatialIndex
+        index of the graph
+    crashes : pandas.DataFrame
+        crashes with latitude and longitude columns
+    max_dist : float
+        crashes further (in meters) from the streets network are ignored
+
+    Returns
+    -------
+    numpy.ndarray
+        index of the edge of each crash, -1 if it's too far
+    """
+    edges, _, dists = spatial_index.snap_edges(
+        crashes["latitude"].to_numpy(dtype=float),
+        crashes["longitude"].to_numpy(dtype=float),
+    )
+    return np.where(dists <= max_dist, edges, -1)
+
+
+def accumulate_severity(snapshot, spatial_index, chunks, severity=crash_severity):
+    """
+    Sum the severity of the crashes of each edge.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    spatial_index : SpatialIndex
+        index of the graph
+    chunks : iterable of pandas.DataFrame
+        crashes, see read_crashes
+    severity : function
+        returns the severity of each crash of a DataFrame
+
+    Returns
+    -------
+    numpy.ndarray
+        sum of the severity of the crashes snapped on each edge
+    """
+    total = np.zeros(snapshot.n_edges)
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        edges = snap_crashes(spatial_index, chunk)
+        kept = edges >= 0
+        total += np.bincount(
+            edges[kept], weights=severity(chunk)[kept], minlength=snapshot.n_edges
+        )
+    return total
+
+
+def accumulate_since(
+    snapshot, spatial_index, chunks, since=None, seen=(), severity=crash_severity
+):
+    """
+    Sum the severity of the crashes of each edge, only for the crashes
+    not ingested yet : the ones newer than a watermark and the ones of the
+    watermark hour added to the file since (see crash_keys).
+
+    The crashes added later with an older hour are not ingested, nor the
+    crashes without a valid hour once there is a watermark.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    spatial_index : SpatialIndex
+        index of the graph
+    chunks : iterable of pandas.DataFrame
+        crashes, see read_crashes
+    since : int
+        watermark (see crash_timestamps), the older crashes are skipped.
+        None to use all the crashes.
+    seen : list
+        keys of the crashes of the watermark hour already ingested
+    severity : function
+        returns the severity of each crash of a DataFrame
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, int, list)
+        sum of the severity of the new crashes snapped on each edge, the
+        new watermark (the hour of the most recent crash) and the keys of
+        the crashes of this hour
+    """
+    total = np.zeros(snapshot.n_edges)
+    watermark = since
+    seen = set(seen)
+    for chunk in chunks:
+        stamps = crash_timestamps(chunk)
+        keys = crash_keys(chunk)
+        if since is not None:
+            new = (stamps > since) | (
+                (stamps == since) & ~np.isin(keys, np.array(sorted(seen), np.uint64))
+            )
+            chunk, stamps, keys = chunk[new], stamps[new], keys[new]
+        if not len(chunk):
+            continue
+        total += accumulate_severity(snapshot, spatial_index, [chunk], severity)
+        latest = int(stamps.max())
+        if latest >= 0 and (watermark is None or latest > watermark):
+            watermark, seen = latest, set()
+        if watermark is not None:
+            seen.update(keys[stamps == watermark].tolist())
+    return total, watermark, sorted(seen)
+
+
+def load_risk_state(dirpath):
+    """
+    Load the incremental risk state saved in a snapshot directory.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, int, list)
+        severity snapped on each edge, watermark and keys of the crashes
+        of the watermark hour, (None, None, []) if no state has been saved
+    """
+    state_filepath = path.join(dirpath, RISK_STATE_FILENAME)
+    if not path.isfile(state_filepath):
+        return None, None, []
+    with open(state_filepath) as f:
+        state = json.load(f)
+    edge_severity = np.load(path.join(dirpath, state["severity_file"]))
+    return edge_severity, state["watermark"], state.get("seen", [])
+
+
+def risk_state_files(dirpath):
+    """
+    Returns the names of the files of the incremental risk state saved in
+    a snapshot directory (see save_risk_state), none if no state is saved.
+    """
+    state_filepath = path.join(dirpath, RISK_STATE_FILENAME)
+    if not path.isfile(state_filepath):
+        return []
+    with open(state_filepath) as f:
+        state = json.load(f)
+    return [state["severity_file"], RISK_STATE_FILENAME]
+
+
+def save_risk_state(dirpath, edge_severity, watermark, seen=()):
+    """
+    Save the incremental risk state in a snapshot directory.
+
+    Parameters
+    ----------
+    dirpath : string or pathlib.Path
+        path to the snapshot directory
+    edge_severity : numpy.ndarray
+        severity snapped on each edge
+    watermark : int
+        hour of the most recent crash ingested, see crash_timestamps
+    seen : list
+        keys of the crashes of the watermark hour, see crash_keys
+    """
+    state_filepath = path.join(dirpath, RISK_STATE_FILENAME)
+    previous = None
+    if path.isfile(state_filepath):
+        with open(state_filepath) as f:
+            previous = json.load(f)["severity_file"]
+    # A new severity file per update (the keys of the watermark hour only
+    # grow until the next hour), the state is switched at once
+    severity_file = SEVERITY_FILENAME.replace(".npy", f".{watermark}.{len(seen)}.npy")
+    np.save(path.join(dirpath, severity_file), edge_severity)
+    tmp_filepath = f"{state_filepath}.{os.getpid()}.tmp"
+    state = {
+        "watermark": watermark,
+        "severity_file": severity_file,
+        "seen": [int(key) for key in seen],
+    }
+    with open(tmp_filepath, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_filepath, state_filepath)
+    if previous is not None and previous != severity_file:
+        os.remove(path.join(dirpath, previous))
+
+
+def street_ids(snapshot):
+    """
+    Index of the street of each edge : the edges between the same two
+    nodes (reverse and parallel edges) share the same street.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    source = snapshot.edge_source.astype(np.int64)
+    target = np.asarray(snapshot.edge_target, dtype=np.int64)
+    street = np.minimum(source, target) * snapshot.n_nodes + np.maximum(source, target)
+    _, street_idx = np.unique(street, return_inverse=True)
+    return street_idx.ravel()
+
+
+def street_risk(snapshot, edge_severity):
+    """
+    Share the severity of an edge with its reverse and parallel edges.
+
+    A crash is snapped on one of the directed edges of a two-way street,
+    the risk is the one of the street whatever the driving direction.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    edge_severity : numpy.ndarray
+        severity snapped on each edge
+
+    Returns
+    -------
+    numpy.ndarray
+        risk of each edge
+    """
+    street_idx = street_ids(snapshot)
+    street_total = np.bincount(street_idx, weights=edge_severity)
+    return street_total[street_idx]
+
+
+def global_risk_of(snapshot, risk):
+    """
+    Risk per RISK_LENGTH meters of street, comparable between short and
+    long edges.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    risk : numpy.ndarray
+        risk of each edge
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    length = np.nan_to_num(snapshot.edge_length, nan=1.0)
+    return risk * RISK_LENGTH / np.maximum(length, 1.0)
+
+
+def compute_edge_risk(
+    snapshot, spatial_index, crash_filepath, chunksize=500000, severity=crash_severity
+):
+    """
+    Compute the risk of the edges of a graph from a crash file.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    spatial_index : SpatialIndex
+        index of the graph
+    crash_filepath : string or pathlib.Path
+        path to the crash file, see read_crashes
+    chunksize : int
+        number of crashes processed at once
+    severity : function
+        returns the severity of each crash of a DataFrame
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray)
+        risk and global_risk of each edge
+    """
+    chunks = read_crashes(crash_filepath, chunksize=chunksize)
+    risk = street_risk(
+        snapshot, accumulate_severity(snapshot, spatial_index, chunks, severity)
+    )
+    return risk, global_risk_of(snapshot, risk)
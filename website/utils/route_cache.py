@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from os import path
+
+from utils.file_lock import file_lock
+
+
+class RouteCache:
+    """
+    Least recently used cache of computed routes.
+
+    The routes are lists of node IDs, the memory used is bounded by the
+    total number of nodes stored (`max_nodes`) : the least recently used
+    routes are evicted when a new route doesn't fit.
+
+    The keys must be tuples of JSON serializable values (see save), the
+    cache doesn't know what the routes depend on : the caller puts the
+    version of its data in the keys and calls `clear` when it changes.
+
+    The cache can be used by several threads, and saved to the same file
+    by several processes (see save).
+    """
+
+    def __init__(self, max_nodes=2000000):
+        """
+        Initialize the RouteCache
+
+        Parameters
+        ----------
+        max_nodes : int
+            maximum total number of nodes of the cached routes
+        """
+        self.max_nodes = max_nodes
+        self.n_nodes = 0
+        self.hits = 0
+        self.misses = 0
+        # True if routes were added since the cache was loaded or saved
+        self.changed = False
+        self._routes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def get(self, key):
+        """
+        Returns the route cached for a key and mark it as recently used.
+
+        Parameters
+        ----------
+        key : tuple
+            key of the route
+
+        Returns
+        -------
+        list or None if the route is not cached
+        """
+        with self._lock:
+            route = self._routes.get(key)
+            if route is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._routes.move_to_end(key)
+        return list(route)
+
+    def put(self, key, route):
+        """
+        Cache a route, evicting the least recently used ones if needed.
+
+        Parameters
+        ----------
+        key : tuple
+            key of the route
+        route : list
+            node IDs of the route
+        """
+        if len(route) > self.max_nodes:
+            return
+        with self._lock:
+            if key in self._routes:
+                self.n_nodes -= len(self._routes.pop(key))
+            while self._routes and self.n_nodes + len(route) > self.max_nodes:
+                _, evicted = self._routes.popitem(last=False)
+                self.n_nodes -= len(evicted)
+            self._routes[key] = tuple(route)
+            self.n_nodes += len(route)
+            self.changed = True
+
+    def clear(self):
+        """Remove all the routes, the counters are kept"""
+        with self._lock:
+            self._routes = OrderedDict()
+            self.n_nodes = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns
+        -------
+        dict
+            hits, misses, number of routes and of nodes cached
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "routes": len(self._routes),
+            "nodes": self.n_nodes,
+        }
+
+    def save(self, filepath, version=None):
+        """
+        Add the routes to a JSON file, from the least to the most recently
+        used.
+
+        The routes already saved in the file with the same version are
+        kept before the ones of this cache, up to max_nodes : the processes
+        sharing the file (the gunicorn workers) each add their routes, one
+        at a time. Nothing is written if no route was added since the cache
+        was loaded or saved (the gunicorn master).
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the file including extension
+        version : JSON serializable
+            version of the data of the routes, checked by `load`
+        """
+        if not self.changed:
+            return
+        with file_lock(f"{filepath}.lock"):
+            merged = RouteCache(self.max_nodes)
+            merged.load(filepath, version)
+            with self._lock:
+                routes = list(self._routes.items())
+                self.changed = False
+            for key, route in routes:
+                merged.put(key, route)
+            routes = [[list(key), list(route)] for key, route in merged._routes.items()]
+            content = {"version": version, "routes": routes}
+            tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+            with open(tmp_filepath, "w") as f:
+                json.dump(content, f)
+            os.replace(tmp_filepath, filepath)
+
+    def load(self, filepath, version=None):
+        """
+        Add the routes saved with `save` to the cache.
+
+        Parameters
+        ----------
+        filepath : string or pathlib.Path
+            path to the file including extension
+        version : JSON serializable
+            version of the current data, the routes saved with another
+            version are ignored
+
+        Returns
+        -------
+        int
+            number of routes loaded, 0 if the file can't be read
+        """
+        if not path.isfile(filepath):
+            return 0
+        try:
+            with open(filepath) as f:
+                content = json.load(f)
+            if content.get("version") != version:
+                return 0
+            routes = [
+                # JSON arrays are read as lists, the keys are tuples
+                (tuple(tuple(p) if type(p) is list else p for p in key), route)
+                for key, route in content["routes"]
+            ]
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            # Truncated or invalid file : the routes are computed again
+            return 0
+        changed = self.changed
+        for key, route in routes:
+            self.put(key, route)
+        self.changed = changed
+        return len(routes)
@@ -0,0 +1,560 @@
+import numpy as np
+
+from collections import namedtuple
+from heapq import heappush, heappop
+from itertools import count
+
+from utils.profiles import compile_profiles, profile_weights
+
+# Same earth radius as osmnx, used to compute the edges length
+EARTH_RADIUS_M = 6371009
+
+# Result of a one-to-many search (see RouteEngine.shortest_path_tree)
+#   dist : index of each settled node:weight of its path, in settling order
+#   pred : index of the previous node on the path of each node (-1 if none)
+#   pred_pair : pair of edges followed to reach each node (-1 if none)
+#   reverse : True if the paths go from the nodes to the sources, pred is
+#       then the next node of the path
+SearchTree = namedtuple("SearchTree", ["dist", "pred", "pred_pair", "reverse"])
+
+
+class NoPathException(Exception):
+    pass
+
+
+def parallel_edges(snapshot):
+    """
+    Returns the first edge of each pair of parallel edges (edges with the
+    same source and target, contiguous in the CSR order) and, for each
+    edge, the first edge of its pair.
+    """
+    source = snapshot.edge_source
+    target = np.asarray(snapshot.edge_target)
+    new_pair = np.ones(snapshot.n_edges, dtype=bool)
+    new_pair[1:] = (target[1:] != target[:-1]) | (source[1:] != source[:-1])
+    pair_start = np.flatnonzero(new_pair)
+    first_edge = np.repeat(pair_start, np.diff(np.append(pair_start, snapshot.n_edges)))
+    return pair_start, first_edge
+
+
+def haversine_to(snapshot, node):
+    """
+    Great-circle distance (in meters) between every node and `node`.
+
+    Parameters
+    ----------
+    snapshot : GraphSnapshot
+        the graph arrays
+    node : int
+        index of the node
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    lat1 = np.radians(snapshot.node_y)
+    lat2 = np.radians(snapshot.node_y[node])
+    d_lat = lat2 - lat1
+    d_lng = np.radians(snapshot.node_x[node] - snapshot.node_x)
+    h = np.sin(d_lat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+class RouteEngine:
+    """
+    Shortest path engine working on the arrays of a GraphSnapshot.
+
+    The parallel edges of the snapshot are merged in "pairs" (one per
+    (u, v) couple of nodes) keeping the minimum weight, as networkx does
+    on a MultiDiGraph. The searches use a binary heap on the node indices
+    and a counter to break the ties in the same order as networkx, so
+    Dijkstra returns the same node lists as `nx.dijkstra_path`.
+
+    The weights are registered by name with `set_weights`, registering a
+    new array under an existing name swaps it for the next searches. The
+    weights of the route profiles (see utils/profiles.py) are computed by
+    `load_profiles`, which swaps them the same way.
+    """
+
+    def __init__(self, snapshot):
+        """
+        Initialize the RouteEngine
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        """
+        self.snapshot = snapshot
+        n_nodes = snapshot.n_nodes
+        source = snapshot.edge_source
+        target = np.asarray(snapshot.edge_target)
+
+        self.pair_start, self.first_edge = parallel_edges(snapshot)
+        self.pair_indptr = np.searchsorted(
+            source[self.pair_start], np.arange(n_nodes + 1)
+        )
+        self.pair_target = target[self.pair_start]
+        # For each pair, the shortest of its edges (the first one on ties)
+        order = np.lexsort((snapshot.edge_length, self.first_edge))
+        self.pair_edge = order[self.pair_start]
+
+        # Python lists are much faster than numpy scalars in the search loop
+        self._indptr = self.pair_indptr.tolist()
+        self._targets = self.pair_target.tolist()
+        # name:Profile whose weights are computed by load_profiles
+        self.profiles = {}
+        self.pair_weights = {}
+        self._weights = {}
+        # Built on the first reverse search (see _reverse_adjacency)
+        self._reverse = None
+        self._reversed_weights = {}
+
+    @property
+    def n_nodes(self):
+        return self.snapshot.n_nodes
+
+    @classmethod
+    def from_snapshot(cls, snapshot, profiles=None):
+        """
+        Create an engine with the weights of route profiles.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        profiles : dict
+            name:Profile, default : the profiles.PROFILES (shortest, safest,
+            safest_streets and dangerous)
+        """
+        engine = cls(snapshot)
+        engine.load_profiles(profiles)
+        return engine
+
+    def load_profiles(self, profiles=None):
+        """
+        (Re)compute the weights of the route profiles from the snapshot
+        arrays, called again when the risk of the snapshot is updated.
+
+        Parameters
+        ----------
+        profiles : dict
+            name:Profile replacing the profiles of the engine (the weights
+            of the profiles not in it are removed), default : the current
+            profiles
+        """
+        if profiles is None:
+            profiles = self.profiles or compile_profiles()
+        weights = profile_weights(self.snapshot, profiles)
+        for name in set(self.profiles) - set(profiles):
+            self.remove_weights(name)
+        self.profiles = dict(profiles)
+        for name, edge_weights in weights.items():
+            self.set_weights(name, edge_weights)
+
+    def profile_weights(self, profiles=None, **kwargs):
+        """
+        Compute the weights of the route profiles.
+
+        Parameters
+        ----------
+        profiles : list
+            names of the profiles to compute, default : all of them
+        kwargs : dict
+            global_risk, time_factor and bucket, see profiles.Profile.weights
+
+        Returns
+        -------
+        dict
+            profile:weight of each edge
+        """
+        return profile_weights(self.snapshot, self.profiles, profiles, **kwargs)
+
+    def set_weights(self, name, edge_weights):
+        """
+        Register (or replace) the weights of a profile.
+
+        Parameters
+        ----------
+        name : string
+            name of the profile
+        edge_weights : numpy.ndarray
+            weight of each edge of the snapshot, the weight of a pair is
+            the minimum of its parallel edges
+        """
+        edge_weights = np.asarray(edge_weights, dtype=float)
+        if len(edge_weights) != self.snapshot.n_edges:
+            raise ValueError(
+                f"Expected {self.snapshot.n_edges} weights, got {len(edge_weights)}"
+            )
+        if len(self.pair_start):
+            pair_weights = np.minimum.reduceat(edge_weights, self.pair_start)
+        else:
+            pair_weights = edge_weights
+        weights = pair_weights.tolist()
+        # Swap the list last, a running search keeps its own reference
+        self.pair_weights[name] = pair_weights
+        self._weights[name] = weights
+        self._reversed_weights.pop(name, None)
+
+    def has_weights(self, name):
+        return name in self._weights
+
+    def remove_weights(self, name):
+        """Forget the weights of a profile"""
+        self.pair_weights.pop(name, None)
+        self._weights.pop(name, None)
+        self._reversed_weights.pop(name, None)
+
+    def shortest_path(self, source, target, weight="shortest", heuristic=False):
+        """
+        Returns the shortest weighted path from source to target.
+
+        Parameters
+        ----------
+        source : int
+            index of the starting node
+        target : int
+            index of the destination node
+        weight : string
+            name of the weights registered with `set_weights`
+        heuristic : boolean
+            If True, use A* with the great-circle distance to the target
+            as heuristic. It's only admissible when the weights are
+            lengths in meters.
+
+        Returns
+        -------
+        list
+            indices of the nodes of the path
+
+        Raises
+        ------
+        NoPathException
+            If no path exists between source and target.
+        """
+        if source == target:
+            return [source]
+        if heuristic:
+            pred = self._astar(source, target, self._weights[weight])
+            return self._build_path(pred, source, target)
+        return self.shortest_path_between({source: 0}, {target: 0}, weight)
+
+    def shortest_path_between(self, sources, targets, weight="shortest"):
+        """
+        Returns the shortest weighted path from any of the sources to any
+        of the targets.
+
+        The sources and targets have an offset added to the weight of the
+        paths starting / ending on them, which is how a point located in
+        the middle of an edge is reached from its two ends.
+
+        Parameters
+        ----------
+        sources : dict
+            index of a starting node:offset
+        targets : dict
+            index of a destination node:offset
+        weight : string
+            name of the weights registered with `set_weights`
+
+        Returns
+        -------
+        list
+            indices of the nodes of the path
+
+        Raises
+        ------
+        NoPathException
+            If no path exists between the sources and the targets.
+        """
+        pred, target = self._dijkstra(sources, targets, self._weights[weight])
+        return self._build_path(pred, None, target)
+
+    def shortest_path_tree(
+        self,
+        sources,
+        weight="shortest",
+        targets=None,
+        cutoff=None,
+        stretch=None,
+        reverse=False,
+        potential=None,
+    ):
+        """
+        Search the shortest weighted paths from the sources to many nodes
+        at once.
+
+        The search stops when all the targets are settled or when the
+        paths get longer than the cutoff, the paths to the settled nodes
+        are the ones shortest_path returns.
+
+        Parameters
+        ----------
+        sources : dict
+            index of a starting node:offset
+        weight : string
+            name of the weights registered with `set_weights`
+        targets : set
+            indices of the nodes to reach, default : all the nodes
+        cutoff : float
+            maximum weight of the paths, default : no limit
+        stretch : float
+            If set, the search goes on once the targets are settled, up to
+            stretch * the weight of the path to the last one
+        reverse : boolean
+            If True, search the paths from the nodes to the sources : the
+            `pred` of a node is then the next node of its path
+        potential : list
+            If set, lower bound of the weight of the rest of the route from
+            each node (inf to skip a node) : a node is searched only if
+            the weight of its path plus its potential is within the cutoff
+
+        Returns
+        -------
+        SearchTree
+            the pred and pred_pair of the settled nodes
+        """
+        if not reverse:
+            return self._dijkstra_tree(
+                sources,
+                self._indptr,
+                self._targets,
+                self._weights[weight],
+                targets,
+                cutoff,
+                stretch,
+                potential,
+            )
+        indptr, adj_sources, pairs = self._reverse_adjacency()
+        tree = self._dijkstra_tree(
+            sources,
+            indptr,
+            adj_sources,
+            self._reverse_weights(weight),
+            targets,
+            cutoff,
+            stretch,
+            potential,
+        )
+        # Positions in the reversed adjacency to pairs of edges
+        pred_pair = tree.pred_pair
+        for v in tree.dist:
+            if pred_pair[v] >= 0:
+                pred_pair[v] = pairs[pred_pair[v]]
+        return tree._replace(reverse=True)
+
+    def tree_path(self, tree, target):
+        """
+        Returns the path to a node settled by shortest_path_tree (from the
+        node for a reverse search tree).
+
+        Raises
+        ------
+        NoPathException
+            If the node has not been reached.
+        """
+        if target not in tree.dist:
+            raise NoPathException(f"No path to {target}")
+        path = self._build_path(tree.pred, None, target)
+        if tree.reverse:
+            path.reverse()
+        return path
+
+    def tree_edges(self, tree, path):
+        """
+        Returns the snapshot edges followed by the path to a node of a
+        search tree (from the node for a reverse search tree).
+        """
+        nodes = path[:-1] if tree.reverse else path[1:]
+        pairs = np.array([tree.pred_pair[v] for v in nodes], dtype=np.int64)
+        return self.pair_edge[pairs]
+
+    def _reverse_adjacency(self):
+        """
+        Returns the pairs of edges entering each node, in CSR order : the
+        indptr, the source node of each pair and the pair itself.
+        """
+        if self._reverse is None:
+            pairs = np.argsort(self.pair_target, kind="stable")
+            sources = np.repeat(np.arange(self.n_nodes), np.diff(self.pair_indptr))
+            indptr = np.searchsorted(
+                self.pair_target[pairs], np.arange(self.n_nodes + 1)
+            )
+            self._reverse = (indptr.tolist(), sources[pairs].tolist(), pairs.tolist())
+        return self._reverse
+
+    def _reverse_weights(self, name):
+        """Weights of a profile in the order of _reverse_adjacency"""
+        weights = self._reversed_weights.get(name)
+        if weights is None:
+            pairs = self._reverse_adjacency()[2]
+            weights = self.pair_weights[name][pairs].tolist()
+            self._reversed_weights[name] = weights
+        return weights
+
+    def pair_index(self, u, v):
+        """
+        Returns the index of the pair of edges u -> v or -1 if there is no
+        edge from u to v.
+        """
+        for i in range(self._indptr[u], self._indptr[u + 1]):
+            if self._targets[i] == v:
+                return i
+        return -1
+
+    def route_edges(self, path):
+        """
+        Returns the snapshot edges followed by a path : the shortest of
+        the parallel edges between each two nodes, as convert_route_to_gdf
+        does on the graph.
+
+        Parameters
+        ----------
+        path : list
+            indices of the nodes of the path
+
+        Returns
+        -------
+        numpy.ndarray
+
+        Raises
+        ------
+        KeyError
+            If two consecutive nodes of the path are not linked.
+        """
+        pairs = [self.pair_index(u, v) for u, v in zip(path[:-1], path[1:])]
+        if any(pair < 0 for pair in pairs):
+            raise KeyError(f"No edge between consecutive nodes of {path}")
+        return self.pair_edge[np.array(pairs, dtype=np.int64)]
+
+    def _dijkstra(self, sources, targets, weights):
+        indptr, adj_targets = self._indptr, self._targets
+        seen = [float("inf")] * self.n_nodes
+        done = bytearray(self.n_nodes)
+        pred = [-1] * self.n_nodes
+        c = count()
+        fringe = []
+        for source, offset in sources.items():
+            if offset < seen[source]:
+                seen[source] = offset
+                heappush(fringe, (offset, next(c), source))
+        best, best_target = float("inf"), None
+        while fringe:
+            d, _, v = heappop(fringe)
+            if done[v]:
+                continue
+            if d >= best:
+                break
+            done[v] = 1
+            if v in targets and d + targets[v] < best:
+                best, best_target = d + targets[v], v
+                if d >= best:
+                    continue
+            for i in range(indptr[v], indptr[v + 1]):
+                u = adj_targets[i]
+                if done[u]:
+                    continue
+                vu_dist = d + weights[i]
+                if vu_dist < seen[u]:
+                    seen[u] = vu_dist
+                    pred[u] = v
+                    heappush(fringe, (vu_dist, next(c), u))
+        return pred, best_target
+
+    def _dijkstra_tree(
+        self,
+        sources,
+        indptr,
+        adj_targets,
+        weights,
+        targets=None,
+        cutoff=None,
+        stretch=None,
+        potential=None,
+    ):
+        inf = float("inf")
+        if cutoff is None:
+            cutoff = inf
+        seen = [inf] * self.n_nodes
+        done = bytearray(self.n_nodes)
+        pred = [-1] * self.n_nodes
+        pred_pair = [-1] * self.n_nodes
+        dist = {}
+        remaining = set(targets) if targets is not None else None
+        c = count()
+        fringe = []
+        for source, offset in sources.items():
+            if offset < seen[source]:
+                seen[source] = offset
+                heappush(fringe, (offset, next(c), source))
+        while fringe:
+            d, _, v = heappop(fringe)
+            if done[v]:
+                continue
+            if d > cutoff:
+                break
+            if potential is not None and d + potential[v] > cutoff:
+                continue
+            done[v] = 1
+            dist[v] = d
+            if remaining is not None:
+                remaining.discard(v)
+                if not remaining:
+                    if stretch is None:
+                        break
+                    cutoff = min(cutoff, d * stretch)
+                    remaining = None
+            for i in range(indptr[v], indptr[v + 1]):
+                u = adj_targets[i]
+                if done[u]:
+                    continue
+                vu_dist = d + weights[i]
+                if potential is not None and vu_dist + potential[u] > cutoff:
+                    continue
+                if vu_dist < seen[u] and vu_dist <= cutoff:
+                    seen[u] = vu_dist
+                    pred[u] = v
+                    pred_pair[u] = i
+                    heappush(fringe, (vu_dist, next(c), u))
+        return SearchTree(dist, pred, pred_pair, False)
+
+    def _astar(self, source, target, weights):
+        indptr, targets = self._indptr, self._targets
+        # Slightly scaled down to absorb the rounding of the OSM lengths
+        h = (haversine_to(self.snapshot, target) * 0.999).tolist()
+        g = [float("inf")] * self.n_nodes
+        done = bytearray(self.n_nodes)
+        pred = [-1] * self.n_nodes
+        c = count()
+        g[source] = 0
+        fringe = [(h[source], next(c), source)]
+        while fringe:
+            _, _, v = heappop(fringe)
+            if done[v]:
+                continue
+            done[v] = 1
+            if v == target:
+                break
+            d = g[v]
+            for i in range(indptr[v], indptr[v + 1]):
+                u = targets[i]
+                if done[u]:
+                    continue
+                vu_dist = d + weights[i]
+                if vu_dist < g[u]:
+                    g[u] = vu_dist
+                    pred[u] = v
+                    heappush(fringe, (vu_dist + h[u], next(c), u))
+        return pred if done[target] else None
+
+    @staticmethod
+    def _build_path(pred, source, target):
+        """Follow the predecessors from target back to a node without any"""
+        if pred is None or target is None:
+            raise NoPathException(f"No path between {source} and {target}")
+        path = [target]
+        while pred[path[-1]] >= 0:
+            path.append(pred[path[-1]])
+        path.reverse()
+        return path
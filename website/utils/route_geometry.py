@@ -0,0 +1,209 @@
+import numpy as np
+
+from utils.polyline import encode_polyline
+
+# Upper bounds of the global_risk of the risk classes 1 and 2 : class 0 is
+# no risk, class 3 is above the last bound (same bands as the map colours)
+RISK_BANDS = (3, 7)
+
+
+class RouteGeometry:
+    """
+    Geometry and attributes of the edges of a route, read from the arrays
+    of a GraphSnapshot.
+
+    The points of the edges are stored in one (n, 2) array of (lng, lat)
+    coordinates, the points of the i-th edge are between `offsets[i]` and
+    `offsets[i + 1]`. The attributes of the edges (length, risk,
+    global_risk) are arrays in the order of the route.
+
+    The GeoDataFrame of the route (as returned by convert_route_to_gdf) is
+    only built on demand by `to_gdf`.
+    """
+
+    def __init__(self, nodes, edges, coords, offsets, attributes):
+        """
+        Initialize the RouteGeometry
+
+        Parameters
+        ----------
+        nodes : list
+            node IDs of the route
+        edges : numpy.ndarray
+            index of each edge of the route in the snapshot
+        coords : numpy.ndarray
+            (lng, lat) coordinates of the points of the edges
+        offsets : numpy.ndarray
+            index of the first point of each edge in coords, and the number
+            of points at the end
+        attributes : dict
+            name:value of each edge (length, risk, global_risk, ...)
+        """
+        self.nodes = list(nodes)
+        self.edges = edges
+        self.coords = coords
+        self.offsets = offsets
+        self.attributes = attributes
+
+    @classmethod
+    def from_route(cls, snapshot, engine, route):
+        """
+        Build the geometry of a route.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        engine : RouteEngine
+            route engine of the snapshot (chooses the parallel edges)
+        route : list
+            node IDs of the route
+
+        Returns
+        -------
+        RouteGeometry
+        """
+        path = [snapshot.node_index(node) for node in route]
+        edges = engine.route_edges(path)
+        starts = np.asarray(snapshot.geom_offsets[edges], dtype=np.int64)
+        counts = np.asarray(snapshot.geom_offsets[edges + 1], dtype=np.int64) - starts
+        offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # Index of each point in the geom arrays of the snapshot
+        points = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        coords = np.column_stack(
+            (np.asarray(snapshot.geom_x)[points], np.asarray(snapshot.geom_y)[points])
+        )
+        attributes = {
+            "length": np.asarray(snapshot.edge_length)[edges],
+            "risk": np.asarray(snapshot.edge_risk)[edges],
+            "global_risk": np.asarray(snapshot.edge_global_risk)[edges],
+        }
+        return cls(route, edges, coords, offsets, attributes)
+
+    def __len__(self):
+        return len(self.edges)
+
+    @property
+    def length(self):
+        """Length of the route in meters"""
+        return float(np.nansum(self.attributes["length"]))
+
+    @property
+    def bounds(self):
+        """(minx, miny, maxx, maxy) of the route or None if it's empty"""
+        if not len(self.coords):
+            return None
+        minx, miny = self.coords.min(axis=0)
+        maxx, maxy = self.coords.max(axis=0)
+        return float(minx), float(miny), float(maxx), float(maxy)
+
+    def edge_coords(self, i):
+        """Returns the (lng, lat) coordinates of the i-th edge of the route"""
+        return self.coords[self.offsets[i] : self.offsets[i + 1]]
+
+    def _line_mask(self):
+        """Points kept in line_coords"""
+        keep = np.ones(len(self.coords), dtype=bool)
+        first_points = self.offsets[1:-1]
+        keep[first_points] = np.any(
+            self.coords[first_points] != self.coords[first_points - 1], axis=1
+        )
+        return keep
+
+    def line_coords(self):
+        """
+        Returns the (lng, lat) coordinates of the route as one line : the
+        first point of an edge is dropped when it's the last point of the
+        previous edge.
+        """
+        return self.coords[self._line_mask()]
+
+    def risk_classes(self):
+        """
+        Returns the risk class of each edge (0 to 3) from its global_risk,
+        see RISK_BANDS. An unknown risk is in the highest class.
+        """
+        global_risk = self.attributes["global_risk"]
+        return np.select(
+            [
+                global_risk == 0,
+                global_risk < RISK_BANDS[0],
+                global_risk < RISK_BANDS[1],
+            ],
+            [0, 1, 2],
+            default=3,
+        )
+
+    def risk_runs(self):
+        """
+        Returns the runs of consecutive edges of the same risk class (see
+        risk_classes) as three arrays : the first point and the last point
+        of each run, as indices of the points of line_coords, and its class.
+        """
+        keep = self._line_mask()
+        line_index = np.cumsum(keep) - 1
+        classes = self.risk_classes()
+        if not len(self):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        first_points = line_index[self.offsets[:-1]]
+        last_points = line_index[self.offsets[1:] - 1]
+        # Edges starting a run of the same class
+        starts = np.flatnonzero(np.diff(classes, prepend=-1) != 0)
+        ends = np.append(starts[1:], len(self)) - 1
+        return first_points[starts], last_points[ends], classes[starts]
+
+    def to_json(self):
+        """
+        Returns a compact JSON serializable description of the route :
+            - polyline : the line encoded with encode_polyline
+            - length : length of the route in meters
+            - bounds : (minx, miny, maxx, maxy)
+            - segments : [first point, last point, risk class] of the
+              consecutive edges of the same risk class, the points are the
+              indices of the points of the decoded polyline
+        """
+        segments = np.column_stack(self.risk_runs()).tolist()
+        return {
+            "polyline": encode_polyline(self.line_coords()),
+            "length": round(self.length, 1),
+            "bounds": self.bounds,
+            "segments": segments,
+        }
+
+    def to_geojson(self):
+        """
+        Returns the route as a GeoJSON Feature : a LineString with the
+        length and the attributes of each edge as properties.
+        """
+        properties = {"length": self.length}
+        for name, values in self.attributes.items():
+            properties[f"edge_{name}"] = [
+                None if np.isnan(value) else value for value in values.tolist()
+            ]
+        return {
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": self.line_coords().tolist(),
+            },
+            "properties": properties,
+        }
+
+    def to_gdf(self):
+        """
+        Returns the route as a geopandas.GeoDataFrame with one row per edge
+        (geometry, u, v and the attributes of the edges).
+        """
+        # Imported here : only needed when the GeoDataFrame is asked for
+        import geopandas as gpd
+        from shapely.geometry import LineString
+
+        data = {
+            "u": self.nodes[:-1],
+            "v": self.nodes[1:],
+        }
+        data.update(self.attributes)
+        geometry = [LineString(self.edge_coords(i)) for i in range(len(self))]
+        return gpd.GeoDataFrame(data, geometry=geometry, crs="EPSG:4326")
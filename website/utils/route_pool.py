@@ -0,0 +1,93 @@
+import threading
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+
+class RoutePool:
+    """
+    Pool of processes computing the routes (a ProcessPoolExecutor) which
+    can be retired when one of its tasks is stuck.
+
+    A running task can't be cancelled, only its process can stop it, and
+    terminating a process breaks all the tasks of the pool. So a request
+    giving up a running task only retires the pool : the next requests get
+    a new pool, the other tasks of this one go on, and its processes are
+    terminated once only the abandoned tasks are left.
+    """
+
+    def __init__(self, executor):
+        """
+        Initialize the RoutePool
+
+        Parameters
+        ----------
+        executor : concurrent.futures.ProcessPoolExecutor
+            the processes of the pool
+        """
+        self.executor = executor
+        # If True, no task is submitted anymore
+        self.retired = False
+        self.terminated = False
+        self._lock = threading.RLock()
+        # Tasks not done yet and the ones no request waits for anymore
+        self._pending = set()
+        self._abandoned = set()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit a task, see ProcessPoolExecutor.submit. The task of a pool
+        terminated meanwhile fails with BrokenProcessPool.
+        """
+        try:
+            if self.terminated:
+                raise RuntimeError("The pool is terminated")
+            future = self.executor.submit(fn, *args, **kwargs)
+        except RuntimeError as err:
+            future = Future()
+            future.set_exception(BrokenProcessPool(str(err)))
+            return future
+        with self._lock:
+            self._pending.add(future)
+        # Called at once if the task is already done
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            self._abandoned.discard(future)
+        self._terminate_if_idle()
+
+    def abandon(self, future):
+        """
+        Retire the pool because of a running task no request waits for
+        anymore, its processes are terminated once the other tasks are done.
+        """
+        with self._lock:
+            self.retired = True
+            if not future.done():
+                self._abandoned.add(future)
+        self._terminate_if_idle()
+
+    def _terminate_if_idle(self):
+        with self._lock:
+            if (
+                not self.retired
+                or self.terminated
+                or not self._pending <= self._abandoned
+            ):
+                return
+            self.terminated = True
+        self.terminate()
+
+    def terminate(self):
+        """Terminate the processes of the pool, even the busy ones"""
+        processes = list((getattr(self.executor, "_processes", None) or {}).values())
+        self.executor.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+
+    def shutdown(self, wait=True):
+        """Stop the processes once their tasks are done"""
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,444 @@
+import os
+
+import numpy as np
+
+from collections import namedtuple
+from os import path
+
+from utils.route_engine import EARTH_RADIUS_M
+
+# Point snapped on an edge of the snapshot
+#   edge : index of the edge
+#   fraction : position of the point along the edge (0 = source, 1 = target)
+#   dist : distance (in meters) between the point and the edge
+EdgeSnap = namedtuple("EdgeSnap", ["edge", "fraction", "dist"])
+
+
+def great_circle(lat1, lng1, lat2, lng2):
+    """Vectorized great-circle distance (in meters), as osmnx computes it"""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_theta = np.radians(lng2) - np.radians(lng1)
+    h = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_theta / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+class SpatialIndex:
+    """
+    Uniform grid index over the nodes and the edge segments of a snapshot.
+
+    The coordinates are projected in meters (equirectangular projection
+    centered on the graph, accurate enough at the scale of a city) and
+    each node / segment is registered in the cells of the grid it covers.
+    A query visits the cells ring by ring around the point until no
+    unvisited cell can contain a closer item.
+
+    The nearest node is chosen with the great-circle distance, like
+    `ox.get_nearest_node`, among the candidates of the visited cells.
+
+    The snapshots of several networks built on the same node table (see
+    GraphSnapshot.reindex) share the index of the table : its projected
+    nodes and node grid, searched for the nodes with edges in the network.
+    """
+
+    cell_size = 250.0
+    array_names = (
+        "index_params",
+        "index_node_cells",
+        "index_node_items",
+        "index_segment_cells",
+        "index_segment_items",
+    )
+
+    def __init__(self, snapshot, arrays, nodes=None):
+        """
+        Initialize the SpatialIndex
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the indexed graph arrays
+        arrays : dict
+            name:numpy.ndarray for each name of `array_names`
+        nodes : SpatialIndex
+            index of the node table of the snapshot, used for the nodes if
+            the snapshot is built on it (see GraphSnapshot.reindex)
+        """
+        self.snapshot = snapshot
+        for name in self.array_names:
+            setattr(self, name, np.asarray(arrays[name]))
+        lat0, x0, y0, cell_size, n_x, n_y = self.index_params.tolist()
+        self.lat0, self.x0, self.y0 = lat0, x0, y0
+        self.cell_size, self.n_x, self.n_y = cell_size, int(n_x), int(n_y)
+
+        # Projected coordinates of the nodes and of the geometry points
+        self.nodes = None
+        self.node_mask = None
+        if nodes is not None and nodes.snapshot.node_ids is snapshot.node_ids:
+            self.nodes = nodes
+            self.node_px, self.node_py = nodes.node_px, nodes.node_py
+            # Nodes of the table in this network : the ones with edges
+            self.node_mask = np.diff(snapshot.indptr) > 0
+            self.node_mask[np.asarray(snapshot.edge_target)] = True
+        else:
+            self.node_px, self.node_py = self.project(snapshot.node_y, snapshot.node_x)
+        self.geom_px, self.geom_py = self.project(snapshot.geom_y, snapshot.geom_x)
+        self.point_edge = np.repeat(
+            np.arange(snapshot.n_edges), np.diff(snapshot.geom_offsets)
+        )
+        # Length of the segment starting at each geometry point (0 for the
+        # last point of an edge) and the position of each point in its edge
+        seg_len = np.hypot(np.diff(self.geom_px), np.diff(self.geom_py))
+        seg_len = np.append(seg_len, 0)
+        seg_len[np.asarray(snapshot.geom_offsets[1:]) - 1] = 0
+        self.segment_length = seg_len
+        cum = np.concatenate(([0], np.cumsum(seg_len)))
+        self.point_position = (
+            cum[:-1] - cum[snapshot.geom_offsets[:-1]][self.point_edge]
+        )
+        self.edge_proj_length = (
+            np.add.reduceat(seg_len, snapshot.geom_offsets[:-1])
+            if snapshot.n_edges
+            else np.zeros(0)
+        )
+
+    def project(self, lat, lng):
+        """Project (lat, lng) coordinates to meters"""
+        x = EARTH_RADIUS_M * np.radians(lng) * np.cos(np.radians(self.lat0))
+        y = EARTH_RADIUS_M * np.radians(lat)
+        return x, y
+
+    @classmethod
+    def build(cls, snapshot, cell_size=None, nodes=None):
+        """
+        Build the index of a snapshot.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        cell_size : float
+            size of the cells of the grid in meters
+        nodes : SpatialIndex
+            index of the node table shared by the snapshot, see __init__
+
+        Returns
+        -------
+        SpatialIndex
+        """
+        cell_size = cell_size or cls.cell_size
+        lat0 = float(np.mean(snapshot.node_y)) if snapshot.n_nodes else 0.0
+        x = EARTH_RADIUS_M * np.radians(snapshot.geom_x) * np.cos(np.radians(lat0))
+        y = EARTH_RADIUS_M * np.radians(snapshot.geom_y)
+        node_x = EARTH_RADIUS_M * np.radians(snapshot.node_x) * np.cos(np.radians(lat0))
+        node_y = EARTH_RADIUS_M * np.radians(snapshot.node_y)
+        all_x, all_y = np.append(x, node_x), np.append(y, node_y)
+        x0, y0 = all_x.min(), all_y.min()
+        n_x = int((all_x.max() - x0) // cell_size) + 1
+        n_y = int((all_y.max() - y0) // cell_size) + 1
+
+        def cell_of(px, py):
+            return (
+                np.clip(((px - x0) // cell_size).astype(np.int64), 0, n_x - 1),
+                np.clip(((py - y0) // cell_size).astype(np.int64), 0, n_y - 1),
+            )
+
+        def grid(cells, items):
+            order = np.argsort(cells, kind="stable")
+            starts = np.searchsorted(cells[order], np.arange(n_x * n_y + 1))
+            return starts.astype(np.int64), items[order].astype(np.int64)
+
+        cx, cy = cell_of(node_x, node_y)
+        node_cells, node_items = grid(cy * n_x + cx, np.arange(snapshot.n_nodes))
+
+        # A segment is registered in every cell of its bounding box
+        last = np.asarray(snapshot.geom_offsets[1:]) - 1
+        is_segment = np.ones(len(x), dtype=bool)
+        is_segment[last] = False
+        seg = np.flatnonzero(is_segment)
+        ax, ay = cell_of(x[seg], y[seg])
+        bx, by = cell_of(x[seg + 1], y[seg + 1])
+        min_x, max_x = np.minimum(ax, bx), np.maximum(ax, bx)
+        min_y, max_y = np.minimum(ay, by), np.maximum(ay, by)
+        span_x, span_y = max_x - min_x + 1, max_y - min_y + 1
+        counts = span_x * span_y
+        items = np.repeat(seg, counts)
+        rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells_x = np.repeat(min_x, counts) + rank % np.repeat(span_x, counts)
+        cells_y = np.repeat(min_y, counts) + rank // np.repeat(span_x, counts)
+        segment_cells, segment_items = grid(cells_y * n_x + cells_x, items)
+
+        arrays = {
+            "index_params": np.array([lat0, x0, y0, cell_size, n_x, n_y]),
+            "index_node_cells": node_cells,
+            "index_node_items": node_items,
+            "index_segment_cells": segment_cells,
+            "index_segment_items": segment_items,
+        }
+        return cls(snapshot, arrays, nodes)
+
+    def save(self, dirpath):
+        """
+        Save the index arrays, next to the snapshot arrays.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        """
+        for name in self.array_names:
+            # Replaced at once : several processes can build and save the
+            # index of a new snapshot while the others load it
+            filepath = path.join(dirpath, f"{name}.npy")
+            tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+            with open(tmp_filepath, "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, snapshot, dirpath, nodes=None):
+        """
+        Load the index saved with `save`.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the indexed graph arrays
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        nodes : SpatialIndex
+            index of the node table shared by the snapshot, see __init__
+
+        Returns
+        -------
+        SpatialIndex or None if the index has not been saved
+        """
+        filepaths = {
+            name: path.join(dirpath, f"{name}.npy") for name in cls.array_names
+        }
+        if not all(path.isfile(filepath) for filepath in filepaths.values()):
+            return None
+        arrays = {
+            name: np.load(filepath, mmap_mode="r")
+            for name, filepath in filepaths.items()
+        }
+        return cls(snapshot, arrays, nodes)
+
+    def _rings(self, px, py):
+        """
+        Yield the cells of the grid ring by ring around a projected point,
+        with the minimum distance between the point and the items of the
+        ring.
+        """
+        cx = int((px - self.x0) // self.cell_size)
+        cy = int((py - self.y0) // self.cell_size)
+        # Skip the empty rings when the point is outside of the grid
+        r = max(0, -cx, cx - self.n_x + 1, -cy, cy - self.n_y + 1)
+        max_r = r + max(self.n_x, self.n_y)
+        while r <= max_r:
+            if r == 0:
+                xs, ys = np.array([cx]), np.array([cy])
+            else:
+                side = np.arange(-r, r + 1)
+                inner = np.arange(-r + 1, r)
+                xs = (
+                    np.concatenate(
+                        (side, side, np.full(len(inner), -r), np.full(len(inner), r))
+                    )
+                    + cx
+                )
+                ys = (
+                    np.concatenate(
+                        (np.full(len(side), -r), np.full(len(side), r), inner, inner)
+                    )
+                    + cy
+                )
+            inside = (xs >= 0) & (xs < self.n_x) & (ys >= 0) & (ys < self.n_y)
+            yield ys[inside] * self.n_x + xs[inside], max(r - 1, 0) * self.cell_size
+            r += 1
+
+    @staticmethod
+    def _items(cells, starts, items):
+        if not len(cells):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([items[starts[c] : starts[c + 1]] for c in cells])
+
+    def nearest_nodes(self, lats, lngs, return_dist=False):
+        """
+        Find the nearest node of many points.
+
+        Parameters
+        ----------
+        lats : array-like
+            latitudes of the points
+        lngs : array-like
+            longitudes of the points
+        return_dist : bool
+            Optionally also return the great-circle distances (in meters)
+
+        Returns
+        -------
+        numpy.ndarray or tuple of (numpy.ndarray, numpy.ndarray)
+            node indices and optionally the distances
+        """
+        lats, lngs = np.atleast_1d(lats), np.atleast_1d(lngs)
+        # Node grid of the shared node table, or of this snapshot
+        grid = self if self.nodes is None else self.nodes
+        pxs, pys = grid.project(lats, lngs)
+        nodes = np.zeros(len(lats), dtype=np.int64)
+        dists = np.zeros(len(lats))
+        for i, (px, py) in enumerate(zip(pxs.tolist(), pys.tolist())):
+            candidates, best = [], np.inf
+            for cells, ring_dist in grid._rings(px, py):
+                # 1% of margin between the projected and great-circle distances
+                if best * 1.01 < ring_dist:
+                    break
+                found = grid._items(cells, grid.index_node_cells, grid.index_node_items)
+                if self.node_mask is not None:
+                    found = found[self.node_mask[found]]
+                if len(found):
+                    candidates.append(found)
+                    best = min(
+                        best,
+                        np.hypot(
+                            self.node_px[found] - px, self.node_py[found] - py
+                        ).min(),
+                    )
+            candidates = np.concatenate(candidates)
+            gc = great_circle(
+                lats[i],
+                lngs[i],
+                self.snapshot.node_y[candidates],
+                self.snapshot.node_x[candidates],
+            )
+            # On ties, the lowest node index (so the lowest node ID)
+            best = np.flatnonzero(gc == gc.min())
+            j = best[np.argmin(candidates[best])]
+            nodes[i], dists[i] = candidates[j], gc[j]
+        if return_dist:
+            return nodes, dists
+        return nodes
+
+    def nearest_edges(self, lats, lngs):
+        """
+        Snap many points on their nearest edge.
+
+        Parameters
+        ----------
+        lats : array-like
+            latitudes of the points
+        lngs : array-like
+            longitudes of the points
+
+        Returns
+        -------
+        list of EdgeSnap
+        """
+        edges, fractions, dists = self.snap_edges(lats, lngs)
+        return [
+            EdgeSnap(edge, fraction, dist)
+            for edge, fraction, dist in zip(
+                edges.tolist(), fractions.tolist(), dists.tolist()
+            )
+        ]
+
+    def snap_edges(self, lats, lngs, batch_size=5000):
+        """
+        Snap many points on their nearest edge, vectorized by batches.
+
+        The segments of the 3x3 cells around each point are compared at
+        once. It's exact when the nearest segment is closer than a cell
+        size, the other points are snapped one by one ring by ring.
+
+        Parameters
+        ----------
+        lats : array-like
+            latitudes of the points
+        lngs : array-like
+            longitudes of the points
+        batch_size : int
+            number of points compared at once, bounds the memory used
+
+        Returns
+        -------
+        tuple of (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            index of the edges, position of the points along the edges
+            (0 to 1) and distances (in meters)
+        """
+        pxs, pys = self.project(np.atleast_1d(lats), np.atleast_1d(lngs))
+        n_points = len(pxs)
+        best_seg = np.zeros(n_points, dtype=np.int64)
+        best_t = np.zeros(n_points)
+        best_d = np.full(n_points, np.inf)
+        cxs = ((pxs - self.x0) // self.cell_size).astype(np.int64)
+        cys = ((pys - self.y0) // self.cell_size).astype(np.int64)
+        off_x, off_y = np.meshgrid([-1, 0, 1], [-1, 0, 1])
+        off_x, off_y = off_x.ravel(), off_y.ravel()
+
+        for start in range(0, n_points, batch_size):
+            end = min(start + batch_size, n_points)
+            cx = cxs[start:end, None] + off_x
+            cy = cys[start:end, None] + off_y
+            inside = ((cx >= 0) & (cx < self.n_x) & (cy >= 0) & (cy < self.n_y)).ravel()
+            cells = (cy * self.n_x + cx).ravel()[inside]
+            points = np.repeat(np.arange(start, end), len(off_x))[inside]
+            starts = self.index_segment_cells[cells]
+            counts = self.index_segment_cells[cells + 1] - starts
+            pair_point = np.repeat(points, counts)
+            rank = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            pair_seg = self.index_segment_items[np.repeat(starts, counts) + rank]
+            d, t = self._segment_distances(pair_seg, pxs[pair_point], pys[pair_point])
+
+            # Nearest segment of each point
+            order = np.lexsort((d, pair_point))
+            sorted_point = pair_point[order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = sorted_point[1:] != sorted_point[:-1]
+            sel = order[first]
+            best_seg[pair_point[sel]] = pair_seg[sel]
+            best_t[pair_point[sel]] = t[sel]
+            best_d[pair_point[sel]] = d[sel]
+
+        for i in np.flatnonzero(best_d > self.cell_size).tolist():
+            best_seg[i], best_t[i], best_d[i] = self._nearest_segment(pxs[i], pys[i])
+
+        edges = self.point_edge[best_seg]
+        position = (
+            self.point_position[best_seg] + best_t * self.segment_length[best_seg]
+        )
+        edge_length = self.edge_proj_length[edges]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fractions = np.where(edge_length > 0, position / edge_length, 0.0)
+        return edges, np.clip(fractions, 0.0, 1.0), best_d
+
+    def _segment_distances(self, segments, px, py):
+        """
+        Distance between points and segments, and position of the
+        projection of the points on the segments (0 to 1)
+        """
+        ax, ay = self.geom_px[segments], self.geom_py[segments]
+        dx = self.geom_px[segments + 1] - ax
+        dy = self.geom_py[segments + 1] - ay
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.clip(((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy), 0, 1)
+        t = np.nan_to_num(t)
+        return np.hypot(ax + t * dx - px, ay + t * dy - py), t
+
+    def _nearest_segment(self, px, py):
+        """Nearest segment of a projected point, searched ring by ring"""
+        best, best_seg, best_t = np.inf, 0, 0.0
+        for cells, ring_dist in self._rings(px, py):
+            if best < ring_dist:
+                break
+            found = self._items(
+                cells, self.index_segment_cells, self.index_segment_items
+            )
+            if not len(found):
+                continue
+            d, t = self._segment_distances(found, px, py)
+            j = int(np.argmin(d))
+            if d[j] < best:
+                best, best_seg, best_t = float(d[j]), int(found[j]), float(t[j])
+        return best_seg, best_t, best
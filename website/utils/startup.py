@@ -0,0 +1,163 @@
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(timings, stage):
+    """Time a stage and store its duration (in seconds) in timings[stage]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+class Startup:
+    """
+    Loading state of the services of the website : the duration of each
+    loading stage, then ready (or the error which stopped the loading).
+
+    The services are loaded at once (load) or in a background thread
+    (start) : the server then answers its health checks while the graph is
+    loaded, and reports ready (see status) only once it is mapped.
+    """
+
+    def __init__(self):
+        # Time of the creation, the start of the loading
+        self.created = time.perf_counter()
+        # stage:duration in seconds, in the loading order
+        self.timings = OrderedDict()
+        # Exception raised by the loader, None if it has not failed
+        self.error = None
+        # Duration (in seconds) from the creation to the end of the loading
+        self.ready_after = None
+        self._ready = threading.Event()
+        # Set at the end of the loading, ready or failed
+        self._done = threading.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def stage(self, name):
+        """Context timing a loading stage, see timed"""
+        return timed(self.timings, name)
+
+    def load(self, loader):
+        """
+        Load the services : call loader(startup), which times its stages
+        with `stage`, then set the services as ready.
+
+        Raises
+        ------
+        Exception
+            The exception raised by the loader (kept in error).
+        """
+        try:
+            loader(self)
+        except Exception as err:
+            self.error = err
+            raise
+        else:
+            self.ready_after = time.perf_counter() - self.created
+            self._ready.set()
+        finally:
+            self._done.set()
+
+    def start(self, loader):
+        """
+        Load the services in a background (daemon) thread, see load.
+
+        Returns
+        -------
+        threading.Thread
+        """
+        thread = threading.Thread(
+            target=self.load, args=(loader,), name="startup", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def wait(self, timeout=None):
+        """
+        Wait for the end of the loading, ready or failed (see error).
+        Returns True if ready.
+        """
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self):
+        """
+        Returns the loading state as a JSON-serializable dict : ready, the
+        error, the seconds until ready and the seconds of each stage.
+        """
+        return {
+            "ready": self.ready,
+            "error": repr(self.error) if self.error is not None else None,
+            "ready_after": self.ready_after,
+            "stages": dict(self.timings),
+        }
+
+
+if __name__ == "__main__":
+    # Startup and first route timings :
+    #   PYTHONPATH=website python -m utils.startup [--partitioned]
+    import os
+    import sys
+
+    import numpy as np
+
+    start = time.perf_counter()
+    imports = OrderedDict()
+    with timed(imports, "flask"):
+        import flask
+    # The website loads the graph in the background, as with LAZY_STARTUP
+    os.environ["LAZY_STARTUP"] = "1"
+    if "--partitioned" in sys.argv:
+        os.environ["PARTITIONED_ROUTES"] = "1"
+    with timed(imports, "route"):
+        import route
+    print(f"[!] Imports : {time.perf_counter() - start:.3f} s")
+    for name, seconds in imports.items():
+        print(f"    {name:<30} {seconds:.3f} s")
+
+    if not route.startup.wait():
+        sys.exit(f"[!] Loading failed : {route.startup.error!r}")
+    print(f"[!] Ready : {time.perf_counter() - start:.3f} s")
+    for name, seconds in route.startup.timings.items():
+        print(f"    {name:<30} {seconds:.3f} s")
+
+    # Routes between two nodes drawn at random, in this process
+    route_manager = route.route_manager
+    route_manager.route_workers = 0
+    rng = np.random.default_rng(0)
+    for label in ("First route", "Second route"):
+        nodes = rng.integers(0, route_manager.snapshot.n_nodes, 2)
+        points = [
+            (
+                float(route_manager.snapshot.node_y[i]),
+                float(route_manager.snapshot.node_x[i]),
+            )
+            for i in nodes
+        ]
+        stages = OrderedDict()
+        with timed(stages, "snap"):
+            ends = [route_manager.snap_point(point) for point in points]
+        with timed(stages, "search"):
+            routes = route_manager.compute_routes(*ends, route_manager.route_types)
+        with timed(stages, "geometry"):
+            routes = {
+                profile: route_manager.convert_route_to_geometry(path)
+                for profile, path in routes.items()
+            }
+        with timed(stages, "render"):
+            route.map_manager.get_map("from", "to", routes=routes)
+        if label == "First route":
+            first_route = time.perf_counter() - start
+        print(f"[!] {label} : {sum(stages.values()):.3f} s")
+        for name, seconds in stages.items():
+            print(f"    {name:<30} {seconds:.3f} s")
+    print(f"[!] Time to first route : {first_route:.3f} s")
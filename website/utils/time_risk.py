@@ -0,0 +1,221 @@
+import os
+
+import numpy as np
+
+from datetime import datetime
+from os import path
+
+from utils.risk_builder import (
+    crash_buckets,
+    crash_severity,
+    snap_crashes,
+    street_ids,
+)
+
+N_BUCKETS = 7 * 24
+
+
+def time_bucket(departure_time):
+    """
+    Time bucket of a departure time : day_of_week * 24 + hour.
+
+    Parameters
+    ----------
+    departure_time : datetime.datetime
+        departure time
+
+    Returns
+    -------
+    int
+        bucket from 0 to 167, Monday 0h is 0
+    """
+    return departure_time.weekday() * 24 + departure_time.hour
+
+
+class TimeBucketRisk:
+    """
+    Hour by day of week risk factors of the edges.
+
+    The global risk of an edge during a time bucket is its global risk
+    multiplied by the factor of the bucket. The factors of a street are
+    its share of the crashes in each bucket, smoothed toward the share of
+    the whole city (the crash data of a single street is very sparse), and
+    average to 1 over the week.
+
+    Only the edges with crashes have factors, stored as a float32 matrix
+    (n edges x 168 buckets), the global risk of the other ones is 0.
+    """
+
+    array_names = ("time_risk_edges", "time_risk_factors")
+
+    def __init__(self, edges, factors):
+        """
+        Initialize the TimeBucketRisk
+
+        Parameters
+        ----------
+        edges : numpy.ndarray
+            sorted indices of the edges with factors
+        factors : numpy.ndarray
+            float32 matrix of the factors (len(edges) x 168)
+        """
+        self.edges = edges
+        self.factors = factors
+
+    @classmethod
+    def build(
+        cls, snapshot, spatial_index, chunks, smoothing=5.0, severity=crash_severity
+    ):
+        """
+        Compute the factors from crashes.
+
+        Parameters
+        ----------
+        snapshot : GraphSnapshot
+            the graph arrays
+        spatial_index : SpatialIndex
+            index of the graph
+        chunks : iterable of pandas.DataFrame
+            crashes, see risk_builder.read_crashes
+        smoothing : float
+            weight (in number of crashes) of the city profile in the
+            factors of each street
+        severity : function
+            returns the severity of each crash of a DataFrame
+
+        Returns
+        -------
+        TimeBucketRisk
+        """
+        edge_street = street_ids(snapshot)
+        # Sparse severity by (street, bucket), reduced after each chunk
+        keys, values = np.zeros(0, dtype=np.int64), np.zeros(0)
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            edges = snap_crashes(spatial_index, chunk)
+            buckets = crash_buckets(chunk)
+            # Crashes too far from the streets or without a valid time
+            kept = (edges >= 0) & (buckets >= 0) & (buckets < N_BUCKETS)
+            chunk_keys = edge_street[edges[kept]] * N_BUCKETS + buckets[kept]
+            keys = np.concatenate((keys, chunk_keys))
+            values = np.concatenate((values, severity(chunk)[kept]))
+            keys, inverse = np.unique(keys, return_inverse=True)
+            values = np.bincount(inverse.ravel(), weights=values)
+
+        streets, street_pos = np.unique(keys // N_BUCKETS, return_inverse=True)
+        severity = np.zeros((len(streets), N_BUCKETS))
+        np.add.at(severity, (street_pos.ravel(), keys % N_BUCKETS), values)
+        city = severity.sum(axis=0)
+        city = city / city.sum() if city.sum() else np.full(N_BUCKETS, 1 / N_BUCKETS)
+        factors = (
+            N_BUCKETS
+            * (severity + smoothing * city)
+            / (severity.sum(axis=1, keepdims=True) + smoothing)
+        )
+
+        pos = np.clip(
+            np.searchsorted(streets, edge_street), 0, max(len(streets) - 1, 0)
+        )
+        has_factors = (
+            streets[pos] == edge_street
+            if len(streets)
+            else np.zeros(len(edge_street), bool)
+        )
+        edges = np.flatnonzero(has_factors)
+        return cls(edges, factors[pos[has_factors]].astype(np.float32))
+
+    def save(self, dirpath):
+        """
+        Save the factors in the snapshot directory.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+        """
+        # Replaced at once (see SpatialIndex.save), the edges last : their
+        # number is checked by load against the factors
+        for name, array in (
+            ("time_risk_factors", self.factors),
+            ("time_risk_edges", self.edges),
+        ):
+            filepath = path.join(dirpath, f"{name}.npy")
+            tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+            with open(tmp_filepath, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, dirpath):
+        """
+        Load the factors saved with `save`.
+
+        Parameters
+        ----------
+        dirpath : string or pathlib.Path
+            path to the snapshot directory
+
+        Returns
+        -------
+        TimeBucketRisk or None if the factors have not been saved
+        """
+        filepaths = [path.join(dirpath, f"{name}.npy") for name in cls.array_names]
+        if not all(path.isfile(filepath) for filepath in filepaths):
+            return None
+        # Read again if the files were replaced in between (see save)
+        for _ in range(3):
+            edges, factors = (
+                np.load(filepath, mmap_mode="r") for filepath in filepaths
+            )
+            if len(edges) == len(factors):
+                return cls(edges, factors)
+        return None
+
+    def edge_factors(self, n_edges, bucket):
+        """
+        Factor of the risk of each edge during a time bucket, 1 for the
+        edges without factors.
+
+        Parameters
+        ----------
+        n_edges : int
+            number of edges of the snapshot
+        bucket : int
+            time bucket, see time_bucket
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        factors = np.ones(n_edges)
+        factors[self.edges] = self.factors[:, bucket]
+        return factors
+
+    def global_risk(self, global_risk, bucket):
+        """
+        Global risk of the edges during a time bucket.
+
+        Parameters
+        ----------
+        global_risk : numpy.ndarray
+            global risk of each edge
+        bucket : int
+            time bucket, see time_bucket
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        return np.asarray(global_risk, dtype=float) * self.edge_factors(
+            len(global_risk), bucket
+        )
+
+
+if __name__ == "__main__":
+    # Offline preprocessing : PYTHONPATH=website python -m utils.time_risk
+    from utils.NYCRouteManager import NYCRouteManager
+
+    print(f"[!] Start Time Buckets: {datetime.now()}")
+    NYCRouteManager().build_time_risk()
+    print(f"[!] End Time Buckets: {datetime.now()}")